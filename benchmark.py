@@ -0,0 +1,193 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from loadtest import NodeGroup, percentile
+
+WAIT_TIMEOUT = 30  # Seconds for a single message or file to arrive before the run is abandoned
+WARMUP_MESSAGES = 10  # Round trips sent, and not counted, before the measured ones
+
+# Every metric a run records, and whether a bigger value is better
+METRICS = {
+    "connect_p50_ms": False,
+    "connect_p99_ms": False,
+    "reconnect_p50_ms": False,
+    "reconnect_p99_ms": False,
+    "roundtrip_p50_ms": False,
+    "roundtrip_p99_ms": False,
+    "file_mb_per_s": True
+}
+
+
+def _wait(event, what):
+    if not event.wait(WAIT_TIMEOUT):
+        raise RuntimeError(f"{what} did not arrive within {WAIT_TIMEOUT} s")
+    event.clear()
+
+
+def _bench_connect(group, peers):
+    """Full handshakes with peers never met before, then signed reconnects to the same peers"""
+    node = group.nodes["node0"]
+    ports = group.ports()
+    for peer in peers:
+        if group.connect([("node0", peer, ports[peer])]) != 1:
+            raise RuntimeError(f"could not connect to {peer}")
+    connects = list(group.connect_latencies)
+    for peer in peers:
+        node.disconnect_from_peer(peer)
+    for peer in peers:
+        if group.connect([("node0", peer, ports[peer])]) != 1:
+            raise RuntimeError(f"could not reconnect to {peer}")
+    reconnects = group.connect_latencies[len(connects):]
+    return {
+        "connect_p50_ms": percentile(connects, 0.5),
+        "connect_p99_ms": percentile(connects, 0.99),
+        "reconnect_p50_ms": percentile(reconnects, 0.5),
+        "reconnect_p99_ms": percentile(reconnects, 0.99)
+    }
+
+
+def _bench_roundtrip(sender, echo, count):
+    """One message at a time to a peer that sends it straight back"""
+    returned = threading.Event()
+    echo.message_received.connect(
+        lambda peer, content: echo.send_message(peer, content) if content.startswith("rt|") else None)
+    sender.message_received.connect(
+        lambda peer, content: returned.set() if content.startswith("rt|") else None)
+    latencies = []
+    for i in range(WARMUP_MESSAGES + count):
+        started = time.perf_counter()
+        sender.send_message(echo.username, f"rt|{i}")
+        _wait(returned, "an echoed message")
+        if i >= WARMUP_MESSAGES:
+            latencies.append(time.perf_counter() - started)
+    return {
+        "roundtrip_p50_ms": percentile(latencies, 0.5),
+        "roundtrip_p99_ms": percentile(latencies, 0.99)
+    }
+
+
+def _bench_files(group, sender, receiver, count, size):
+    """Files sent one after another; the rate is over all of them, from first send to last arrival"""
+    path = os.path.join(group.data_dir, "benchmark.bin")
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+    arrived = threading.Event()
+    receiver.file_received.connect(lambda peer, filename, filepath: arrived.set())
+    started = time.perf_counter()
+    for _ in range(count):
+        if not sender.send_file(receiver.username, path):
+            raise RuntimeError("could not send a file")
+        _wait(arrived, "a file")
+    elapsed = time.perf_counter() - started
+    return {"file_mb_per_s": count * size / elapsed / 1e6}
+
+
+def run_benchmarks(connects=10, messages=200, files=5, file_size=4194304, transport="tcp", base_port=17500):
+    """Measure every metric in METRICS on nodes in this process, returning a baseline dict"""
+    group = NodeGroup(list(range(connects + 1)), transport, base_port)
+    try:
+        peers = [f"node{i}" for i in range(1, connects + 1)]
+        results = _bench_connect(group, peers)
+        sender, receiver = group.nodes["node0"], group.nodes["node1"]
+        results.update(_bench_roundtrip(sender, receiver, messages))
+        results.update(_bench_files(group, sender, receiver, files, file_size))
+    finally:
+        group.stop()
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count()
+        },
+        "settings": {
+            "connects": connects,
+            "messages": messages,
+            "files": files,
+            "file_size": file_size,
+            "transport": transport
+        },
+        "results": results
+    }
+
+
+def compare(baseline, current, threshold=10.0):
+    """Each metric in both runs as (name, before, after, percent change, regressed)
+
+    A metric regresses when it moves the wrong way by more than threshold percent.
+    """
+    rows = []
+    for name, higher_is_better in METRICS.items():
+        before = baseline["results"].get(name)
+        after = current["results"].get(name)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        regressed = -change > threshold if higher_is_better else change > threshold
+        rows.append((name, before, after, change, regressed))
+    return rows
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _print_comparison(baseline, current, threshold):
+    """Print how current compares to baseline, returning the number of regressions"""
+    if baseline.get("machine") != current.get("machine"):
+        print("Note: the runs were made on different machines or Python versions")
+    if baseline.get("settings") != current.get("settings"):
+        print("Note: the runs used different settings")
+    rows = compare(baseline, current, threshold)
+    for name, before, after, change, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"  {name:<18} {before:>10.2f} -> {after:>10.2f}  {change:+6.1f}%{flag}")
+    regressions = sum(1 for row in rows if row[4])
+    print(f"{regressions} regression(s) beyond {threshold:g}%")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='End-to-end benchmarks with JSON baselines')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument('--connects', type=int, default=10, help='Peers to connect and reconnect to')
+    run_parser.add_argument('--messages', type=int, default=200, help='Message round trips to time')
+    run_parser.add_argument('--files', type=int, default=5, help='Files to send')
+    run_parser.add_argument('--file-size', type=int, default=4194304, help='Size of each file in bytes')
+    run_parser.add_argument('--transport', choices=['tcp', 'ipc'], default='tcp', help='Transport between nodes')
+    run_parser.add_argument('--base-port', type=int, default=17500, help='Port of the first node')
+    run_parser.add_argument('--output', help='Save the results as a JSON baseline')
+    run_parser.add_argument('--baseline', help='Compare the results with this baseline')
+    run_parser.add_argument('--threshold', type=float, default=10.0,
+                            help='Percent a metric may get worse before it counts as a regression')
+
+    compare_parser = commands.add_parser('compare', help='Compare two saved runs')
+    compare_parser.add_argument('baseline', help='The run to compare against')
+    compare_parser.add_argument('current', help='The run being checked')
+    compare_parser.add_argument('--threshold', type=float, default=10.0,
+                                help='Percent a metric may get worse before it counts as a regression')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        sys.exit(1 if _print_comparison(_load(args.baseline), _load(args.current), args.threshold) else 0)
+
+    # Nodes log every message they handle, which would drown the results
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        current = run_benchmarks(args.connects, args.messages, args.files, args.file_size, args.transport,
+                                 args.base_port)
+    for name, value in current["results"].items():
+        print(f"  {name:<18} {value:>10.2f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=4)
+        print(f"Saved to {args.output}")
+    if args.baseline:
+        sys.exit(1 if _print_comparison(_load(args.baseline), current, args.threshold) else 0)
@@ -0,0 +1,631 @@
+import itertools
+import math
+import time
+from collections import OrderedDict
+from PyQt6.QtWidgets import QListView, QStyledItemDelegate, QStyle, QAbstractItemView, QApplication
+from PyQt6.QtCore import Qt, QAbstractListModel, QModelIndex, QSize, QRectF, QPointF, QPoint
+from PyQt6.QtGui import QColor, QFont, QFontMetrics, QPainter, QTextLayout, QTextOption, QKeySequence
+
+# Bubble geometry, matching the old MessageBubble widget
+BUBBLE_MAX_WIDTH = 400
+BUBBLE_MIN_WIDTH = 40
+BUBBLE_RADIUS = 15
+BUBBLE_PADDING_X = 12
+BUBBLE_PADDING_Y = 8
+SIDE_MARGIN = 12
+ROW_SPACING = 6
+NAME_SPACING = 2
+
+SELF_COLOR = QColor("#007AFF")
+PEER_COLOR = QColor("#E9E9EB")
+SELF_TEXT_COLOR = QColor("white")
+PEER_TEXT_COLOR = QColor("black")
+SYSTEM_TEXT_COLOR = QColor("#8E8E93")
+SELECTION_COLOR = QColor("#E5E5EA")
+
+# Rows a conversation keeps in its model, and how many are paged in at a time; paging in one
+# direction evicts as many rows from the other end, so the model never grows past the window
+CONVERSATION_WINDOW = 200
+HISTORY_PAGE_SIZE = 100
+
+# Messages kept in memory outside the window, on each side, when there is no message store
+HISTORY_LIMIT = 100000
+
+# Most rows paged in to bring a search result into its conversation
+REVEAL_LIMIT = 5000
+
+# Row heights are cheap to keep; full text layouts only matter for rows on screen
+METRICS_CACHE_SIZE = 20000
+LAYOUT_CACHE_SIZE = 512
+
+# Role used to fetch the ChatMessage behind a row
+MessageRole = Qt.ItemDataRole.UserRole + 1
+
+_message_ids = itertools.count(1)
+
+
+class ChatMessage:
+    """A single chat line shown in the chat view"""
+    __slots__ = ("message_id", "username", "text", "is_self", "timestamp", "store_id")
+
+    def __init__(self, username, text, is_self=False, timestamp=None, message_id=None, store_id=None):
+        self.message_id = message_id if message_id is not None else next(_message_ids)
+        self.username = username
+        self.text = text
+        self.is_self = is_self
+        self.timestamp = timestamp if timestamp is not None else time.time()
+        self.store_id = store_id  # Row id in the MessageStore, once persisted
+
+    @classmethod
+    def from_stored(cls, row):
+        """Build a message from a MessageStore.page() row"""
+        store_id, username, text, is_self, timestamp = row
+        return cls(username, text, is_self, timestamp, store_id=store_id)
+
+    @property
+    def is_system(self):
+        return self.username == "System"
+
+
+class MessageListModel(QAbstractListModel):
+    """List model holding the messages of a conversation"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.messages = []
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.messages)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.messages):
+            return None
+        message = self.messages[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return message.text
+        if role == MessageRole:
+            return message
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(message.timestamp))
+        return None
+
+    def append_message(self, message):
+        """Append one message at the end"""
+        row = len(self.messages)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.messages.append(message)
+        self.endInsertRows()
+
+    def append_messages(self, messages):
+        """Append several messages with a single row insertion"""
+        if not messages:
+            return
+        row = len(self.messages)
+        self.beginInsertRows(QModelIndex(), row, row + len(messages) - 1)
+        self.messages.extend(messages)
+        self.endInsertRows()
+
+    def clear(self):
+        """Remove every message"""
+        self.beginResetModel()
+        self.messages = []
+        self.endResetModel()
+
+
+class ConversationModel(MessageListModel):
+    """Messages with one peer: a fixed window of rows, paged back and forth through the history on demand
+
+    With a MessageStore, messages outside the window are read back from it; without one they are
+    kept in memory.
+    """
+
+    def __init__(self, peer, window_size=CONVERSATION_WINDOW, parent=None, store=None):
+        super().__init__(parent)
+        self.peer = peer
+        self.window_size = window_size
+        self.store = store
+        self.older = []  # Messages before the window, oldest first, when there is no store
+        self.newer = []  # Messages after the window, oldest first, when there is no store
+        self.stored_older = store is not None  # Whether the store may hold messages before the window
+        self.stored_newer = False  # Whether the store holds messages after the window
+        self.evicted = []  # Ids of messages paged out, for the view to drop their cached layouts
+        self.top_row = None  # Row at the top of the view when it was last hidden, None for the bottom
+
+    def load_history(self):
+        """Fill an empty conversation with its most recent stored messages"""
+        if self.store is None or self.messages:
+            return
+        rows = self.store.page(self.peer, limit=self.window_size)
+        self.append_messages([ChatMessage.from_stored(row) for row in rows])
+        self.stored_older = len(self.messages) == self.window_size
+
+    def can_load_older(self):
+        return self.stored_older or bool(self.older)
+
+    def can_load_newer(self):
+        return self.stored_newer or bool(self.newer)
+
+    def take_evicted(self):
+        """Ids of the messages paged out since the last call"""
+        evicted, self.evicted = self.evicted, []
+        return evicted
+
+    def append_messages(self, messages):
+        """Append new messages, or hold them back while the window is paged away from the latest rows"""
+        if not self.can_load_newer():
+            super().append_messages(messages)
+        elif self.store is None:
+            self.newer.extend(messages)
+            self._bound(self.newer, keep_newest=False)
+        # With a store they are already queued for it and are read back when paged to
+
+    def _read_older(self, count):
+        """Read the page before the first row from the store"""
+        first = self.messages[0] if self.messages else None
+        if first is not None and first.store_id is None:
+            self.stored_older = False
+            return []
+        # Rows just appended may still be queued for writing
+        self.store.flush()
+        before = (first.timestamp, first.store_id) if first is not None else None
+        rows = self.store.page(self.peer, before, count)
+        if len(rows) < count:
+            self.stored_older = False
+        return [ChatMessage.from_stored(row) for row in rows]
+
+    def _read_newer(self, count):
+        """Read the page after the last row from the store"""
+        last = self.messages[-1] if self.messages else None
+        if last is None or last.store_id is None:
+            self.stored_newer = False
+            return []
+        self.store.flush()
+        rows = self.store.page(self.peer, limit=count, after=(last.timestamp, last.store_id))
+        if len(rows) < count:
+            self.stored_newer = False
+        return [ChatMessage.from_stored(row) for row in rows]
+
+    def _bound(self, messages, keep_newest=True):
+        # Only the in-memory history needs a cap; the store keeps everything
+        if len(messages) > HISTORY_LIMIT:
+            if keep_newest:
+                del messages[:len(messages) - HISTORY_LIMIT]
+            else:
+                del messages[HISTORY_LIMIT:]
+
+    def load_older(self, count=HISTORY_PAGE_SIZE):
+        """Page older messages in above the current rows, returning how many were added
+
+        As many of the newest rows are paged out below, so the window keeps its size.
+        """
+        if self.store is not None:
+            page = self._read_older(count)
+        else:
+            page = self.older[-count:]
+            del self.older[-len(page):]
+        if not page:
+            return 0
+        self.beginInsertRows(QModelIndex(), 0, len(page) - 1)
+        self.messages[0:0] = page
+        self.endInsertRows()
+
+        excess = len(self.messages) - self.window_size
+        if excess > 0:
+            dropped = self.messages[-excess:]
+            self.beginRemoveRows(QModelIndex(), len(self.messages) - excess, len(self.messages) - 1)
+            del self.messages[-excess:]
+            self.endRemoveRows()
+            if self.store is not None:
+                self.stored_newer = True
+            else:
+                self.newer[0:0] = dropped
+                self._bound(self.newer, keep_newest=False)
+            self.evicted.extend(message.message_id for message in dropped)
+        return len(page)
+
+    def load_newer(self, count=HISTORY_PAGE_SIZE):
+        """Page newer messages in below the current rows, returning how many were added
+
+        As many of the oldest rows are paged out above, so the window keeps its size.
+        """
+        if self.store is not None:
+            page = self._read_newer(count)
+        else:
+            page = self.newer[:count]
+            del self.newer[:len(page)]
+        if not page:
+            return 0
+        super().append_messages(page)
+        self.evicted.extend(self.trim())
+        return len(page)
+
+    def show_latest(self):
+        """Move the window back to the most recent messages"""
+        if not self.can_load_newer():
+            return
+        self.evicted.extend(message.message_id for message in self.messages)
+        self.beginResetModel()
+        if self.store is not None:
+            self.store.flush()
+            rows = self.store.page(self.peer, limit=self.window_size)
+            self.messages = [ChatMessage.from_stored(row) for row in rows]
+            self.stored_older = len(self.messages) == self.window_size
+            self.stored_newer = False
+        else:
+            history = self.older + self.messages + self.newer
+            self.messages = history[-self.window_size:]
+            self.older = history[:-self.window_size]
+            self._bound(self.older)
+            self.newer = []
+        self.endResetModel()
+
+    def reveal(self, store_id, limit=REVEAL_LIMIT):
+        """Page the window to the stored message, returning its row or -1"""
+        for row, message in enumerate(self.messages):
+            if message.store_id == store_id:
+                return row
+
+        # The message may be newer than a window paged back, so search back from the latest rows
+        if self.can_load_newer():
+            self.show_latest()
+            for row, message in enumerate(self.messages):
+                if message.store_id == store_id:
+                    return row
+
+        searched = len(self.messages)
+        while searched < limit and self.can_load_older():
+            loaded = self.load_older()
+            for row in range(loaded):
+                if self.messages[row].store_id == store_id:
+                    return row
+            if not loaded:
+                break
+            searched += loaded
+        return -1
+
+    def trim(self):
+        """Drop rows beyond the window to the older history, returning their message ids"""
+        excess = len(self.messages) - self.window_size
+        if excess <= 0:
+            return []
+        dropped = self.messages[:excess]
+        self.beginRemoveRows(QModelIndex(), 0, excess - 1)
+        del self.messages[:excess]
+        self.endRemoveRows()
+
+        if self.store is not None:
+            # Already persisted, so they can be read back when scrolled to
+            self.stored_older = True
+        else:
+            self.older.extend(dropped)
+            self._bound(self.older)
+        return [message.message_id for message in dropped]
+
+
+class LRUCache:
+    """Size-bounded least-recently-used cache with hit-rate statistics"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached value for key, or None"""
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used entries beyond capacity"""
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, key):
+        """Drop a single entry"""
+        self.entries.pop(key, None)
+
+    def clear(self):
+        """Drop every entry, keeping the statistics"""
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+
+class BubbleLayout:
+    """Geometry of one painted row, relative to the row's top-left corner"""
+    __slots__ = ("text_layout", "name_pos", "bubble_rect", "text_pos", "height")
+
+    def __init__(self, text_layout, name_pos, bubble_rect, text_pos, height):
+        self.text_layout = text_layout
+        self.name_pos = name_pos
+        self.bubble_rect = bubble_rect
+        self.text_pos = text_pos
+        self.height = height
+
+
+def _layout_text(text, font, max_width, alignment=Qt.AlignmentFlag.AlignLeft):
+    """Wrap text to max_width, returning the laid out QTextLayout and its size"""
+    # QTextLayout treats the Unicode line separator as a hard line break
+    text_layout = QTextLayout(text.replace("\n", "\u2028"), font)
+    option = QTextOption(alignment)
+    option.setWrapMode(QTextOption.WrapMode.WrapAtWordBoundaryOrAnywhere)
+    text_layout.setTextOption(option)
+
+    height = 0.0
+    natural_width = 0.0
+    text_layout.beginLayout()
+    while True:
+        line = text_layout.createLine()
+        if not line.isValid():
+            break
+        line.setLineWidth(max_width)
+        line.setPosition(QPointF(0, height))
+        height += line.height()
+        natural_width = max(natural_width, line.naturalTextWidth())
+    text_layout.endLayout()
+
+    return text_layout, math.ceil(natural_width), math.ceil(height)
+
+
+def layout_bubble(message, width, font):
+    """Compute the painted geometry of a message for a viewport width"""
+    metrics = QFontMetrics(font)
+    available = max(width - 2 * SIDE_MARGIN, BUBBLE_MIN_WIDTH)
+
+    # System messages are centred grey text without a bubble
+    if message.is_system:
+        text_layout, _, text_height = _layout_text(message.text, font, available, Qt.AlignmentFlag.AlignHCenter)
+        return BubbleLayout(text_layout, None, None, QPointF(SIDE_MARGIN, ROW_SPACING),
+                            text_height + 2 * ROW_SPACING)
+
+    max_text_width = min(available, BUBBLE_MAX_WIDTH) - 2 * BUBBLE_PADDING_X
+    text_layout, text_width, text_height = _layout_text(message.text, font, max(max_text_width, 1))
+
+    bubble_width = max(text_width + 2 * BUBBLE_PADDING_X, BUBBLE_MIN_WIDTH)
+    bubble_height = text_height + 2 * BUBBLE_PADDING_Y
+    name_height = metrics.height() + NAME_SPACING
+
+    # Our own messages sit on the right, everyone else's on the left
+    if message.is_self:
+        x = width - SIDE_MARGIN - bubble_width
+    else:
+        x = SIDE_MARGIN
+    top = ROW_SPACING + name_height
+
+    return BubbleLayout(
+        text_layout,
+        QPointF(x + 4, ROW_SPACING + metrics.ascent()),
+        QRectF(x, top, bubble_width, bubble_height),
+        QPointF(x + BUBBLE_PADDING_X, top + BUBBLE_PADDING_Y),
+        top + bubble_height + ROW_SPACING
+    )
+
+
+class BubbleDelegate(QStyledItemDelegate):
+    """Paints chat bubbles directly instead of building a widget per message"""
+
+    def __init__(self, view):
+        super().__init__(view)
+        self.view = view
+        self.width = view.viewport().width()
+        # Both caches are keyed by (message id, viewport width)
+        self.metrics_cache = LRUCache(METRICS_CACHE_SIZE)
+        self.layout_cache = LRUCache(LAYOUT_CACHE_SIZE)
+
+    def _layout(self, message, font):
+        """Get the full layout of a message, computing it on a cache miss"""
+        key = (message.message_id, self.width)
+        layout = self.layout_cache.get(key)
+        if layout is None:
+            layout = layout_bubble(message, key[1], font)
+            self.layout_cache.put(key, layout)
+            self.metrics_cache.put(key, layout.height)
+        return layout
+
+    def _height(self, message, font):
+        """Get the row height of a message without keeping its text layout around"""
+        key = (message.message_id, self.width)
+        height = self.metrics_cache.get(key)
+        if height is None:
+            height = layout_bubble(message, key[1], font).height
+            self.metrics_cache.put(key, height)
+        return height
+
+    def forget(self, message_ids):
+        """Evict the layouts of messages that left the model"""
+        for message_id in message_ids:
+            self.metrics_cache.discard((message_id, self.width))
+            self.layout_cache.discard((message_id, self.width))
+
+    def invalidate(self, width):
+        """Drop every cached layout after the viewport width changed"""
+        self.width = width
+        self.metrics_cache.clear()
+        self.layout_cache.clear()
+
+    def cache_stats(self):
+        return {
+            "metrics": self.metrics_cache.stats(),
+            "layouts": self.layout_cache.stats()
+        }
+
+    def sizeHint(self, option, index):
+        # Called for every row on each relayout, so read the row straight from the model
+        message = index.model().messages[index.row()]
+        return QSize(self.width, self._height(message, option.font))
+
+    def paint(self, painter, option, index):
+        message = index.data(MessageRole)
+        if message is None:
+            return
+        layout = self._layout(message, option.font)
+
+        painter.save()
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+
+        if option.state & QStyle.StateFlag.State_Selected:
+            painter.fillRect(option.rect, SELECTION_COLOR)
+
+        painter.translate(QPointF(option.rect.topLeft()))
+
+        if message.is_system:
+            painter.setPen(SYSTEM_TEXT_COLOR)
+            layout.text_layout.draw(painter, layout.text_pos)
+            painter.restore()
+            return
+
+        # Username above the bubble
+        name_font = QFont(option.font)
+        name_font.setBold(True)
+        painter.setFont(name_font)
+        painter.setPen(PEER_TEXT_COLOR)
+        painter.drawText(layout.name_pos, f"{message.username}:")
+
+        # Bubble
+        bubble_color = SELF_COLOR if message.is_self else PEER_COLOR
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(bubble_color)
+        painter.drawRoundedRect(layout.bubble_rect, BUBBLE_RADIUS, BUBBLE_RADIUS)
+
+        # Message text
+        painter.setPen(SELF_TEXT_COLOR if message.is_self else PEER_TEXT_COLOR)
+        layout.text_layout.draw(painter, layout.text_pos)
+
+        painter.restore()
+
+
+class ChatView(QListView):
+    """Chat display that only lays out and paints the rows on screen"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setItemDelegate(BubbleDelegate(self))
+        self.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.setResizeMode(QListView.ResizeMode.Adjust)
+        self.setWordWrap(True)
+
+        # Conversations keep a bounded window of rows with cached heights, so a single
+        # layout pass is cheap and keeps scroll positions exact
+        self.setLayoutMode(QListView.LayoutMode.SinglePass)
+        self.layout_width = self.viewport().width()
+
+        # Page history in when the user scrolls to either end of the window
+        self.paging = False
+        self.verticalScrollBar().valueChanged.connect(self.load_older_if_at_top)
+        self.verticalScrollBar().valueChanged.connect(self.load_newer_if_at_bottom)
+
+    def setModel(self, model):
+        # setModel creates a new selection model but leaves the old one alive
+        old_selection_model = self.selectionModel()
+        super().setModel(model)
+        if old_selection_model is not None:
+            old_selection_model.deleteLater()
+
+    def show_conversation(self, conversation):
+        """Swap in another conversation, keeping each one's scroll position"""
+        current = self.model()
+        if current is conversation:
+            return
+        if isinstance(current, ConversationModel):
+            if self.is_at_bottom():
+                current.top_row = None
+                self.itemDelegate().forget(current.trim())
+            else:
+                current.top_row = self.indexAt(QPoint(0, 0)).row()
+
+        self.setModel(conversation)
+
+        if conversation.top_row is None or conversation.top_row < 0:
+            self.scrollToBottom()
+        else:
+            self.scrollTo(conversation.index(conversation.top_row, 0), QAbstractItemView.ScrollHint.PositionAtTop)
+
+        # A short conversation can't be scrolled, so fill the view straight away
+        self.load_older_if_at_top(self.verticalScrollBar().value())
+
+    def load_older_if_at_top(self, value):
+        model = self.model()
+        if self.paging or not isinstance(model, ConversationModel):
+            return
+        if value > self.verticalScrollBar().minimum() or not model.can_load_older():
+            return
+
+        self.paging = True
+        try:
+            # Keep the message that was at the top in place after the page is inserted
+            loaded = model.load_older()
+            if loaded:
+                self.scrollTo(model.index(loaded, 0), QAbstractItemView.ScrollHint.PositionAtTop)
+            self.itemDelegate().forget(model.take_evicted())
+        finally:
+            self.paging = False
+
+    def load_newer_if_at_bottom(self, value):
+        model = self.model()
+        if self.paging or not isinstance(model, ConversationModel):
+            return
+        if value < self.verticalScrollBar().maximum() or not model.can_load_newer():
+            return
+
+        self.paging = True
+        try:
+            # Keep the message that was at the bottom in place after the page is appended
+            rows = model.rowCount()
+            loaded = model.load_newer()
+            if loaded:
+                paged_out = rows + loaded - model.rowCount()
+                self.scrollTo(model.index(rows - 1 - paged_out, 0), QAbstractItemView.ScrollHint.PositionAtBottom)
+            self.itemDelegate().forget(model.take_evicted())
+        finally:
+            self.paging = False
+
+    def resizeEvent(self, event):
+        # Wrapped layouts depend on the width, so cached ones are useless after a resize
+        width = self.viewport().width()
+        if width != self.layout_width:
+            self.layout_width = width
+            self.itemDelegate().invalidate(width)
+        super().resizeEvent(event)
+
+    def is_at_bottom(self):
+        scroll_bar = self.verticalScrollBar()
+        return scroll_bar.value() >= scroll_bar.maximum() - 4
+
+    def keyPressEvent(self, event):
+        # Copy the text of the selected messages
+        if event.matches(QKeySequence.StandardKey.Copy):
+            rows = sorted(index.row() for index in self.selectedIndexes())
+            lines = []
+            for row in rows:
+                message = self.model().index(row, 0).data(MessageRole)
+                if message.is_system:
+                    lines.append(message.text)
+                else:
+                    lines.append(f"{message.username}: {message.text}")
+            QApplication.clipboard().setText("\n".join(lines))
+            return
+        super().keyPressEvent(event)
@@ -0,0 +1,64 @@
+import json
+import os
+
+# Defaults for every setting; config.json only needs to override what it changes
+DEFAULT_CONFIG = {
+    "network": {
+        "port": 5555,
+        "transport": "tcp",
+        "timeout": 5000,
+        "accept_timeout": 60000,
+        "bulk_rate_limit": 0,
+        "bulk_burst": 1048576,
+        "relay_port": 5600,
+        "discovery": False,
+        "discovery_port": 5599,
+        "discovery_address": "255.255.255.255",
+        "discovery_interval": 2000,
+        "decode_workers": 2,
+        "dispatch_workers": 1,
+        "pipeline_queue_limit": 10000,
+        "heartbeat_interval": 5000,
+        "heartbeat_timeout": 15000,
+        "metrics_port": 0,
+        "metrics_file": ""
+    },
+    "encryption": {
+        "key_size": 2048,
+        "key_directory": "keys",
+        "identity_path": "data/identity.pem"
+    },
+    "storage": {
+        "path": "data/messages.db",
+        "outbox_path": "data/outbox.db",
+        "outbox_max_attempts": 8,
+        "outbox_ttl": 86400,
+        "directory_path": "data/peers.db"
+    },
+    "ui": {
+        "window_width": 600,
+        "window_height": 400
+    }
+}
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
+
+
+def load_config(path=CONFIG_PATH):
+    """Load config.json merged over the defaults"""
+    config = {section: dict(values) for section, values in DEFAULT_CONFIG.items()}
+    try:
+        with open(path) as f:
+            user_config = json.load(f)
+    except FileNotFoundError:
+        return config
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Error loading config from {path}: {e}")
+        return config
+
+    for section, values in user_config.items():
+        if isinstance(values, dict):
+            config.setdefault(section, {}).update(values)
+        else:
+            config[section] = values
+    return config
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from cryptography.hazmat.primitives import serialization
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS peers (
+    username TEXT PRIMARY KEY,
+    ip TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    public_key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    last_seen REAL NOT NULL
+);
+"""
+
+
+def key_fingerprint(public_key_pem):
+    """SHA-256 of a public key's DER encoding, as hex"""
+    public_key = serialization.load_pem_public_key(public_key_pem.encode())
+    der = public_key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return hashlib.sha256(der).hexdigest()
+
+
+class PeerRecord:
+    """What we remember about a peer between sessions"""
+    __slots__ = ("username", "ip", "port", "public_key", "fingerprint", "last_seen")
+
+    def __init__(self, username, ip, port, public_key, fingerprint, last_seen):
+        self.username = username
+        self.ip = ip
+        self.port = port
+        self.public_key = public_key
+        self.fingerprint = fingerprint
+        self.last_seen = last_seen
+
+
+class PeerDirectory:
+    """Known peers with their last endpoint and pinned public key, kept in SQLite and in memory"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+        # Small enough to keep whole; lookups happen on every connection attempt
+        self.peers = {
+            row[0]: PeerRecord(*row)
+            for row in self.connection.execute(
+                "SELECT username, ip, port, public_key, fingerprint, last_seen FROM peers"
+            )
+        }
+
+    def get(self, username):
+        """The record for a peer, or None if we have never connected to it"""
+        return self.peers.get(username)
+
+    def remember(self, username, ip, port, public_key):
+        """Record a successful connection, returning the pinned fingerprint if the key differs from it
+
+        A different key is never pinned over the old one; forget() the peer first to trust it.
+        """
+        fingerprint = key_fingerprint(public_key)
+        record = PeerRecord(username, ip, port, public_key, fingerprint, time.time())
+        with self.lock, self.connection:
+            previous = self.peers.get(username)
+            if previous is not None and previous.fingerprint != fingerprint:
+                return previous.fingerprint
+            self.peers[username] = record
+            self.connection.execute(
+                "INSERT OR REPLACE INTO peers (username, ip, port, public_key, fingerprint, last_seen) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (username, ip, port, public_key, fingerprint, record.last_seen)
+            )
+        return None
+
+    def forget(self, username):
+        with self.lock, self.connection:
+            self.peers.pop(username, None)
+            self.connection.execute("DELETE FROM peers WHERE username = ?", (username,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,172 @@
+import json
+import select
+import socket
+import threading
+import time
+import uuid
+
+BEACON_TYPE = "shadow-messenger-presence"
+PEER_TTL_INTERVALS = 3  # Beacons a peer may miss before it is dropped
+MAX_BEACON_SIZE = 1024
+
+
+class PresenceEntry:
+    """A peer seen on the local network"""
+    __slots__ = ("username", "ip", "port", "fingerprint", "node", "expires")
+
+    def __init__(self, username, ip, port, fingerprint, node, expires):
+        self.username = username
+        self.ip = ip
+        self.port = port
+        self.fingerprint = fingerprint
+        self.node = node
+        self.expires = expires
+
+
+class PresenceDirectory:
+    """Peers announced by beacons, each forgotten once its beacons stop for the TTL"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}  # username -> PresenceEntry
+        self.lock = threading.Lock()
+
+    def seen(self, username, ip, port, fingerprint, node, now=None):
+        """Record a beacon, returning True if the peer is new or has moved"""
+        expires = (now if now is not None else time.monotonic()) + self.ttl
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is not None and (entry.ip, entry.port, entry.node) == (ip, port, node):
+                entry.expires = expires
+                entry.fingerprint = fingerprint
+                return False
+            self.entries[username] = PresenceEntry(username, ip, port, fingerprint, node, expires)
+            return True
+
+    def get(self, username):
+        with self.lock:
+            return self.entries.get(username)
+
+    def remove(self, username, node=None):
+        """Forget a peer, only if it is still the given node when one is passed"""
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None or (node is not None and entry.node != node):
+                return False
+            del self.entries[username]
+            return True
+
+    def expire(self, now=None):
+        """Drop peers whose beacons have stopped, returning their usernames"""
+        now = now if now is not None else time.monotonic()
+        with self.lock:
+            expired = [username for username, entry in self.entries.items() if entry.expires <= now]
+            for username in expired:
+                del self.entries[username]
+        return expired
+
+
+class Discovery:
+    """Announces us on the LAN with UDP broadcast beacons and listens for other peers' beacons
+
+    Beacons are not authenticated; trusted(username, fingerprint), when given, decides which
+    ones are believed at all.
+    """
+
+    def __init__(self, username, listen_port, fingerprint, discovery_port, broadcast_address,
+                 interval, on_found, on_lost, trusted=None):
+        self.username = username
+        self.listen_port = listen_port
+        self.fingerprint = fingerprint
+        self.discovery_port = discovery_port
+        self.broadcast_address = broadcast_address
+        self.interval = interval
+        self.on_found = on_found
+        self.on_lost = on_lost
+        self.trusted = trusted
+        # Tells our own beacons apart from another instance with the same username
+        self.node = uuid.uuid4().hex
+        self.peers = PresenceDirectory(interval * PEER_TTL_INTERVALS)
+
+        # Every instance on a host binds the same port; broadcasts reach all of them
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.socket.bind(("", discovery_port))
+        # Written to by stop() so the thread doesn't sleep out its timeout
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _beacon(self, leaving=False):
+        return json.dumps({
+            "type": BEACON_TYPE,
+            "username": self.username,
+            "port": self.listen_port,
+            "fingerprint": self.fingerprint,
+            "node": self.node,
+            "leaving": leaving
+        }).encode()
+
+    def _announce(self, leaving=False):
+        try:
+            self.socket.sendto(self._beacon(leaving), (self.broadcast_address, self.discovery_port))
+        except OSError as e:
+            print(f"Error sending presence beacon: {e}")
+
+    def _run(self):
+        next_beacon = time.monotonic()
+        while self.running:
+            now = time.monotonic()
+            if now >= next_beacon:
+                self._announce()
+                next_beacon = now + self.interval
+            for username in self.peers.expire(now):
+                print(f"{username} is no longer on the network")
+                self.on_lost(username)
+
+            readable, _, _ = select.select([self.socket, self.wake_reader], [], [],
+                                           max(0.0, next_beacon - time.monotonic()))
+            if self.wake_reader in readable:
+                break
+            if readable:
+                try:
+                    data, address = self.socket.recvfrom(MAX_BEACON_SIZE)
+                except OSError as e:
+                    print(f"Error receiving presence beacon: {e}")
+                    continue
+                self._handle_beacon(data, address[0])
+
+    def _handle_beacon(self, data, ip):
+        try:
+            beacon = json.loads(data)
+            if beacon.get("type") != BEACON_TYPE or beacon.get("node") == self.node:
+                return
+            username = beacon["username"]
+            port = int(beacon["port"])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return
+        fingerprint = beacon.get("fingerprint", "")
+        if self.trusted is not None and not self.trusted(username, fingerprint):
+            return
+
+        if beacon.get("leaving"):
+            if self.peers.remove(username, beacon.get("node")):
+                print(f"{username} left the network")
+                self.on_lost(username)
+        elif self.peers.seen(username, ip, port, fingerprint, beacon.get("node")):
+            print(f"Discovered {username} at {ip}:{port}")
+            self.on_found(username, ip, port)
+
+    def stop(self):
+        """Tell other peers we are leaving and stop listening"""
+        self.running = False
+        self._announce(leaving=True)
+        self.wake_writer.send(b"\0")
+        if threading.current_thread() is not self.thread and self.thread.is_alive():
+            self.thread.join(timeout=1)
+        for sock in (self.socket, self.wake_reader, self.wake_writer):
+            sock.close()
@@ -3,19 +3,46 @@ from cryptography.hazmat.primitives.asymmetric import rsa, padding
 import base64
 import os
 import json
+from metrics import MetricsRegistry
+
+
+def verify_signature(public_key_pem, data, signature):
+    """Check a base64 signature over bytes against a PEM public key, without keys of our own"""
+    try:
+        public_key = serialization.load_pem_public_key(public_key_pem.encode())
+        public_key.verify(
+            base64.b64decode(signature),
+            data,
+            padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
+            hashes.SHA256()
+        )
+        return True
+    except Exception as e:
+        print(f"Signature verification failed: {e}")
+        return False
 
 class RSAEncryption:
-    def __init__(self):
+    def __init__(self, metrics=None):
         self.private_key = None
         self.public_key = None
         self.keys_dir = "keys"
         
+        # How long each RSA operation takes, kept in the node's registry when it has one
+        self.timings = (metrics or MetricsRegistry()).histogram(
+            "shadow_crypto_seconds", "Time spent in RSA operations", ("operation",))
+        
         # Create keys directory if it doesn't exist
         if not os.path.exists(self.keys_dir):
             os.makedirs(self.keys_dir)
 
     def generate_keys(self):
         """Generate a new RSA key pair"""
+        self._new_key_pair()
+        
+        # Save keys to files
+        self._save_keys()
+
+    def _new_key_pair(self):
         # Generate private key
         self.private_key = rsa.generate_private_key(
             public_exponent=65537,
@@ -24,9 +51,45 @@ class RSAEncryption:
         
         # Get public key
         self.public_key = self.private_key.public_key()
+
+    def load_or_generate_keys(self, identity_path):
+        """Load our long-lived key pair, generating and saving it on first run
+
+        Peers pin this key, so it has to survive restarts. It lives only at identity_path,
+        with owner-only permissions, and is never copied into the keys directory.
+        """
+        try:
+            with open(identity_path, "rb") as f:
+                self.private_key = serialization.load_pem_private_key(f.read(), password=None)
+        except FileNotFoundError:
+            self._new_key_pair()
+            os.makedirs(os.path.dirname(os.path.abspath(identity_path)), exist_ok=True)
+            # Readable by the owner only
+            fd = os.open(identity_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.private_key.private_bytes(
+                    encoding=serialization.Encoding.PEM,
+                    format=serialization.PrivateFormat.PKCS8,
+                    encryption_algorithm=serialization.NoEncryption()
+                ))
+            return
         
-        # Save keys to files
-        self._save_keys()
+        self.public_key = self.private_key.public_key()
+
+    def sign(self, data):
+        """Sign bytes with our private key, returning a base64 signature"""
+        with self.timings.labels("sign").timer():
+            signature = self.private_key.sign(
+                data,
+                padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
+                hashes.SHA256()
+            )
+        return base64.b64encode(signature).decode()
+
+    def verify(self, public_key_pem, data, signature):
+        """Check a base64 signature over bytes against a peer's public key"""
+        with self.timings.labels("verify").timer():
+            return verify_signature(public_key_pem, data, signature)
 
     def _save_keys(self):
         """Save the generated keys to files"""
@@ -54,33 +117,41 @@ class RSAEncryption:
             format=serialization.PublicFormat.SubjectPublicKeyInfo
         ).decode()
 
+    def max_message_size(self, public_key=None):
+        """Longest message in bytes that a single RSA-OAEP block can hold, for our key or the given one"""
+        public_key = public_key or self.public_key
+        return public_key.key_size // 8 - 2 * hashes.SHA256.digest_size - 2
+
     def encrypt_message(self, message, public_key_pem=None):
-        """Encrypt a message using RSA"""
-        try:
-            # If a public key is provided, use it; otherwise use our own public key
-            if public_key_pem:
-                print(f"Loading public key from PEM: {public_key_pem[:50]}...")
-                public_key = serialization.load_pem_public_key(public_key_pem.encode())
-            else:
-                print("Using own public key")
-                public_key = self.public_key
-            
-            # Encrypt the message
-            print(f"Encrypting message: {message[:50]}...")
+        """Encrypt a message using RSA, raising ValueError if it can't be"""
+        # If a public key is provided, use it; otherwise use our own public key
+        if public_key_pem:
+            print(f"Loading public key from PEM: {public_key_pem[:50]}...")
+            public_key = serialization.load_pem_public_key(public_key_pem.encode())
+        else:
+            print("Using own public key")
+            public_key = self.public_key
+        
+        # Never fall back to sending the message in the clear
+        plaintext = message.encode()
+        limit = self.max_message_size(public_key)
+        if len(plaintext) > limit:
+            raise ValueError(f"message is {len(plaintext)} bytes, more than the {limit} RSA can encrypt")
+        
+        # Encrypt the message
+        print(f"Encrypting message: {message[:50]}...")
+        with self.timings.labels("encrypt").timer():
             encrypted = public_key.encrypt(
-                message.encode(),
+                plaintext,
                 padding.OAEP(
                     mgf=padding.MGF1(algorithm=hashes.SHA256()),
                     algorithm=hashes.SHA256(),
                     label=None
                 )
             )
-            result = base64.b64encode(encrypted).decode()
-            print(f"Encryption result: {result[:50]}...")
-            return result
-        except Exception as e:
-            print(f"Encryption error: {e}")
-            return message
+        result = base64.b64encode(encrypted).decode()
+        print(f"Encryption result: {result[:50]}...")
+        return result
 
     def decrypt_message(self, encrypted_message):
         """Decrypt a message using RSA"""
@@ -101,14 +172,15 @@ class RSAEncryption:
             
             # Decrypt using private key
             print("Decrypting with private key")
-            decrypted = self.private_key.decrypt(
-                encrypted,
-                padding.OAEP(
-                    mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                    algorithm=hashes.SHA256(),
-                    label=None
+            with self.timings.labels("decrypt").timer():
+                decrypted = self.private_key.decrypt(
+                    encrypted,
+                    padding.OAEP(
+                        mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                        algorithm=hashes.SHA256(),
+                        label=None
+                    )
                 )
-            )
             
             # Decode from bytes to string
             decrypted_str = decrypted.decode('utf-8')
@@ -0,0 +1,51 @@
+import threading
+
+
+class BoundSignal:
+    """Callbacks connected to one signal of one object"""
+
+    def __init__(self, name):
+        self.name = name
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def connect(self, callback):
+        with self.lock:
+            self.callbacks.append(callback)
+
+    def disconnect(self, callback=None):
+        """Disconnect a callback, or every callback if none is given"""
+        with self.lock:
+            if callback is None:
+                self.callbacks = []
+            elif callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def emit(self, *args):
+        """Call every connected callback on the emitting thread"""
+        with self.lock:
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"Error in {self.name} callback: {e}")
+
+
+class Signal:
+    """Qt-free stand-in for pyqtSignal, declared on the class and bound per instance"""
+
+    def __init__(self, *types):
+        self.types = types  # Documentation only, arguments aren't checked
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        # Cache the bound signal on the instance, which then shadows this descriptor
+        bound = BoundSignal(self.name)
+        instance.__dict__[self.name] = bound
+        return bound
@@ -0,0 +1,175 @@
+import threading
+import time
+from collections import deque
+from types import MappingProxyType
+
+# Outbound handshakes
+CONNECTING = "connecting"
+RECONNECTING = "reconnecting"
+AWAITING_ACCEPT = "awaiting_accept"
+# Inbound handshakes
+REQUESTED = "requested"
+ACCEPTING = "accepting"
+# Both
+KEY_EXCHANGE = "key_exchange"
+CONNECTED = "connected"
+# Terminal states; a new handshake may start from any of them
+FAILED = "failed"
+REFUSED = "refused"
+CANCELLED = "cancelled"
+CLOSED = "closed"
+
+TERMINAL = (FAILED, REFUSED, CANCELLED, CLOSED)
+IDLE = (None,) + TERMINAL  # None is a peer we have no handshake with
+OUTBOUND = (CONNECTING, RECONNECTING, AWAITING_ACCEPT, KEY_EXCHANGE)
+IN_PROGRESS = (CONNECTING, RECONNECTING, AWAITING_ACCEPT, REQUESTED, ACCEPTING, KEY_EXCHANGE)
+
+# Every state a handshake may move to from each state
+TRANSITIONS = {
+    CONNECTING: {RECONNECTING, AWAITING_ACCEPT, KEY_EXCHANGE, CONNECTED, FAILED, REFUSED, CANCELLED},
+    RECONNECTING: {CONNECTING, CONNECTED, FAILED, CANCELLED},
+    AWAITING_ACCEPT: {KEY_EXCHANGE, CONNECTED, FAILED, REFUSED, CANCELLED},
+    REQUESTED: {ACCEPTING, CONNECTING, CONNECTED, FAILED, REFUSED, CANCELLED},
+    ACCEPTING: {KEY_EXCHANGE, CONNECTED, FAILED, CANCELLED},
+    KEY_EXCHANGE: {CONNECTED, FAILED, CANCELLED},
+    CONNECTED: {FAILED, CLOSED},
+}
+for _state in IDLE:
+    TRANSITIONS[_state] = {CONNECTING, REQUESTED, CONNECTED}
+
+LATENCY_SAMPLES = 1000  # Most recent latencies kept per transition for percentiles
+
+
+class TransitionStats:
+    """How long handshakes spent in one state before one particular transition"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=LATENCY_SAMPLES)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    def snapshot(self):
+        recent = sorted(self.recent)
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000,
+            "p50_ms": recent[len(recent) // 2] * 1000,
+            "p99_ms": recent[int(len(recent) * 0.99)] * 1000,
+            "max_ms": self.max * 1000
+        }
+
+
+class Handshake:
+    """Where the handshake with one peer stands"""
+    __slots__ = ("state", "entered", "deadline")
+
+    def __init__(self, state, entered, deadline):
+        self.state = state
+        self.entered = entered
+        self.deadline = deadline  # TimerHandle of the state's timeout, or None
+
+
+class HandshakeMachine:
+    """The state of every handshake, moved only along TRANSITIONS
+
+    Waiting states time out through the shared timer's heap instead of a blocked thread each:
+    when a deadline passes with the handshake still in that state, it moves to FAILED and
+    on_timeout(username, state) is called on the timer thread.
+    """
+
+    def __init__(self, timer, timeouts, on_timeout):
+        self.timer = timer
+        self.timeouts = timeouts  # state -> seconds
+        self.on_timeout = on_timeout
+        self.lock = threading.Lock()
+        self.handshakes = {}  # username -> Handshake
+        self._states = {}  # username -> state, republished on every change for lock-free reads
+        self.stats = {}  # (from, to) -> TransitionStats
+
+    @property
+    def states(self):
+        return MappingProxyType(self._states)
+
+    def state(self, username):
+        return self._states.get(username)
+
+    def transition(self, username, state, expected=None):
+        """Move a peer's handshake to state, returning whether it moved
+
+        With expected, only moves if the current state is one of those; this is how a reply
+        that arrives after a cancel or timeout finds out it is too late. Moving to the state
+        it is already in succeeds without restarting its timeout.
+        """
+        with self.lock:
+            handshake = self.handshakes.get(username)
+            current = handshake.state if handshake else None
+            if expected is not None and current not in expected:
+                return False
+            if current == state:
+                return True
+            if state not in TRANSITIONS[current]:
+                print(f"Ignoring handshake transition for {username} from {current} to {state}")
+                return False
+            self._enter(username, handshake, state)
+            return True
+
+    def _enter(self, username, handshake, state):
+        # Only call with the lock held
+        now = time.monotonic()
+        if handshake is not None and handshake.deadline is not None:
+            handshake.deadline.cancel()
+        # Only time spent handshaking counts, not time connected or idle in between
+        if handshake is not None and handshake.state in IN_PROGRESS:
+            key = (handshake.state, state)
+            if key not in self.stats:
+                self.stats[key] = TransitionStats()
+            self.stats[key].add(now - handshake.entered)
+        deadline = None
+        timeout = self.timeouts.get(state)
+        if timeout:
+            entered = now
+            deadline = self.timer.call_later(timeout, lambda: self._expire(username, state, entered))
+        self.handshakes[username] = Handshake(state, now, deadline)
+        states = dict(self._states)
+        states[username] = state
+        self._states = states
+
+    def _expire(self, username, state, entered):
+        with self.lock:
+            handshake = self.handshakes.get(username)
+            # The handshake may have moved on, or left and come back to this state since
+            if handshake is None or handshake.state != state or handshake.entered != entered:
+                return
+            self._enter(username, handshake, FAILED)
+        print(f"Handshake with {username} timed out in {state}")
+        self.on_timeout(username, state)
+
+    def latency_stats(self):
+        """Latency of every transition seen so far, keyed "from -> to" """
+        with self.lock:
+            return {f"{before} -> {after}": stats.snapshot()
+                    for (before, after), stats in self.stats.items()}
+
+    def outcomes(self):
+        """How many handshakes have ended connected or in each terminal state"""
+        with self.lock:
+            outcomes = {}
+            for (before, after), stats in self.stats.items():
+                if after == CONNECTED or after in TERMINAL:
+                    outcomes[after] = outcomes.get(after, 0) + stats.count
+            return outcomes
+
+    def clear(self):
+        with self.lock:
+            for handshake in self.handshakes.values():
+                if handshake.deadline is not None:
+                    handshake.deadline.cancel()
+            self.handshakes = {}
+            self._states = {}
@@ -0,0 +1,175 @@
+import os
+import signal
+import sys
+import threading
+from network import MessengerNetwork
+from transfer import save_received_file
+
+HELP_TEXT = """Commands:
+  /connect <ip> <port> <username>   Connect to a peer
+  /connect <username>               Connect to a peer found on the LAN or met before
+  /forget <username>                Forget a peer's pinned key, to trust a new one
+  /accept <username>                Accept a pending connection request
+  /refuse <username>                Refuse a pending connection request
+  /cancel <username>                Cancel an outgoing connection attempt
+  /msg <username> <message>         Send a message
+  /file <username> <path>           Send a file
+  /peers                            List connected peers
+  /stats                            Show queue depths, handshake latencies and handler timings
+  /metrics                          Print every metric in the Prometheus text format
+  /quit                             Shut down"""
+
+
+class HeadlessNode:
+    """Runs the messenger without a UI, logging events to stdout and taking commands from stdin"""
+
+    def __init__(self, port, username, auto_accept=False, download_dir="downloads", config=None,
+                 startup_timer=None):
+        self.network = MessengerNetwork(listen_port=port, username=username, config=config,
+                                        startup_timer=startup_timer)
+        self.auto_accept = auto_accept
+        self.download_dir = download_dir
+        self.requests = {}  # username -> (ip, port) awaiting /accept or /refuse
+        self.stopped = threading.Event()
+
+        # Callbacks run on network threads, so they only log and hand work back to the network
+        self.network.message_received.connect(self.handle_message_received)
+        self.network.file_received.connect(self.handle_file_received)
+        self.network.connection_request.connect(self.handle_connection_request)
+        self.network.connection_status.connect(self.handle_connection_status)
+        self.network.connection_progress.connect(self.handle_connection_progress)
+        self.network.connection_closed.connect(self.handle_connection_closed)
+        self.network.peer_key_changed.connect(self.handle_peer_key_changed)
+        self.network.peer_discovered.connect(self.handle_peer_discovered)
+
+    def handle_message_received(self, username, message):
+        print(f"[{username}] {message}")
+
+    def handle_file_received(self, username, filename, filepath):
+        os.makedirs(self.download_dir, exist_ok=True)
+        target = os.path.join(self.download_dir, filename)
+        try:
+            save_received_file(filepath, target)
+            print(f"Received {filename} from {username}, saved to {target}")
+        except OSError as e:
+            print(f"Error saving {filename} from {username}: {e}")
+
+    def handle_connection_request(self, username, ip, port):
+        if self.auto_accept:
+            print(f"Accepting connection from {username} ({ip}:{port})")
+            self.network.accept_connection(ip, port, username)
+        else:
+            self.requests[username] = (ip, port)
+            print(f"Connection request from {username} ({ip}:{port}), /accept or /refuse it")
+
+    def handle_connection_status(self, username, success):
+        print(f"Connected to {username}" if success else f"Connection to {username} failed")
+
+    def handle_connection_progress(self, username, stage):
+        print(f"{username}: {stage}")
+
+    def handle_connection_closed(self, username):
+        print(f"{username} disconnected")
+
+    def handle_peer_key_changed(self, username, fingerprint):
+        print(f"Warning: {username}'s key has changed, new fingerprint {fingerprint}")
+
+    def handle_peer_discovered(self, username, ip, port):
+        print(f"{username} is on the network at {ip}:{port}, /connect {username} to talk")
+
+    def run_command(self, line):
+        """Run one command line, returning False on /quit"""
+        parts = line.strip().split(" ", 2)
+        command = parts[0]
+        if not command:
+            return True
+
+        try:
+            if command == "/connect" and len(parts) == 2:
+                if self.network.connect_by_name(parts[1]) is None and parts[1] not in self.network.connected_peers:
+                    print(f"Don't know where to find {parts[1]}")
+            elif command == "/connect":
+                ip, port, username = line.split()[1:]
+                self.network.connect_async(ip, int(port), username)
+            elif command in ("/accept", "/refuse") and len(parts) == 2:
+                request = self.requests.pop(parts[1], None)
+                if request is None:
+                    print(f"No connection request from {parts[1]}")
+                elif command == "/accept":
+                    self.network.accept_connection(request[0], request[1], parts[1])
+                else:
+                    self.network.refuse_connection(request[0], request[1], parts[1])
+            elif command == "/cancel" and len(parts) == 2:
+                if not self.network.cancel_connection(parts[1]):
+                    print(f"Not connecting to {parts[1]}")
+            elif command == "/msg" and len(parts) == 3:
+                if not self.network.send_message(parts[1], parts[2]):
+                    print(f"Could not send the message to {parts[1]}")
+            elif command == "/file" and len(parts) == 3:
+                if not self.network.send_file(parts[1], parts[2]):
+                    print(f"Could not send {parts[2]} to {parts[1]}")
+            elif command == "/forget" and len(parts) == 2:
+                self.network.forget_peer(parts[1])
+                print(f"Forgot the pinned key of {parts[1]}")
+            elif command == "/peers":
+                for username, peer_info in list(self.network.connected_peers.items()):
+                    print(f"{username} {peer_info['ip']}:{peer_info['port']}")
+            elif command == "/stats":
+                for stage, stats in self.network.pipeline_stats().items():
+                    print(f"{stage}: {stats['workers']} workers, {stats['queued']} queued "
+                          f"(peak {stats['peak_queued']}), {stats['processed']} processed")
+                for transition, stats in self.network.handshake_stats().items():
+                    print(f"{transition}: {stats['count']} times, p50 {stats['p50_ms']:.1f} ms, "
+                          f"p99 {stats['p99_ms']:.1f} ms, max {stats['max_ms']:.1f} ms")
+                for message_type, stats in self.network.handler_stats().items():
+                    print(f"{message_type}: {stats['count']} handled, {stats['errors']} failed, "
+                          f"p50 {stats['p50_ms']:.2f} ms, p99 {stats['p99_ms']:.2f} ms")
+            elif command == "/metrics":
+                print(self.network.metrics.render(), end="")
+            elif command == "/quit":
+                return False
+            else:
+                print(HELP_TEXT)
+        except ValueError as e:
+            print(f"Invalid command: {e}")
+        return True
+
+    def read_commands(self, stream):
+        """Read commands until /quit or end of input"""
+        for line in stream:
+            if not self.run_command(line):
+                self.stopped.set()
+                return
+
+    def run(self, stream=None, startup_report=False):
+        """Serve until /quit, SIGINT or SIGTERM, returning False if the network didn't start"""
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: self.stopped.set())
+
+        self.network.start()
+
+        # Without a terminal or pipe on stdin this is a plain daemon
+        if stream is not None:
+            threading.Thread(target=self.read_commands, args=(stream,), daemon=True).start()
+
+        try:
+            if not self.network.wait_ready():
+                print(f"Could not start the network: {self.network.startup_error}")
+                return False
+            print(f"{self.network.username} listening on {self.network.local_ip}:{self.network.listen_port}")
+            if startup_report:
+                print(self.network.startup_timer.report())
+
+            while not self.stopped.wait(1):
+                pass
+            return True
+        finally:
+            self.network.cleanup()
+
+
+def run_headless(port, username, auto_accept=False, download_dir="downloads", read_stdin=True,
+                 startup_timer=None, startup_report=False):
+    """Entry point for main.py --headless"""
+    node = HeadlessNode(port, username, auto_accept, download_dir, startup_timer=startup_timer)
+    started = node.run(sys.stdin if read_stdin else None, startup_report)
+    return 0 if started else 1
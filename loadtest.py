@@ -0,0 +1,392 @@
+import argparse
+import contextlib
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from config import load_config
+from network import MessengerNetwork
+
+READY_TIMEOUT = 60  # Seconds for a group's nodes to generate keys and bind
+CONNECT_TIMEOUT = 30  # Seconds for every handshake of the connect phase to finish
+STALL_TIMEOUT = 10  # Seconds without any delivery before a phase is abandoned
+POLL_INTERVAL = 0.1  # Seconds between checks on how much has been delivered
+
+
+def percentile(values, q):
+    """The q-th quantile of values in milliseconds, or 0.0 if there are none"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)] * 1000
+
+
+def _process_usage():
+    """Threads and resident memory in MB of this process, as the kernel counts them"""
+    threads = threading.active_count()
+    rss = 0.0
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+                elif line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return threads, rss or peak, peak
+
+
+class NodeGroup:
+    """Headless nodes sharing one process, driven by the load test and recording what arrives
+
+    Latencies are measured between time.monotonic() stamps, which every process on a machine
+    shares, so a message sent in one group can be timed where it arrives in another.
+    """
+
+    def __init__(self, indices, transport="tcp", base_port=17000, data_dir=None):
+        self.data_dir = data_dir or tempfile.mkdtemp(prefix="shadow-loadtest-")
+        self.lock = threading.Lock()
+        self.nodes = {}  # username -> MessengerNetwork
+        self.connecting = {}  # (username, peer) -> when the connection was started
+        self.connect_latencies = []
+        self.chat_latencies = []
+        self.files_received = 0
+        self.bytes_received = 0
+        self.last_received = 0.0
+        self.sent = 0
+        for index in indices:
+            username = f"node{index}"
+            node = MessengerNetwork(base_port + index, username=username,
+                                    config=self._config(username, transport))
+            self._watch(username, node)
+            self.nodes[username] = node
+        for node in self.nodes.values():
+            node.start()
+        for username, node in self.nodes.items():
+            if not node.wait_ready(READY_TIMEOUT) or node.startup_error:
+                raise RuntimeError(f"{username} failed to start: {node.startup_error}")
+
+    def _config(self, username, transport):
+        config = load_config()
+        config["network"]["transport"] = transport
+        config["network"]["discovery"] = False
+        config["encryption"]["identity_path"] = os.path.join(self.data_dir, f"{username}-identity.pem")
+        for key, filename in (("path", "messages.db"), ("outbox_path", "outbox.db"),
+                              ("directory_path", "peers.db")):
+            config["storage"][key] = os.path.join(self.data_dir, f"{username}-{filename}")
+        return config
+
+    def _watch(self, username, node):
+        # Callbacks run on network threads, so they only record and return
+        node.connection_request.connect(
+            lambda peer, ip, port: node.accept_connection(ip, port, peer))
+        node.key_exchange_complete.connect(lambda peer: self._connected(username, peer))
+        node.message_received.connect(self._message_received)
+        node.file_received.connect(self._file_received)
+
+    def _connected(self, username, peer):
+        now = time.monotonic()
+        with self.lock:
+            started = self.connecting.pop((username, peer), None)
+            if started is not None:
+                self.connect_latencies.append(now - started)
+
+    def _message_received(self, peer, content):
+        now = time.monotonic()
+        # Load test messages look like "lt|<monotonic send time>|<padding>"
+        parts = content.split("|", 2)
+        if len(parts) < 2 or parts[0] != "lt":
+            return
+        with self.lock:
+            self.chat_latencies.append(now - float(parts[1]))
+
+    def _file_received(self, peer, filename, filepath):
+        now = time.monotonic()
+        try:
+            size = os.path.getsize(filepath)
+            os.remove(filepath)
+        except OSError:
+            size = 0
+        with self.lock:
+            self.files_received += 1
+            self.bytes_received += size
+            self.last_received = now
+
+    def ports(self):
+        """Where each node ended up listening"""
+        return {username: node.listen_port for username, node in self.nodes.items()}
+
+    def connect(self, pairs):
+        """Connect each (username, peer, peer port) pair, returning how many succeeded"""
+        attempts = []
+        for username, peer, port in pairs:
+            with self.lock:
+                self.connecting[(username, peer)] = time.monotonic()
+            attempt = self.nodes[username].connect_async("127.0.0.1", port, peer)
+            if attempt is not None:
+                attempts.append(attempt)
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        for attempt in attempts:
+            attempt.finished.wait(max(0.0, deadline - time.monotonic()))
+        return sum(1 for username, peer, _ in pairs if peer in self.nodes[username].connected_peers)
+
+    def chat(self, count, rate, size):
+        """Send count messages at rate per second, each from a random node to one of its peers"""
+        senders = [(username, list(node.connected_peers)) for username, node in self.nodes.items()]
+        senders = [(username, peers) for username, peers in senders if peers]
+        if not senders:
+            return 0
+        padding = "x" * max(0, size - 20)
+        started = time.monotonic()
+        for i in range(count):
+            # Paced against the start, so a slow send is caught up on rather than lost
+            delay = started + i / rate - time.monotonic() if rate else 0
+            if delay > 0:
+                time.sleep(delay)
+            username, peers = random.choice(senders)
+            if self.nodes[username].send_message(random.choice(peers), f"lt|{time.monotonic():.6f}|{padding}"):
+                self.sent += 1
+        return self.sent
+
+    def send_files(self, count, size):
+        """Send count files of size bytes, each from a random node to one of its peers"""
+        path = os.path.join(self.data_dir, "payload.bin")
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        sent = 0
+        for _ in range(count):
+            username, node = random.choice(list(self.nodes.items()))
+            peers = list(node.connected_peers)
+            if peers and node.send_file(random.choice(peers), path):
+                sent += 1
+        return sent
+
+    def received(self):
+        """Messages and files delivered to this group's nodes so far"""
+        with self.lock:
+            return len(self.chat_latencies), self.files_received
+
+    def report(self):
+        threads, rss, peak = _process_usage()
+        with self.lock:
+            return {
+                "connect_latencies": list(self.connect_latencies),
+                "chat_latencies": list(self.chat_latencies),
+                "files_received": self.files_received,
+                "bytes_received": self.bytes_received,
+                "last_received": self.last_received,
+                "threads": threads,
+                "rss_mb": rss,
+                "peak_rss_mb": peak
+            }
+
+    def _disconnect_all(self, node):
+        for peer in list(node.connected_peers):
+            node.disconnect_from_peer(peer)
+
+    def _each_node(self, method):
+        """Run method(node) for every node at once, as each mostly waits on other threads"""
+        threads = [threading.Thread(target=method, args=(node,)) for node in self.nodes.values()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
+        # Peers are told while every node is still answering, then shut down together
+        self._each_node(self._disconnect_all)
+        self._each_node(MessengerNetwork.cleanup)
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+class LocalGroup:
+    """A NodeGroup in the driver's own process, behind the same interface as a RemoteGroup"""
+
+    def __init__(self, *args):
+        self.group = NodeGroup(*args)
+        self.last = None
+
+    def submit(self, method, *args):
+        self.last = getattr(self.group, method)(*args)
+
+    def result(self):
+        return self.last
+
+
+def _serve_group(conn, args):
+    # A group's nodes get a process, and so a GIL, of their own
+    sys.stdout = open(os.devnull, "w")
+    try:
+        group = NodeGroup(*args)
+    except Exception as e:
+        conn.send(("error", str(e)))
+        return
+    conn.send(("ok", None))
+    while True:
+        method, method_args = conn.recv()
+        try:
+            conn.send(("ok", getattr(group, method)(*method_args)))
+        except Exception as e:
+            conn.send(("error", str(e)))
+        if method == "stop":
+            return
+
+
+class RemoteGroup:
+    """A NodeGroup in a worker process, driven over a pipe"""
+
+    def __init__(self, *args):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve_group, args=(child, args), daemon=True)
+        self.process.start()
+        self.result()
+
+    def submit(self, method, *args):
+        self.conn.send((method, args))
+
+    def result(self):
+        status, value = self.conn.recv()
+        if status == "error":
+            raise RuntimeError(value)
+        return value
+
+
+def _call_all(groups, method, *args):
+    """Run a method on every group at once and collect the results in order"""
+    for group in groups:
+        group.submit(method, *args)
+    return [group.result() for group in groups]
+
+
+def _wait_for(groups, index, expected):
+    """Poll the groups until expected deliveries of one kind arrive or they stall; returns the count"""
+    received = 0
+    progressed = time.monotonic()
+    while received < expected:
+        time.sleep(POLL_INTERVAL)
+        total = sum(counts[index] for counts in _call_all(groups, "received"))
+        if total > received:
+            received, progressed = total, time.monotonic()
+        elif time.monotonic() - progressed > STALL_TIMEOUT:
+            break
+    return received
+
+
+def run_loadtest(nodes=20, processes=0, transport="tcp", topology="mesh", messages=10000, rate=1000,
+                 size=64, files=0, file_size=1048576, base_port=17000):
+    """Connect nodes to each other, push chat and file traffic through them and report the result
+
+    With processes 0 every node runs in this process; otherwise they are split across that
+    many worker processes. Returns a dict of throughputs, latencies in milliseconds, threads
+    and resident memory summed over every process.
+    """
+    processes = max(0, min(processes, nodes))
+    shares = [list(range(i, nodes, processes)) for i in range(processes)] if processes else [list(range(nodes))]
+    if processes:
+        groups = [RemoteGroup(indices, transport, base_port, None) for indices in shares]
+    else:
+        groups = [LocalGroup(list(range(nodes)), transport, base_port, None)]
+    try:
+        ports = {}
+        for group_ports in _call_all(groups, "ports"):
+            ports.update(group_ports)
+        owner = {f"node{index}": n for n, indices in enumerate(shares) for index in indices}
+
+        # Each pair connects once; below three nodes a ring is the same as a mesh
+        if topology == "ring" and nodes > 2:
+            pairs = [(i, (i + 1) % nodes) for i in range(nodes)]
+        else:
+            pairs = [(i, j) for i in range(nodes) for j in range(i + 1, nodes)]
+        plans = [[] for _ in groups]
+        for i, j in pairs:
+            plans[owner[f"node{i}"]].append((f"node{i}", f"node{j}", ports[f"node{j}"]))
+        started = time.monotonic()
+        for group, plan in zip(groups, plans):
+            group.submit("connect", plan)
+        connected = sum(group.result() for group in groups)
+        connect_time = time.monotonic() - started
+
+        # Chat: the rate and message count are shared out between the groups
+        started = time.monotonic()
+        sent = sum(_call_all(groups, "chat", messages // len(groups), rate / len(groups), size))
+        delivered = _wait_for(groups, 0, sent)
+        chat_time = time.monotonic() - started
+
+        started = time.monotonic()
+        files_sent = sum(_call_all(groups, "send_files", files // len(groups), file_size)) if files else 0
+        files_delivered = _wait_for(groups, 1, files_sent) if files_sent else 0
+
+        reports = _call_all(groups, "report")
+    finally:
+        for group in groups:
+            try:
+                _call_all([group], "stop")
+            except Exception as e:
+                print(f"Error stopping a node group: {e}", file=sys.stderr)
+
+    connect_latencies = [latency for report in reports for latency in report["connect_latencies"]]
+    chat_latencies = [latency for report in reports for latency in report["chat_latencies"]]
+    last_file = max(report["last_received"] for report in reports)
+    file_time = last_file - started if files_delivered else 0.0
+    file_bytes = sum(report["bytes_received"] for report in reports)
+    return {
+        "connections": len(pairs),
+        "connected": connected,
+        "connect_seconds": connect_time,
+        "connect_p50_ms": percentile(connect_latencies, 0.5),
+        "connect_p99_ms": percentile(connect_latencies, 0.99),
+        "sent": sent,
+        "delivered": delivered,
+        "chat_seconds": chat_time,
+        "chat_rate": delivered / chat_time if chat_time else 0.0,
+        "chat_p50_ms": percentile(chat_latencies, 0.5),
+        "chat_p95_ms": percentile(chat_latencies, 0.95),
+        "chat_p99_ms": percentile(chat_latencies, 0.99),
+        "files_sent": files_sent,
+        "files_delivered": files_delivered,
+        "file_mb_per_s": file_bytes / file_time / 1e6 if file_time else 0.0,
+        "threads": sum(report["threads"] for report in reports),
+        "rss_mb": sum(report["rss_mb"] for report in reports),
+        "peak_rss_mb": sum(report["peak_rss_mb"] for report in reports)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test with many headless nodes on one machine')
+    parser.add_argument('--nodes', type=int, default=20, help='Number of nodes')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='Worker processes to spread the nodes over (0 runs them all in this one)')
+    # No inproc: each node has its own ZeroMQ context, and --processes puts nodes in separate processes
+    parser.add_argument('--transport', choices=['tcp', 'ipc'], default='tcp', help='Transport between nodes')
+    parser.add_argument('--topology', choices=['mesh', 'ring'], default='mesh',
+                        help='Every node connected to every other, or each to the next')
+    parser.add_argument('--messages', type=int, default=10000, help='Chat messages to send in total')
+    parser.add_argument('--rate', type=float, default=1000, help='Chat messages per second to aim for')
+    parser.add_argument('--size', type=int, default=64, help='Chat message size in characters')
+    parser.add_argument('--files', type=int, default=0, help='Files to send in total')
+    parser.add_argument('--file-size', type=int, default=1048576, help='Size of each file in bytes')
+    parser.add_argument('--base-port', type=int, default=17000, help='Port of the first node')
+    args = parser.parse_args()
+
+    # Nodes log every message they handle, which would drown the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        result = run_loadtest(args.nodes, args.processes, args.transport, args.topology, args.messages,
+                              args.rate, args.size, args.files, args.file_size, args.base_port)
+    print(f"{args.nodes} nodes in {max(1, args.processes)} process(es) over {args.transport}, "
+          f"{args.topology} of {result['connections']} connections")
+    print(f"  connect: {result['connected']}/{result['connections']} in {result['connect_seconds']:.2f} s, "
+          f"latency p50 {result['connect_p50_ms']:.1f} ms, p99 {result['connect_p99_ms']:.1f} ms")
+    print(f"  chat: {result['delivered']}/{result['sent']} delivered in {result['chat_seconds']:.2f} s, "
+          f"{result['chat_rate']:,.0f} msgs/s, latency p50 {result['chat_p50_ms']:.1f} ms, "
+          f"p95 {result['chat_p95_ms']:.1f} ms, p99 {result['chat_p99_ms']:.1f} ms")
+    if args.files:
+        print(f"  files: {result['files_delivered']}/{result['files_sent']} of {args.file_size} bytes, "
+              f"{result['file_mb_per_s']:.1f} MB/s")
+    print(f"  {result['threads']} threads, RSS {result['rss_mb']:.0f} MB (peak {result['peak_rss_mb']:.0f} MB)")
@@ -1,46 +1,59 @@
+from startup import StartupTimer
+startup_timer = StartupTimer()
+
 import sys
 import argparse
-from PyQt6.QtWidgets import QApplication, QInputDialog, QMessageBox
-from ui import ChatApp
-from encryption import RSAEncryption
-
-def get_port_from_user(app):
-    """Ask the user to select a port number"""
-    port, ok = QInputDialog.getInt(
-        None, 
-        'Port Selection', 
-        'Enter the port number to use (1024-65535):',
-        5555,  # Default value
-        1024,  # Minimum value
-        65535, # Maximum value
-        1      # Step
-    )
-    
-    if ok:
-        return port
-    else:
-        # If user cancels, use default port
-        return 5555
+from config import load_config
+
+def run_gui(args):
+    """Start the Qt client"""
+    # PyQt6 is only imported for the GUI so headless nodes never load it
+    with startup_timer.stage("qt_imports"):
+        from PyQt6.QtWidgets import QApplication
+        from ui import ChatApp
 
-if __name__ == "__main__":
     # Create QApplication first
     app = QApplication(sys.argv)
-    
+
+    # Show the window straight away; the network starts in the background
+    window = ChatApp(port=args.port, username=args.username,
+                     startup_timer=startup_timer, startup_report=args.startup_report)
+    window.show()
+    startup_timer.mark("window_shown")
+
+    return app.exec()
+
+if __name__ == "__main__":
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Secure Messenger')
-    parser.add_argument('--port', type=int, help='Port to use for the messenger')
+    parser.add_argument('--port', type=int, help='Port to use for the messenger (default from config.json)')
+    parser.add_argument('--username', default='Anonymous', help='Username to announce to peers')
+    parser.add_argument('--headless', action='store_true',
+                        help='Run without a UI, taking commands from stdin')
+    parser.add_argument('--auto-accept', action='store_true',
+                        help='Accept every connection request (headless only)')
+    parser.add_argument('--download-dir', default='downloads',
+                        help='Where received files are saved (headless only)')
+    parser.add_argument('--relay', action='store_true',
+                        help='Run as a relay forwarding messages between registered clients')
+    parser.add_argument('--startup-report', action='store_true',
+                        help='Print how long each startup stage took')
     args = parser.parse_args()
-    
-    # Initialize encryption
-    encryption = RSAEncryption()
-    encryption.generate_keys()
-    print("RSA keys generated successfully.")
-    
-    # If port is provided via command line, use it; otherwise ask the user
-    port = args.port if args.port else get_port_from_user(app)
-    
-    # Create and show the main window
-    window = ChatApp(port=port)
-    window.show()
-    
-    sys.exit(app.exec())
+
+    # Use the configured port unless one is given
+    if not args.port:
+        network_config = load_config()["network"]
+        args.port = network_config["relay_port"] if args.relay else network_config["port"]
+    startup_timer.mark("imports")
+
+    if args.relay:
+        from relay import run_relay
+        sys.exit(run_relay(args.port))
+
+    if args.headless:
+        with startup_timer.stage("network_imports"):
+            from headless import run_headless
+        sys.exit(run_headless(args.port, args.username, args.auto_accept, args.download_dir,
+                              startup_timer=startup_timer, startup_report=args.startup_report))
+
+    sys.exit(run_gui(args))
@@ -0,0 +1,228 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds, from a fast handler up to a slow disk or network wait
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Counter:
+    """A count that only goes up, safe to bump from any thread"""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Histogram:
+    """Observations counted into fixed buckets, so recording one is cheap and memory is bounded"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last one is everything above the top bound
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """The upper bound of the bucket holding the q-th observation, or 0.0 with none yet"""
+        with self.lock:
+            rank = q * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if count and seen >= rank:
+                    return self.buckets[min(index, len(self.buckets) - 1)]
+        return 0.0
+
+    def mean(self):
+        with self.lock:
+            return self.sum / self.count if self.count else 0.0
+
+    @contextmanager
+    def timer(self):
+        """Observe how many seconds the with block took"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class MetricFamily:
+    """A named metric with one Counter or Histogram per combination of label values
+
+    Look the child up once with labels() where possible; after that, recording costs what the
+    child costs.
+    """
+
+    def __init__(self, name, help_text, kind, label_names, factory):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.label_names = tuple(label_names)
+        self.factory = factory
+        self.children = {}  # label values -> Counter or Histogram
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def render(self):
+        lines = []
+        for values, child in sorted(self.children.items()):
+            if self.kind == "histogram":
+                with child.lock:
+                    counts, count, total = list(child.counts), child.count, child.sum
+                cumulative = 0
+                for bound, bucket in zip(child.buckets + (float("inf"),), counts):
+                    cumulative += bucket
+                    le = [("le", _format_value(bound))]
+                    lines.append(f"{self.name}_bucket{_format_labels(self.label_names, values, le)} {cumulative}")
+                labels = _format_labels(self.label_names, values)
+                lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {count}")
+            else:
+                lines.append(f"{self.name}{_format_labels(self.label_names, values)} {_format_value(child.value)}")
+        return lines
+
+
+class CallbackFamily:
+    """A metric read from callback() only when it is exported, so nothing is recorded on the hot path
+
+    callback returns the value, or with label names a dict of label value tuples to values.
+    """
+
+    def __init__(self, name, help_text, kind, label_names, callback):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.label_names = tuple(label_names)
+        self.callback = callback
+
+    def render(self):
+        values = self.callback()
+        if not self.label_names:
+            values = {(): values}
+        return [f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+                for labels, value in sorted(values.items())]
+
+
+class MetricsRegistry:
+    """Every metric of one node, exported together in the Prometheus text format"""
+
+    def __init__(self):
+        self.families = {}  # name -> MetricFamily or CallbackFamily
+        self.lock = threading.Lock()
+
+    def _add(self, family):
+        with self.lock:
+            existing = self.families.get(family.name)
+            if existing is not None:
+                return existing
+            self.families[family.name] = family
+            return family
+
+    def counter(self, name, help_text, label_names=()):
+        return self._add(MetricFamily(name, help_text, "counter", label_names, Counter))
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._add(MetricFamily(name, help_text, "histogram", label_names, lambda: Histogram(buckets)))
+
+    def gauge(self, name, help_text, callback, label_names=()):
+        return self._add(CallbackFamily(name, help_text, "gauge", label_names, callback))
+
+    def counter_callback(self, name, help_text, callback, label_names=()):
+        """A counter kept elsewhere, such as a count another class already tracks"""
+        return self._add(CallbackFamily(name, help_text, "counter", label_names, callback))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            families = list(self.families.values())
+        for family in families:
+            try:
+                samples = family.render()
+            except Exception as e:
+                print(f"Error collecting metric {family.name}: {e}")
+                continue
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the metrics to path, replacing it in one step as the node exporter's textfile collector expects"""
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as f:
+            f.write(self.render())
+        os.replace(temporary, path)
+
+
+class MetricsServer:
+    """Serves a registry over HTTP on /metrics for Prometheus to scrape, from a thread of its own"""
+
+    def __init__(self, registry, port, address="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes every few seconds would flood the log
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
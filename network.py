@@ -9,50 +9,466 @@ import json
 import os
 import shutil
 import socket
-from PyQt6.QtCore import QObject, pyqtSignal
+import tempfile
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from encryption import RSAEncryption
+from transfer import FileSpool, ProgressTracker, CHUNK_SIZE
+from scheduler import PeerScheduler, TokenBucket, CONTROL, CHAT, BULK
+from config import load_config
+from events import Signal
+from startup import StartupTimer
+from outbox import Outbox, RetryTimer, backoff_delay
+from directory import PeerDirectory, key_fingerprint
+from discovery import Discovery
+from pipeline import Pipeline
+from metrics import MetricsRegistry, MetricsServer
+from registry import PeerRegistry
+from reactor import RequestReactor
+from handshake import (HandshakeMachine, CONNECTING, RECONNECTING, AWAITING_ACCEPT, REQUESTED, ACCEPTING,
+                       KEY_EXCHANGE, CONNECTED, FAILED, REFUSED, CANCELLED, CLOSED, IDLE, OUTBOUND)
 
-class MessengerNetwork(QObject):
-    message_received = pyqtSignal(str)
-    message_sent = pyqtSignal(bool, str)
-    key_exchange_complete = pyqtSignal(str)
-    connection_request = pyqtSignal(str, str, int)  # username, ip, port
-    connection_status = pyqtSignal(str, bool)  # username, success
+# Connection attempts wait for startup on a shared pool so the caller never blocks
+CONNECT_WORKERS = 32
+PORT_SEARCH_RANGE = 10  # Ports tried, starting at the requested one, before giving up
+SEEN_MESSAGE_IDS = 10000  # Delivered message ids remembered for duplicate detection
+RECONNECT_WINDOW = 300  # Seconds a signed reconnect request stays valid, allowing for clock skew
+METRICS_FILE_INTERVAL = 15  # Seconds between rewrites of the metrics file
 
-    def __init__(self, listen_port=5555, message_callback=None, username="Anonymous"):
-        super().__init__()
+
+class ConnectionAttempt:
+    """An outbound connection in progress"""
+
+    def __init__(self, username, ip, port):
+        self.username = username
+        self.ip = ip
+        self.port = port
+        self.request_sent = False
+        self.finished = threading.Event()
+        self.outcome = None  # connected, refused, failed or cancelled
+
+
+class MessageHandler:
+    """The handler registered for one message type, with its error count and timings"""
+    __slots__ = ("handler", "errors", "timings")
+
+    def __init__(self, handler, errors, timings):
+        self.handler = handler
+        self.errors = errors
+        self.timings = timings
+
+    def snapshot(self):
+        return {
+            "count": self.timings.count,
+            "errors": self.errors.value,
+            "mean_ms": self.timings.mean() * 1000,
+            "p50_ms": self.timings.quantile(0.5) * 1000,
+            "p99_ms": self.timings.quantile(0.99) * 1000
+        }
+
+
+class Reply:
+    """The one answer to an inbound request, handed back to the receive stage to send"""
+
+    def __init__(self, send):
+        self._send = send
+        self.sent = False
+
+    def send_string(self, text):
+        if self.sent:
+            print("Ignoring a second reply to the same request")
+            return
+        self.sent = True
+        self._send(text.encode())
+
+    def send_json(self, data):
+        self.send_string(json.dumps(data))
+
+
+class MessengerNetwork:
+    """Peer-to-peer networking with no Qt dependency; wrap it in QtNetworkBridge for the UI"""
+
+    message_received = Signal(str, str)  # username, message
+    message_sent = Signal(bool, str)
+    key_exchange_complete = Signal(str)
+    connection_request = Signal(str, str, int)  # username, ip, port
+    connection_status = Signal(str, bool)  # username, success
+    file_received = Signal(str, str, str)  # username, filename, filepath
+    transfer_progress = Signal(dict)  # progress snapshot, at most every 100 ms per transfer
+    connection_progress = Signal(str, str)  # username, stage
+    connection_closed = Signal(str)  # username, when the peer disconnects
+    network_ready = Signal(bool, str)  # success, error once startup has finished
+    peer_key_changed = Signal(str, str)  # username, new key fingerprint
+    peer_discovered = Signal(str, str, int)  # username, ip, port, when a LAN beacon is first seen
+    peer_lost = Signal(str)  # username, when its beacons stop
+
+    def __init__(self, listen_port=5555, message_callback=None, username="Anonymous", config=None,
+                 startup_timer=None):
+        self.config = config or load_config()
+        self.timeout = self.config["network"]["timeout"]
+        self.transport = self.config["network"]["transport"]
+        # Counters and histograms for this node, exported by _start_metrics
+        self.metrics = MetricsRegistry()
+        self.metrics_server = None
         self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REP)
-        self.socket.bind(f"tcp://*:{listen_port}")
+        # ROUTER rather than REP, so replies can be sent once later stages are done with a request
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.heartbeat_interval = self.config["network"]["heartbeat_interval"]
+        self.heartbeat_timeout = self.config["network"]["heartbeat_timeout"]
+        # Connections from peers that vanished are closed rather than kept forever
+        self.socket.setsockopt(zmq.HEARTBEAT_IVL, self.heartbeat_interval)
+        self.socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, self.heartbeat_timeout)
         self.message_callback = message_callback
         self.username = username
         self.listen_port = listen_port
+        self.startup_timer = startup_timer or StartupTimer()
         
-        # Get the actual IP address
-        self.local_ip = self._get_local_ip()
-        print(f"Local IP address: {self.local_ip}")
+        # Filled in by the startup thread; until then only local state may be touched
+        self.local_ip = "127.0.0.1"
+        self.encryption = RSAEncryption(self.metrics)
+        self.ready = threading.Event()
+        self.startup_error = None
         
-        # Initialize encryption
-        self.encryption = RSAEncryption()
-        self.encryption.generate_keys()
-        print("Keys generated and loaded successfully")
+        # Connected and pending peers and their keys
+        self.peers = PeerRegistry()
+        
+        # Outbound connection attempts still in progress
+        self.connection_attempts = {}  # username -> ConnectionAttempt
+        self.connection_attempts_lock = threading.Lock()
+        self.connect_executor = ThreadPoolExecutor(max_workers=CONNECT_WORKERS,
+                                                   thread_name_prefix="connect")
+        
+        # Incoming files are spooled to disk chunk by chunk
+        self.spool = FileSpool()
         
-        # Store peer public keys
-        self.peer_public_keys = {}
+        # Per-transfer progress, aggregated before it reaches the UI
+        self.progress = ProgressTracker(self.transfer_progress.emit)
         
-        # Store pending connection requests
-        self.pending_connections = {}
+        # Messages wait in a durable outbox until the peer acknowledges them
+        self.outbox = Outbox(self.config["storage"]["outbox_path"])
+        self.outbox_lock = threading.Lock()
+        # Past either limit a message is given up on, so it no longer holds up the ones behind it
+        self.outbox_max_attempts = self.config["storage"]["outbox_max_attempts"]
+        self.outbox_ttl = self.config["storage"]["outbox_ttl"]
+        self.delivering = set()  # Peers with a message in flight or waiting for a retry
+        self.retry_handles = {}  # username -> TimerHandle of the pending retry
+        self.retry_timer = RetryTimer()
+        self.connection_status.connect(self._flush_outbox_on_connect)
         
-        # Store connected peers
-        self.connected_peers = {}
+        # Handshakes move through explicit states, timed out by the retry timer's heap
+        timeout = self.timeout / 1000
+        accept_timeout = self.config["network"]["accept_timeout"] / 1000
+        self.handshakes = HandshakeMachine(self.retry_timer, {
+            CONNECTING: timeout,
+            RECONNECTING: timeout,
+            AWAITING_ACCEPT: accept_timeout,
+            REQUESTED: accept_timeout,
+            ACCEPTING: timeout,
+            KEY_EXCHANGE: timeout
+        }, self._handshake_timed_out)
+        # Their round trips share one thread instead of blocking one each
+        self.reactor = RequestReactor(self.context, self.retry_timer)
+        self.reactor.start()
+        self.handshake_requests = {}  # username -> id of the handshake's request in flight
         
-        # Store connection state
-        self.connection_state = {}  # Tracks the state of each connection attempt
+        # Peers we have connected to before, with their pinned keys, for one round trip reconnects
+        self.directory = PeerDirectory(self.config["storage"]["directory_path"])
+        self.seen_reconnect_nonces = OrderedDict()
+        self.connection_status.connect(self._remember_peer)
         
-        # Start receiving thread
+        # Peers announcing themselves on the LAN; started once we know our port and key
+        self.discovery = None
+        
+        # When each connected peer last sent us something; replies are tracked by its scheduler
+        self.last_seen = {}  # username -> time.monotonic()
+        self.pinging = set()  # Peers with a heartbeat ping in flight
+        self.connection_status.connect(self._start_liveness)
+        
+        # Recently delivered message ids, to drop duplicates of retried messages
+        self.seen_message_ids = OrderedDict()
+        
+        # Outbound traffic is sent per peer in priority order, with bulk data rate-limited
+        self.schedulers = {}  # (ip, port) -> PeerScheduler
+        self.schedulers_lock = threading.Lock()
+        self.bulk_bucket = TokenBucket(
+            self.config["network"]["bulk_rate_limit"],
+            self.config["network"]["bulk_burst"]
+        )
+        
+        # Inbound requests are drained, decoded and dispatched on separate threads, so a slow
+        # consumer of our signals never stops the socket from being read
+        self.pipeline = Pipeline(self.context, "inbound", self.config["network"]["pipeline_queue_limit"])
+        self.pipeline.add_stage("decode", self._decode_stage, self.config["network"]["decode_workers"])
+        self.pipeline.add_stage("dispatch", self._dispatch_stage, self.config["network"]["dispatch_workers"])
+        self.reply_endpoint = "inproc://inbound-replies"
+        self.pipeline.set_output(self.reply_endpoint)
+        
+        # The dispatch stage looks requests up by type; anything unregistered goes to _handle_unknown
+        self.handler_errors = self.metrics.counter(
+            "shadow_handler_errors_total", "Requests whose handler raised", ("type",))
+        self.handler_seconds = self.metrics.histogram(
+            "shadow_handler_seconds", "Time spent handling requests", ("type",))
+        self.handlers = {}  # message type -> MessageHandler
+        self.unknown_handler = MessageHandler(self._handle_unknown, self.handler_errors.labels("other"),
+                                              self.handler_seconds.labels("other"))
+        self._register_handlers()
+        self._register_metrics()
+        
+        # start() generates keys, binds and finds our address in the background
         self.running = True
+        self.receive_thread = None
+        self.startup_thread = None
+
+    def start(self):
+        """Start the network in the background; network_ready is emitted when it is usable"""
+        if self.startup_thread is None:
+            self.startup_thread = threading.Thread(target=self._startup, daemon=True)
+            self.startup_thread.start()
+
+    def _generate_keys(self):
+        with self.startup_timer.stage("keygen"):
+            self.encryption.load_or_generate_keys(self.config["encryption"]["identity_path"])
+        print("Keys generated and loaded successfully")
+
+    def _discover_address(self):
+        with self.startup_timer.stage("address"):
+            self.local_ip = self._get_local_ip()
+        print(f"Local IP address: {self.local_ip}")
+
+    def _bind(self):
+        """Bind the listening socket, moving up from the requested port if it is taken"""
+        with self.startup_timer.stage("bind"):
+            first_port = self.listen_port
+            for port in range(first_port, first_port + PORT_SEARCH_RANGE):
+                try:
+                    self.socket.bind(self._endpoint("*", port))
+                except zmq.error.ZMQError as e:
+                    if e.errno != zmq.EADDRINUSE:
+                        raise
+                    print(f"Port {port} is in use")
+                    continue
+                self.listen_port = port
+                return
+            raise RuntimeError(f"No free port between {first_port} and {first_port + PORT_SEARCH_RANGE - 1}")
+
+    def _endpoint(self, peer_ip, peer_port):
+        """The ZeroMQ address of a node's listening socket under the configured transport"""
+        if self.transport == "ipc":
+            # Nodes on one machine only, told apart by port; the address is ignored
+            return f"ipc://{os.path.join(tempfile.gettempdir(), f'shadow-messenger-{peer_port}')}"
+        return f"tcp://{peer_ip}:{peer_port}"
+
+    def _startup(self):
+        """Startup thread: key generation and address discovery run alongside the bind"""
+        try:
+            with ThreadPoolExecutor(max_workers=2, thread_name_prefix="startup") as executor:
+                keygen = executor.submit(self._generate_keys)
+                address = executor.submit(self._discover_address)
+                self._bind()
+                keygen.result()
+                address.result()
+        except Exception as e:
+            print(f"Network startup failed: {str(e)}")
+            self.startup_error = str(e)
+            self.ready.set()
+            self.network_ready.emit(False, self.startup_error)
+            return
+        
+        if not self.running:
+            return
+        
+        # Incoming traffic can only be decrypted once our keys exist
+        self.pipeline.start()
         self.receive_thread = threading.Thread(target=self.receive_loop, daemon=True)
         self.receive_thread.start()
+        self._start_discovery()
+        self._start_metrics()
+        self.retry_timer.call_later(self.heartbeat_interval / 1000, self._heartbeat)
+        
+        self.startup_timer.mark("network_ready")
+        self.ready.set()
+        self.network_ready.emit(True, "")
+
+    def _start_discovery(self):
+        """Announce ourselves on the LAN; without it peers can still be reached by address"""
+        network_config = self.config["network"]
+        if not network_config["discovery"]:
+            return
+        try:
+            self.discovery = Discovery(
+                self.username,
+                self.listen_port,
+                key_fingerprint(self.get_public_key_pem()),
+                network_config["discovery_port"],
+                network_config["discovery_address"],
+                network_config["discovery_interval"] / 1000,
+                self.peer_discovered.emit,
+                self.peer_lost.emit,
+                self._beacon_matches_pin
+            )
+            self.discovery.start()
+        except OSError as e:
+            print(f"LAN discovery unavailable: {e}")
+            self.discovery = None
+
+    def _register_metrics(self):
+        """Traffic counters, and gauges read from live state only when metrics are exported"""
+        self.messages_received = self.metrics.counter(
+            "shadow_messages_received_total", "Requests received", ("peer", "type"))
+        self.bytes_received = self.metrics.counter(
+            "shadow_received_bytes_total", "Bytes of requests received", ("peer", "type"))
+        self.messages_sent = self.metrics.counter(
+            "shadow_messages_sent_total", "Requests sent", ("peer", "type"))
+        self.bytes_sent = self.metrics.counter(
+            "shadow_sent_bytes_total", "Bytes of requests sent", ("peer", "type"))
+        self.metrics.counter_callback("shadow_handshakes_total", "Handshakes by how they ended", lambda: {
+            (outcome,): count for outcome, count in self.handshakes.outcomes().items()
+        }, ("outcome",))
+        self.metrics.gauge("shadow_peers", "Peers by connection state", lambda: {
+            ("connected",): len(self.connected_peers),
+            ("pending",): len(self.pending_connections)
+        }, ("state",))
+        self.metrics.gauge("shadow_pipeline_queued", "Inbound requests waiting at each pipeline stage", lambda: {
+            (stage,): stats["queued"] for stage, stats in self.pipeline_stats().items()
+        }, ("stage",))
+        self.metrics.gauge("shadow_scheduler_queued", "Outbound requests waiting in peer schedulers",
+                           lambda: sum(len(scheduler.queue) for scheduler in list(self.schedulers.values())))
+        self.metrics.gauge("shadow_outbox_pending", "Messages waiting in the outbox", self.outbox.pending)
+        self.metrics.gauge("shadow_sockets", "Open network sockets by use", lambda: {
+            ("listener",): 1,
+            ("peer",): sum(1 for scheduler in list(self.schedulers.values()) if scheduler.socket is not None),
+            ("handshake",): self.reactor.pending()
+        }, ("kind",))
+        self.metrics.gauge("shadow_threads", "Threads in this process", threading.active_count)
+
+    def _count_traffic(self, messages, size_counter, peer_username, message_type, size):
+        # Strangers and unknown types share one series so a peer can't make us grow new ones
+        if peer_username not in self.connected_peers and peer_username not in self.pending_connections:
+            peer_username = "other"
+        if message_type not in self.handlers:
+            message_type = "other"
+        messages.labels(peer_username, message_type).inc()
+        size_counter.labels(peer_username, message_type).inc(size)
+
+    def _count_sent(self, peer_username, message_type, payload):
+        # Payloads are JSON, which json.dumps keeps to ASCII, so characters are bytes
+        self._count_traffic(self.messages_sent, self.bytes_sent, peer_username, message_type, len(payload))
+
+    def _start_metrics(self):
+        """Serve metrics over HTTP and keep them in a file, each only if configured"""
+        network_config = self.config["network"]
+        if network_config["metrics_port"]:
+            try:
+                self.metrics_server = MetricsServer(self.metrics, network_config["metrics_port"])
+                self.metrics_server.start()
+                print(f"Metrics at http://127.0.0.1:{self.metrics_server.port}/metrics")
+            except OSError as e:
+                print(f"Metrics endpoint unavailable: {e}")
+                self.metrics_server = None
+        if network_config["metrics_file"]:
+            self._write_metrics()
+
+    def _write_metrics(self):
+        if not self.running:
+            return
+        try:
+            self.metrics.write(self.config["network"]["metrics_file"])
+        except OSError as e:
+            print(f"Error writing metrics: {e}")
+        self.retry_timer.call_later(METRICS_FILE_INTERVAL, self._write_metrics)
+
+    def _beacon_matches_pin(self, peer_username, fingerprint):
+        """Beacons are unauthenticated, so one naming a pinned peer must carry its pinned fingerprint"""
+        record = self.directory.get(peer_username)
+        if record is None or record.fingerprint == fingerprint:
+            return True
+        print(f"Ignoring beacon for {peer_username}: fingerprint {fingerprint} is not the pinned one")
+        return False
+
+    def resolve(self, peer_username):
+        """Where a peer can be reached: its current LAN beacon, else its last known address"""
+        record = self.directory.get(peer_username)
+        if self.discovery is not None:
+            entry = self.discovery.peers.get(peer_username)
+            # The pin may be newer than the beacon, so it is checked again here
+            if entry is not None and (record is None or record.fingerprint == entry.fingerprint):
+                return entry.ip, entry.port
+        if record is not None:
+            return record.ip, record.port
+        return None
+
+    def _start_liveness(self, peer_username, success):
+        if success:
+            self.last_seen[peer_username] = time.monotonic()
+
+    def _last_contact(self, peer_username, peer_info):
+        """When we last heard from a peer, through its requests or its replies to ours"""
+        contact = self.last_seen.get(peer_username, 0.0)
+        with self.schedulers_lock:
+            scheduler = self.schedulers.get((peer_info["ip"], peer_info["port"]))
+        if scheduler is not None:
+            contact = max(contact, scheduler.last_reply)
+        return contact
+
+    def _heartbeat(self):
+        """Ping peers that have gone quiet and drop the ones that stopped answering"""
+        if not self.running:
+            return
+        now = time.monotonic()
+        interval = self.heartbeat_interval / 1000
+        for peer_username, peer_info in list(self.connected_peers.items()):
+            idle = now - self._last_contact(peer_username, peer_info)
+            if idle >= self.heartbeat_timeout / 1000:
+                self._drop_peer(peer_username, peer_info)
+            elif idle >= interval and peer_username not in self.pinging:
+                # Busy peers are never pinged; any traffic proves they are alive
+                self._ping(peer_username, peer_info)
+        self.retry_timer.call_later(interval, self._heartbeat)
+
+    def _ping(self, peer_username, peer_info):
+        self.pinging.add(peer_username)
+        ping = json.dumps({"type": "ping", "username": self.username})
+        self._count_sent(peer_username, "ping", ping)
+        future = self._scheduler_for(peer_info["ip"], peer_info["port"]).submit(CONTROL, lambda s: s.request(ping))
+        # A reply updates the scheduler's last_reply; a timeout just leaves the peer idle
+        future.add_done_callback(lambda f: self.pinging.discard(peer_username))
+
+    def _drop_peer(self, peer_username, peer_info):
+        """Forget a peer that stopped answering, as if it had disconnected"""
+        print(f"{peer_username} stopped responding, dropping the connection")
+        if self.peers.disconnect(peer_username, expected=peer_info) is None:
+            return
+        self.last_seen.pop(peer_username, None)
+        self.handshakes.transition(peer_username, FAILED, expected=(CONNECTED,))
+        # Its scheduler may be stuck waiting on the dead peer, so don't wait for it
+        self._stop_scheduler(peer_info["ip"], peer_info["port"], wait=False)
+        self.connection_closed.emit(peer_username)
+
+    # Read-only snapshots; every change goes through self.peers
+    @property
+    def connected_peers(self):
+        return self.peers.connected
+
+    @property
+    def pending_connections(self):
+        return self.peers.pending
+
+    @property
+    def peer_public_keys(self):
+        return self.peers.keys
+
+    @property
+    def connection_state(self):
+        return self.handshakes.states
+
+    def pipeline_stats(self):
+        """Worker count, queue depth and processed count of each inbound stage"""
+        return self.pipeline.stats()
+
+    def wait_ready(self, timeout=None):
+        """Block until startup finished, returning whether the network is usable"""
+        return self.ready.wait(timeout) and self.startup_error is None
 
     def _get_local_ip(self):
         """Get the local IP address of this machine"""
@@ -71,34 +487,69 @@ class MessengerNetwork(QObject):
     def cleanup(self):
         """Clean up network resources"""
         try:
+            # Abandon connection attempts still waiting on a peer
+            for peer_username in list(self.connection_attempts):
+                self.cancel_connection(peer_username)
+            self.connect_executor.shutdown(wait=False, cancel_futures=True)
+            
             # Stop the receive thread gracefully
             self.running = False
+            if self.startup_thread:
+                self.startup_thread.join(timeout=5)
             if hasattr(self, 'receive_thread') and self.receive_thread and self.receive_thread.is_alive():
                 try:
                     self.receive_thread.join(timeout=2)
                 except Exception as e:
                     print(f"Error stopping receive thread: {str(e)}")
+            self.pipeline.stop()
+
+            # Let LAN peers drop us now rather than when our beacons expire
+            if self.discovery is not None:
+                self.discovery.stop()
+            if self.metrics_server is not None:
+                self.metrics_server.stop()
 
             # Close all connections first
-            for peer_username in list(self.connected_peers.keys()):
+            for peer_username in self.connected_peers:
                 try:
-                    peer_info = self.connected_peers[peer_username]
-                    self.disconnect_from_peer(peer_info["ip"], peer_info["port"])
+                    self.disconnect_from_peer(peer_username)
                 except Exception as e:
                     print(f"Error disconnecting from {peer_username}: {str(e)}")
 
+            # Undelivered messages stay in the outbox for the next run
+            self.reactor.stop()
+            self.retry_timer.stop()
+            
+            # Stop the outbound schedulers so their sockets are closed
+            with self.schedulers_lock:
+                schedulers = list(self.schedulers.values())
+                self.schedulers.clear()
+            for scheduler in schedulers:
+                scheduler.stop()
+
             # Close the socket gracefully
             if hasattr(self, 'socket') and self.socket:
                 try:
                     self.socket.close(linger=0)
                 except Exception as e:
                     print(f"Error closing socket: {str(e)}")
+            if self.transport == "ipc":
+                # Unlike a port, an ipc address is a file that outlives the socket
+                try:
+                    os.remove(self._endpoint("*", self.listen_port)[len("ipc://"):])
+                except OSError:
+                    pass
 
             # Clear all peer information
-            self.connected_peers.clear()
-            self.pending_connections.clear()
-            self.peer_public_keys.clear()
-            self.connection_state.clear()
+            self.peers.clear()
+            self.handshakes.clear()
+
+            self.outbox.close()
+            self.directory.close()
+            
+            # Drop any spooled files that were never saved
+            self.progress.stop()
+            self.spool.cleanup()
 
             # Close the context last
             if hasattr(self, 'context') and self.context:
@@ -118,24 +569,35 @@ class MessengerNetwork(QObject):
             except Exception as e:
                 print(f"Error cleaning up keys directory: {str(e)}")
 
+    def _scheduler_for(self, peer_ip, peer_port):
+        """Get the outbound scheduler for a peer, creating it on first use"""
+        with self.schedulers_lock:
+            scheduler = self.schedulers.get((peer_ip, peer_port))
+            if scheduler is None:
+                scheduler = PeerScheduler(self.context, self._endpoint(peer_ip, peer_port),
+                                          self.bulk_bucket, self.timeout, self.heartbeat_interval)
+                self.schedulers[(peer_ip, peer_port)] = scheduler
+            return scheduler
+
+    def _stop_scheduler(self, peer_ip, peer_port, wait=True):
+        """Stop and forget the outbound scheduler for a peer"""
+        with self.schedulers_lock:
+            scheduler = self.schedulers.pop((peer_ip, peer_port), None)
+        if scheduler:
+            scheduler.stop(wait)
+
     def get_public_key_pem(self):
         """Get the public key in PEM format"""
         return self.encryption.get_public_key_pem()
 
     def encrypt_message(self, message, recipient_username=None):
-        """Encrypt a message using the appropriate public key"""
-        try:
-            if recipient_username and recipient_username in self.peer_public_keys:
-                # Use recipient's public key if available
-                print(f"Using public key for {recipient_username}")
-                return self.encryption.encrypt_message(message, self.peer_public_keys[recipient_username])
-            else:
-                # If no recipient key available, return unencrypted message
-                print(f"Warning: No public key available for {recipient_username}, sending unencrypted message")
-                return message
-        except Exception as e:
-            print(f"Encryption error: {e}")
-            return message
+        """Encrypt a message using the appropriate public key, raising if it can't be"""
+        public_key = self.peer_public_keys.get(recipient_username) if recipient_username else None
+        if public_key is None:
+            # Never fall back to sending the message in the clear
+            raise ValueError(f"no public key for {recipient_username}")
+        print(f"Using public key for {recipient_username}")
+        return self.encryption.encrypt_message(message, public_key)
 
     def decrypt_message(self, encrypted_message):
         """Decrypt a message using our private key"""
@@ -149,464 +611,908 @@ class MessengerNetwork(QObject):
             # If decryption fails, return the original message
             return encrypted_message
 
-    def initiate_connection(self, peer_ip, peer_port, peer_username):
-        """Initiate a connection request to a peer"""
+    def connect_async(self, peer_ip, peer_port, peer_username):
+        """Start connecting to a peer in the background, reporting through connection_progress"""
         # Check if already connected
         if peer_username in self.connected_peers:
             print(f"Already connected to {peer_username}")
             self.connection_status.emit(peer_username, True)
+            return None
+        
+        with self.connection_attempts_lock:
+            attempt = self.connection_attempts.get(peer_username)
+            if attempt is not None:
+                print(f"Already connecting to {peer_username}")
+                return attempt
+            # A peer already part way through connecting to us finishes that handshake instead
+            if not self.handshakes.transition(peer_username, CONNECTING, expected=IDLE + (REQUESTED,)):
+                print(f"Already exchanging keys with {peer_username}")
+                return None
+            attempt = ConnectionAttempt(peer_username, peer_ip, peer_port)
+            self.connection_attempts[peer_username] = attempt
+            # Store the connection info so the key exchange can complete it
+            self.peers.add_pending(peer_username, peer_ip, peer_port)
+        
+        self.connection_progress.emit(peer_username, "connecting")
+        if self.ready.is_set():
+            self._start_connection_attempt(attempt)
+        else:
+            self.connect_executor.submit(self._start_connection_attempt, attempt)
+        return attempt
+
+    def initiate_connection(self, peer_ip, peer_port, peer_username):
+        """Connect to a peer and wait for the outcome"""
+        attempt = self.connect_async(peer_ip, peer_port, peer_username)
+        if attempt is None:
             return True
-            
-        try:
-            # Set connection state
-            self.connection_state[peer_username] = "connecting"
-            
-            # Create a temporary socket for connection request
-            conn_socket = self.context.socket(zmq.REQ)
-            conn_socket.setsockopt(zmq.RCVTIMEO, 5000)  # 5 second timeout
-            conn_socket.connect(f"tcp://{peer_ip}:{peer_port}")
-            
-            # Send connection request
-            conn_request = {
-                "type": "connection_request",
-                "username": self.username,
-                "port": self.listen_port,
-                "ip": self.local_ip
-            }
-            conn_socket.send_json(conn_request)
-            
-            # Wait for response
-            response = conn_socket.recv_json()
-            conn_socket.close()
-            
-            if response["type"] == "connection_accepted":
-                # Connection accepted, proceed with key exchange
-                print(f"Connection accepted by {peer_username}")
-                self.connection_state[peer_username] = "key_exchange"
-                self.initiate_key_exchange(peer_ip, peer_port, peer_username)
-                return True
-            else:
-                # Connection refused
-                print(f"Connection refused by {peer_username}")
-                self.connection_state[peer_username] = "failed"
-                self.connection_status.emit(peer_username, False)
-                return False
-                
-        except zmq.error.Again:
-            # Timeout error
-            print(f"Connection request to {peer_username} timed out")
-            self.connection_state[peer_username] = "failed"
-            self.connection_status.emit(peer_username, False)
+        attempt.finished.wait()
+        return attempt.outcome == "connected"
+
+    def connect_by_name(self, peer_username):
+        """Connect to a discovered or previously known peer, or None if we can't find it"""
+        address = self.resolve(peer_username)
+        if address is None:
+            return None
+        return self.connect_async(address[0], address[1], peer_username)
+
+    def cancel_connection(self, peer_username):
+        """Cancel a connection attempt that is still in progress"""
+        if not self.is_connecting(peer_username):
             return False
-        except Exception as e:
-            print(f"Connection request failed: {str(e)}")
-            self.connection_state[peer_username] = "failed"
-            self.connection_status.emit(peer_username, False)
+        return self._end_handshake(peer_username, CANCELLED, OUTBOUND)
+
+    def is_connecting(self, peer_username):
+        return peer_username in self.connection_attempts
+
+    def handshake_stats(self):
+        """Latency of each handshake state transition, keyed "from -> to" """
+        return self.handshakes.latency_stats()
+
+    def _start_connection_attempt(self, attempt):
+        """Send the first request of a handshake, once the network has started"""
+        # Nothing can be sent before our keys and address exist
+        if not self.wait_ready():
+            print(f"Connection request failed: network unavailable: {self.startup_error}")
+            self._end_handshake(attempt.username, FAILED, OUTBOUND)
+            return
+        
+        # A peer that has our pinned key can prove who it is without a new exchange
+        known = self.directory.get(attempt.username)
+        if known is not None:
+            self._send_reconnect(attempt, known)
+        else:
+            self._send_connection_request(attempt)
+
+    def _handshake_request(self, peer_username, peer_ip, peer_port, message, on_reply):
+        """Send one step of a handshake; the timeout of the state it is in abandons it"""
+        payload = json.dumps(message)
+        self._count_sent(peer_username, message["type"], payload)
+        self.handshake_requests[peer_username] = self.reactor.request(
+            self._endpoint(peer_ip, peer_port), payload, on_reply)
+
+    def _end_handshake(self, peer_username, state, expected):
+        """Move a handshake to a terminal state and clean up, returning whether it moved"""
+        if not self.handshakes.transition(peer_username, state, expected=expected):
             return False
+        self._handshake_ended(peer_username, state)
+        return True
 
-    def _key_exchange_thread(self, peer_ip, peer_port, peer_username):
-        """Thread function for key exchange"""
-        # Check if already connected
-        if peer_username in self.connected_peers:
-            print(f"Already connected to {peer_username}, skipping key exchange")
+    def _handshake_ended(self, peer_username, state):
+        """Clean up after a handshake that failed, was refused or was cancelled"""
+        request = self.handshake_requests.pop(peer_username, None)
+        if request is not None:
+            self.reactor.cancel(request)
+        if peer_username not in self.connected_peers:
+            self.peers.discard_pending(peer_username)
+        with self.connection_attempts_lock:
+            attempt = self.connection_attempts.pop(peer_username, None)
+        if attempt is not None:
+            attempt.outcome = state
+            attempt.finished.set()
+        
+        if state == CANCELLED:
+            print(f"Connection to {peer_username} cancelled")
+            if attempt is not None and attempt.request_sent:
+                self._notify_cancelled(attempt.ip, attempt.port)
+            self.connection_progress.emit(peer_username, "cancelled")
+        else:
+            self.connection_progress.emit(peer_username, state)
+            self.connection_status.emit(peer_username, False)
+
+    def _handshake_succeeded(self, peer_username):
+        """Report a connection the handshake has just completed"""
+        request = self.handshake_requests.pop(peer_username, None)
+        if request is not None:
+            self.reactor.cancel(request)
+        with self.connection_attempts_lock:
+            attempt = self.connection_attempts.pop(peer_username, None)
+        if attempt is not None:
+            attempt.outcome = "connected"
+            attempt.finished.set()
+        self.key_exchange_complete.emit(peer_username)
+        self.connection_status.emit(peer_username, True)
+        self.connection_progress.emit(peer_username, "connected")
+
+    def _handshake_timed_out(self, peer_username, state):
+        """Called by the handshake machine once a state's deadline has passed"""
+        if state == REQUESTED:
+            # Nobody answered the request and the peer has given up waiting by now
+            self.peers.discard_pending(peer_username)
+            return
+        self._handshake_ended(peer_username, FAILED)
+
+    def _send_connection_request(self, attempt):
+        peer_username = attempt.username
+        # Falling back from a reconnect starts the request's own timeout
+        if not self.handshakes.transition(peer_username, CONNECTING, expected=(CONNECTING, RECONNECTING)):
+            return
+        attempt.request_sent = True
+        self._handshake_request(peer_username, attempt.ip, attempt.port, {
+            "type": "connection_request",
+            "username": self.username,
+            "port": self.listen_port,
+            "ip": self.local_ip
+        }, lambda reply: self._handle_connection_reply(attempt, reply))
+
+    def _handle_connection_reply(self, attempt, reply):
+        peer_username = attempt.username
+        response = json.loads(reply)
+        if response["type"] == "connection_accepted":
+            # The peer already knows us, proceed with key exchange
+            if self.handshakes.transition(peer_username, KEY_EXCHANGE, expected=(CONNECTING,)):
+                print(f"Connection accepted by {peer_username}")
+                self.connection_progress.emit(peer_username, "key_exchange")
+                self._send_key_exchange(peer_username, attempt.ip, attempt.port)
+        elif response["type"] == "connection_pending":
+            # The peer's user has to accept; their key exchange finishes the attempt
+            if self.handshakes.transition(peer_username, AWAITING_ACCEPT, expected=(CONNECTING,)):
+                print(f"Waiting for {peer_username} to accept")
+                self.connection_progress.emit(peer_username, "awaiting_accept")
+        else:
+            # Connection refused
+            print(f"Connection refused by {peer_username}")
+            self._end_handshake(peer_username, REFUSED, (CONNECTING,))
+
+    def _reconnect_payload(self, kind, sender, recipient, nonce, timestamp, ip="", port=""):
+        """The bytes signed for a reconnect request or its acceptance
+
+        A request also signs the address the sender asks to be reached at, so nobody who sees
+        it can point the peer somewhere else.
+        """
+        return f"{kind}|{sender}|{recipient}|{nonce}|{timestamp}|{ip}|{port}".encode()
+
+    def _send_reconnect(self, attempt, known):
+        """Ask a pinned peer to reconnect with one signed round trip"""
+        peer_username = attempt.username
+        if not self.handshakes.transition(peer_username, RECONNECTING, expected=(CONNECTING,)):
+            return
+        self.connection_progress.emit(peer_username, "reconnecting")
+        nonce = uuid.uuid4().hex
+        timestamp = time.time()
+        attempt.request_sent = True
+        self._handshake_request(peer_username, attempt.ip, attempt.port, {
+            "type": "reconnect",
+            "username": self.username,
+            "port": self.listen_port,
+            "ip": self.local_ip,
+            "nonce": nonce,
+            "timestamp": timestamp,
+            "signature": self.encryption.sign(self._reconnect_payload(
+                "reconnect", self.username, peer_username, nonce, timestamp, self.local_ip, self.listen_port))
+        }, lambda reply: self._handle_reconnect_reply(attempt, known, nonce, timestamp, reply))
+
+    def _handle_reconnect_reply(self, attempt, known, nonce, timestamp, reply):
+        """Finish a reconnect, or fall back to the full handshake if the peer doesn't know us"""
+        peer_username = attempt.username
+        if self.handshakes.state(peer_username) != RECONNECTING:
+            return
+        response = json.loads(reply)
+        if response.get("type") != "reconnect_accepted":
+            print(f"{peer_username} did not recognise us, falling back to a full key exchange")
+            self._send_connection_request(attempt)
+            return
+        
+        # The peer must prove it still holds the key we pinned
+        payload = self._reconnect_payload("reconnect_accepted", peer_username, self.username, nonce, timestamp)
+        if not self.encryption.verify(known.public_key, payload, response.get("signature", "")):
+            print(f"{peer_username} could not prove its pinned key, falling back to a full key exchange")
+            # The peer already counts us as connected; undo that before asking again
+            self._handshake_request(peer_username, attempt.ip, attempt.port,
+                                    {"type": "disconnect", "username": self.username},
+                                    lambda reply: self._send_connection_request(attempt))
+            return
+        
+        if not self.handshakes.transition(peer_username, CONNECTED, expected=(RECONNECTING,)):
+            return
+        print(f"Reconnected to {peer_username}")
+        self.peers.connect(peer_username, attempt.ip, attempt.port, known.public_key)
+        self._handshake_succeeded(peer_username)
+
+    def _handle_reconnect(self, message_data, decrypted, reply):
+        """Answer a reconnect from a pinned peer without asking the user"""
+        peer_username = message_data["username"]
+        print(f"Reconnect from {peer_username}")
+        nonce = message_data.get("nonce", "")
+        timestamp = message_data.get("timestamp", 0)
+        peer_ip = message_data.get("ip", "")
+        peer_port = message_data.get("port")
+        known = self.directory.get(peer_username)
+        if known is None:
+            print(f"Reconnect from unknown peer {peer_username}")
+            reply.send_json({"type": "reconnect_unknown", "username": self.username})
+            return
+        
+        # Malformed, stale or replayed requests are refused, as is anything not signed with the pinned key
+        if (not isinstance(nonce, str) or not nonce or not isinstance(peer_ip, str) or
+            not isinstance(peer_port, int) or isinstance(peer_port, bool) or
+            not isinstance(timestamp, (int, float)) or isinstance(timestamp, bool)):
+            print(f"Rejected malformed reconnect from {peer_username}")
+            reply.send_json({"type": "reconnect_rejected", "username": self.username})
+            return
+        payload = self._reconnect_payload("reconnect", peer_username, self.username, nonce, timestamp,
+                                          peer_ip, peer_port)
+        if (abs(time.time() - timestamp) > RECONNECT_WINDOW or
+            nonce in self.seen_reconnect_nonces or
+            not self.encryption.verify(known.public_key, payload, message_data.get("signature", ""))):
+            print(f"Rejected reconnect from {peer_username}")
+            reply.send_json({"type": "reconnect_rejected", "username": self.username})
+            return
+        self.seen_reconnect_nonces[nonce] = True
+        if len(self.seen_reconnect_nonces) > SEEN_MESSAGE_IDS:
+            self.seen_reconnect_nonces.popitem(last=False)
+        
+        # A full handshake the user has already accepted is left to finish
+        expected = IDLE + (CONNECTING, RECONNECTING, AWAITING_ACCEPT, REQUESTED, CONNECTED)
+        if not self.handshakes.transition(peer_username, CONNECTED, expected=expected):
+            print(f"Rejected reconnect from {peer_username} during a handshake")
+            reply.send_json({"type": "reconnect_rejected", "username": self.username})
+            return
+        reply.send_json({
+            "type": "reconnect_accepted",
+            "username": self.username,
+            "signature": self.encryption.sign(
+                self._reconnect_payload("reconnect_accepted", self.username, peer_username, nonce, timestamp))
+        })
+        
+        # A peer we still count as connected has restarted, perhaps somewhere else
+        current = self.connected_peers.get(peer_username)
+        if current is not None:
+            if (current["ip"], current["port"]) == (peer_ip, peer_port):
+                print(f"{peer_username} reconnected at the same address")
+                return
+            print(f"{peer_username} moved from {current['ip']}:{current['port']} to {peer_ip}:{peer_port}")
+            self.peers.disconnect(peer_username, expected=current)
+            self._stop_scheduler(current["ip"], current["port"], wait=False)
+        
+        print(f"{peer_username} reconnected")
+        self.peers.connect(peer_username, peer_ip, peer_port, known.public_key)
+        self._handshake_succeeded(peer_username)
+
+    def _remember_peer(self, peer_username, success):
+        """Pin the key and address of every peer we connect to"""
+        peer_info = self.connected_peers.get(peer_username)
+        public_key = self.peer_public_keys.get(peer_username)
+        if not success or peer_info is None or public_key is None:
             return
-            
         try:
-            # Create a temporary socket for key exchange
-            exchange_socket = self.context.socket(zmq.REQ)
-            exchange_socket.setsockopt(zmq.RCVTIMEO, 5000)  # 5 second timeout
-            exchange_socket.connect(f"tcp://{peer_ip}:{peer_port}")
-            
-            # Send our public key
-            key_exchange_msg = {
-                "type": "key_exchange",
-                "username": self.username,
-                "public_key": self.get_public_key_pem()
-            }
-            exchange_socket.send_json(key_exchange_msg)
-            
-            # Receive peer's public key
-            response = exchange_socket.recv_json()
-            if response["type"] == "key_exchange":
-                # Store the peer's public key
-                self.peer_public_keys[peer_username] = response["public_key"]
-                print(f"Key exchange completed with {peer_username}")
-                
-                # Move from pending to connected
-                if peer_username in self.pending_connections:
-                    self.connected_peers[peer_username] = self.pending_connections[peer_username]
-                    del self.pending_connections[peer_username]
-                
-                self.connection_state[peer_username] = "connected"
-                self.key_exchange_complete.emit(peer_username)
-                self.connection_status.emit(peer_username, True)
-            else:
-                print("Invalid key exchange response")
-                self.connection_state[peer_username] = "failed"
-                self.connection_status.emit(peer_username, False)
-            
-            exchange_socket.close()
-        except zmq.error.Again:
-            # Timeout error
-            print(f"Key exchange with {peer_username} timed out")
-            self.connection_state[peer_username] = "failed"
-            self.connection_status.emit(peer_username, False)
+            previous = self.directory.remember(peer_username, peer_info["ip"], peer_info["port"], public_key)
         except Exception as e:
-            print(f"Key exchange failed: {str(e)}")
-            self.connection_state[peer_username] = "failed"
-            self.connection_status.emit(peer_username, False)
+            print(f"Error remembering {peer_username}: {e}")
+            return
+        if previous is not None:
+            # Only reachable if the key changed after the handshake checked it; the pin is kept
+            self._key_changed(peer_username, public_key)
+
+    def _matches_pin(self, peer_username, public_key):
+        """Whether a key offered in a handshake is the one pinned for the peer, if any"""
+        known = self.directory.get(peer_username)
+        if known is None or known.fingerprint == key_fingerprint(public_key):
+            return True
+        self._key_changed(peer_username, public_key)
+        return False
+
+    def _key_changed(self, peer_username, public_key):
+        fingerprint = key_fingerprint(public_key)
+        print(f"Warning: {peer_username} offered key {fingerprint}, not the pinned "
+              f"{self.directory.get(peer_username).fingerprint}; /forget the peer to trust it")
+        self.peer_key_changed.emit(peer_username, fingerprint)
+
+    def forget_peer(self, peer_username):
+        """Drop a peer's pinned key, so the next full handshake pins whatever key it offers"""
+        self.directory.forget(peer_username)
+
+    def _notify_cancelled(self, peer_ip, peer_port):
+        """Tell a peer to drop our connection request, without waiting for the reply"""
+        cancel_message = json.dumps({
+            "type": "connection_cancelled",
+            "username": self.username
+        })
+        self._count_sent(None, "connection_cancelled", cancel_message)
+        self.reactor.request(self._endpoint(peer_ip, peer_port), cancel_message, lambda reply: None,
+                             timeout=self.timeout / 1000)
+
+    def _send_key_exchange(self, peer_username, peer_ip, peer_port):
+        """Send our public key; the peer's key in the reply completes the connection"""
+        self._handshake_request(peer_username, peer_ip, peer_port, {
+            "type": "key_exchange",
+            "username": self.username,
+            "public_key": self.get_public_key_pem()
+        }, lambda reply: self._handle_key_exchange_reply(peer_username, reply))
+
+    def _handle_key_exchange_reply(self, peer_username, reply):
+        response = json.loads(reply)
+        if response["type"] == "key_exchange":
+            if self.handshakes.state(peer_username) != KEY_EXCHANGE:
+                return
+            if not self._matches_pin(peer_username, response["public_key"]):
+                # The peer already counts us as connected; undo that too
+                pending = self.pending_connections.get(peer_username)
+                if pending is not None:
+                    disconnect = json.dumps({"type": "disconnect", "username": self.username})
+                    self._count_sent(peer_username, "disconnect", disconnect)
+                    self.reactor.request(self._endpoint(pending["ip"], pending["port"]), disconnect,
+                                         lambda reply: None, timeout=self.timeout / 1000)
+                self._end_handshake(peer_username, FAILED, (KEY_EXCHANGE,))
+                return
+            if not self.handshakes.transition(peer_username, CONNECTED, expected=(KEY_EXCHANGE,)):
+                return
+            # Store the peer's public key and move it from pending to connected
+            self.peers.connect(peer_username, public_key=response["public_key"])
+            print(f"Key exchange completed with {peer_username}")
+            self._handshake_succeeded(peer_username)
+        elif response["type"] == "key_exchange_ack" and peer_username in self.connected_peers:
+            # Both sides connected at once and the peer's exchange finished first
+            print(f"Key exchange already completed with {peer_username}")
+        else:
+            print("Invalid key exchange response")
+            self._end_handshake(peer_username, FAILED, (KEY_EXCHANGE,))
 
     def accept_connection(self, peer_ip, peer_port, peer_username):
-        """Accept a connection request and exchange keys"""
+        """Accept a connection request; the handshake carries on in the background"""
         # Check if already connected
         if peer_username in self.connected_peers:
             print(f"Already connected to {peer_username}")
             self.connection_status.emit(peer_username, True)
             return True
-            
+        
+        # The peer may have cancelled, or given up, while the request was waiting for the user
+        if not self.handshakes.transition(peer_username, ACCEPTING, expected=(REQUESTED,)):
+            print(f"{peer_username} cancelled the connection request")
+            self.connection_progress.emit(peer_username, "cancelled")
+            return False
+        
+        # Store the connection info for later use
+        self.peers.add_pending(peer_username, peer_ip, peer_port)
+        
+        self.connection_progress.emit(peer_username, "key_exchange")
+        self._handshake_request(peer_username, peer_ip, peer_port, {
+            "type": "connection_accepted",
+            "username": self.username,
+            "port": self.listen_port,
+            "ip": self.local_ip
+        }, lambda reply: self._handle_acceptance_reply(peer_username, peer_ip, peer_port, reply))
+        return True
+
+    def _handle_acceptance_reply(self, peer_username, peer_ip, peer_port, reply):
+        print(f"Received acknowledgment: {reply}")
+        # A cancel from the peer in the meantime has already ended the handshake
+        if self.handshakes.transition(peer_username, KEY_EXCHANGE, expected=(ACCEPTING,)):
+            self._send_key_exchange(peer_username, peer_ip, peer_port)
+
+    def refuse_connection(self, peer_ip, peer_port, peer_username):
+        """Refuse a connection request, without waiting for the peer"""
+        self.handshakes.transition(peer_username, REFUSED, expected=(REQUESTED,))
+        self.peers.discard_pending(peer_username)
+        
+        refusal = json.dumps({
+            "type": "connection_refused",
+            "username": self.username,
+            "reason": "Connection refused by user"
+        })
+        self._count_sent(peer_username, "connection_refused", refusal)
+        self.reactor.request(self._endpoint(peer_ip, peer_port), refusal,
+                             lambda reply: print(f"Received acknowledgment: {reply}"),
+                             timeout=self.timeout / 1000)
+        return True
+
+    def send_message(self, recipient_username, message):
+        """Queue a message in the outbox; it is delivered, in order, whenever the peer is reachable"""
+        message_data = {
+            "type": "message",
+            "username": self.username,
+            "content": message,
+            # Lets the peer drop a copy that arrives twice after a lost reply; 64 bits is plenty
+            # for that, and every byte here is one less for the content in the RSA block
+            "message_id": uuid.uuid4().hex[:16]
+        }
+        serialized = json.dumps(message_data)
+        
+        # Our key, and with it the size limit below, only exists once startup has finished
+        if not self.wait_ready(0):
+            print(f"Network not started, cannot send to {recipient_username}")
+            return False
+        
+        # Messages are encrypted in a single RSA block, so a longer one could never be sent
+        limit = self.encryption.max_message_size()
+        if len(serialized.encode()) > limit:
+            print(f"Message to {recipient_username} is too long to encrypt ({limit} bytes at most)")
+            self.message_sent.emit(False, "Message too long to send")
+            return False
+        
         try:
-            # Set connection state
-            self.connection_state[peer_username] = "accepting"
-            
-            # Store the connection info for later use
-            self.pending_connections[peer_username] = {
-                "ip": peer_ip,
-                "port": peer_port
-            }
-            
-            # Create a new socket for this connection request
-            accept_socket = self.context.socket(zmq.REQ)
-            accept_socket.setsockopt(zmq.RCVTIMEO, 5000)  # 5 second timeout
-            accept_socket.connect(f"tcp://{peer_ip}:{peer_port}")
-            
-            # Send acceptance response with our connection info
-            response = {
-                "type": "connection_accepted",
-                "username": self.username,
-                "port": self.listen_port,
-                "ip": self.local_ip
-            }
-            accept_socket.send_json(response)
-            
-            # Wait for acknowledgment
+            self.outbox.push(recipient_username, serialized)
+        except Exception as e:
+            print(f"Error queueing message: {e}")
+            return False
+        
+        if recipient_username not in self.connected_peers:
+            print(f"Not connected to {recipient_username}, message queued")
+        self._drain_outbox(recipient_username)
+        return True
+
+    def _drain_outbox(self, peer_username):
+        """Send the peer's oldest queued message unless one is already on its way"""
+        with self.outbox_lock:
+            if peer_username in self.delivering or peer_username not in self.connected_peers:
+                return
+            entry = self.outbox.head(peer_username)
+            if entry is None:
+                return
+            self.delivering.add(peer_username)
+        
+        peer_info = self.connected_peers.get(peer_username)
+        if peer_info is None:
+            self._delivery_failed(entry, "peer disconnected")
+            return
+        
+        def _send_message_job(scheduler):
             try:
-                ack = accept_socket.recv_json(timeout=5000)
-                print(f"Received acknowledgment: {ack}")
+                print(f"Encrypting message for {peer_username}")
+                outgoing = self.encrypt_message(entry.message, peer_username)
             except Exception as e:
-                print(f"Error receiving acknowledgment: {e}")
+                # Retrying would fail the same way
+                self._give_up(entry, f"could not encrypt it: {e}")
+                return False
             
-            accept_socket.close()
+            try:
+                # Send and wait for acknowledgment
+                self._count_sent(peer_username, "message", outgoing)
+                response = scheduler.request(outgoing)
+                if response != "OK":
+                    raise RuntimeError("Failed to send message")
+            except Exception as e:
+                print(f"Error sending message: {e}")
+                self._delivery_failed(entry, str(e))
+                return False
             
-            # Start key exchange in a separate thread
-            threading.Thread(target=self._key_exchange_thread, 
-                           args=(peer_ip, peer_port, peer_username),
-                           daemon=True).start()
+            self.outbox.remove(entry.entry_id)
+            with self.outbox_lock:
+                self.delivering.discard(peer_username)
+            self.message_sent.emit(True, "")
             
+            # Next in line, if any
+            self._drain_outbox(peer_username)
             return True
-        except Exception as e:
-            print(f"Error accepting connection: {str(e)}")
-            self.connection_state[peer_username] = "failed"
-            return False
+        
+        def _check_send_future(future):
+            # Only fails if the scheduler stopped before the message was sent
+            if future.exception():
+                self._delivery_failed(entry, str(future.exception()))
+        
+        # Chat messages overtake any file chunks queued for this peer
+        future = self._scheduler_for(peer_info["ip"], peer_info["port"]).submit(CHAT, _send_message_job)
+        future.add_done_callback(_check_send_future)
 
-    def _connect_back_thread(self, peer_ip, peer_port, peer_username):
-        """Thread function to connect back to the peer"""
-        # Check if already connected
-        if peer_username in self.connected_peers:
-            print(f"Already connected to {peer_username}, skipping connect back")
+    def _delivery_failed(self, entry, error):
+        """Keep the message queued and retry it after a backoff, unless it is out of attempts or too old"""
+        attempts = self.outbox.record_attempt(entry.entry_id)
+        if attempts >= self.outbox_max_attempts:
+            self._give_up(entry, f"{attempts} attempts failed, the last with: {error}")
             return
-            
+        if time.time() - entry.created > self.outbox_ttl:
+            self._give_up(entry, f"it was queued more than {self.outbox_ttl} s ago, the last attempt failed with: {error}")
+            return
+        delay = backoff_delay(attempts - 1)
+        print(f"Delivery to {entry.peer} failed ({error}), retrying in {delay:.1f} s")
+        
+        with self.outbox_lock:
+            self.retry_handles[entry.peer] = self.retry_timer.call_later(
+                delay, lambda: self._retry_delivery(entry.peer)
+            )
+
+    def _give_up(self, entry, reason):
+        """Drop a message from the queue for good, tell the user once and move on to the next"""
+        print(f"Giving up on a message to {entry.peer}: {reason}")
         try:
-            # Create a temporary socket for connection request
-            conn_socket = self.context.socket(zmq.REQ)
-            conn_socket.setsockopt(zmq.RCVTIMEO, 5000)  # 5 second timeout
-            conn_socket.connect(f"tcp://{peer_ip}:{peer_port}")
-            
-            # Send connection request
-            conn_request = {
-                "type": "connection_request",
-                "username": self.username,
-                "port": self.listen_port,
-                "ip": self.local_ip
-            }
-            conn_socket.send_json(conn_request)
-            
-            # Wait for response
-            response = conn_socket.recv_json()
-            conn_socket.close()
-            
-            if response["type"] == "connection_accepted":
-                # Connection accepted, proceed with key exchange
-                print(f"Mutual connection established with {peer_username}")
-                self.connection_state[peer_username] = "connected"
-                self.connection_status.emit(peer_username, True)
-            else:
-                # Connection refused
-                print(f"Mutual connection refused by {peer_username}")
-                self.connection_state[peer_username] = "failed"
-                self.connection_status.emit(peer_username, False)
-                
-        except zmq.error.Again:
-            # Timeout error
-            print(f"Mutual connection request to {peer_username} timed out")
-            self.connection_state[peer_username] = "failed"
-            self.connection_status.emit(peer_username, False)
+            self.outbox.fail(entry.entry_id, reason)
         except Exception as e:
-            print(f"Mutual connection request failed: {str(e)}")
-            self.connection_state[peer_username] = "failed"
-            self.connection_status.emit(peer_username, False)
+            print(f"Error moving message out of the outbox: {e}")
+        with self.outbox_lock:
+            self.delivering.discard(entry.peer)
+        self.message_sent.emit(False, f"Message to {entry.peer} could not be delivered: {reason}")
+        self._drain_outbox(entry.peer)
 
-    def refuse_connection(self, peer_ip, peer_port, peer_username):
-        """Refuse a connection request"""
+    def _retry_delivery(self, peer_username):
+        with self.outbox_lock:
+            self.retry_handles.pop(peer_username, None)
+            self.delivering.discard(peer_username)
+        # While the peer is offline nothing is sent; reconnecting drains the queue
+        self._drain_outbox(peer_username)
+
+    def _flush_outbox_on_connect(self, peer_username, success):
+        """A peer (re)appeared, so deliver its queue now instead of waiting out the backoff"""
+        if not success:
+            return
+        with self.outbox_lock:
+            handle = self.retry_handles.pop(peer_username, None)
+            if handle is not None:
+                handle.cancel()
+                self.delivering.discard(peer_username)
+        self._drain_outbox(peer_username)
+
+    def send_file(self, peer_username, filepath):
+        """Send a file to a connected peer in chunks on the bulk lane"""
+        peer_info = self.connected_peers.get(peer_username)
+        if peer_info is None:
+            print(f"Not connected to {peer_username}, cannot send file")
+            return False
+        
+        scheduler = self._scheduler_for(peer_info["ip"], peer_info["port"])
+        transfer_id = uuid.uuid4().hex
+        filename = os.path.basename(filepath)
+        
         try:
-            # Create a new socket for this connection request
-            refuse_socket = self.context.socket(zmq.REQ)
-            refuse_socket.setsockopt(zmq.RCVTIMEO, 5000)  # 5 second timeout
-            refuse_socket.connect(f"tcp://{peer_ip}:{peer_port}")
-            
-            # Send refusal response
-            response = {
-                "type": "connection_refused",
-                "username": self.username,
-                "reason": "Connection refused by user"
-            }
-            refuse_socket.send_json(response)
-            
-            # Wait for acknowledgment
+            file = open(filepath, "rb")
+            size = os.path.getsize(filepath)
+        except OSError as e:
+            print(f"Error opening file: {e}")
+            return False
+        
+        self.progress.start(transfer_id, peer_username, filename, size, "send")
+        state = {"offset": 0}
+        
+        def _fail(error):
+            file.close()
+            print(f"Error sending file: {error}")
+            self.progress.finish(transfer_id, success=False)
+            self.message_sent.emit(False, str(error))
+        
+        def _send_chunk_job(scheduler):
+            # Each chunk is its own job so control and chat traffic can run in between
             try:
-                ack = refuse_socket.recv_json(timeout=5000)
-                print(f"Received acknowledgment: {ack}")
+                data = file.read(CHUNK_SIZE)
+                # Chunks are too large for RSA, so they travel as plain JSON frames
+                chunk_message = {
+                    "type": "file_chunk",
+                    "username": self.username,
+                    "transfer_id": transfer_id,
+                    "filename": filename,
+                    "size": size,
+                    "offset": state["offset"],
+                    "data": base64.b64encode(data).decode()
+                }
+                payload = json.dumps(chunk_message)
+                self._count_sent(peer_username, "file_chunk", payload)
+                if scheduler.request(payload) != "OK":
+                    raise RuntimeError("Peer rejected file chunk")
+                
+                state["offset"] += len(data)
+                self.progress.update(transfer_id, state["offset"])
             except Exception as e:
-                print(f"Error receiving acknowledgment: {e}")
+                _fail(e)
+                return
             
-            refuse_socket.close()
+            if state["offset"] < size:
+                _queue_next_chunk()
+                return
             
-            # Clean up connection state
-            if peer_username in self.connection_state:
-                del self.connection_state[peer_username]
-            if peer_username in self.pending_connections:
-                del self.pending_connections[peer_username]
-                
-            return True
-        except Exception as e:
-            print(f"Error refusing connection: {str(e)}")
-            return False
+            file.close()
+            self.progress.finish(transfer_id)
+            print(f"Sent file {filename} ({size} bytes) to {peer_username}")
+            self.message_sent.emit(True, "")
+        
+        def _check_chunk_future(future):
+            # Only fails if the scheduler stopped before the chunk was sent
+            if future.exception():
+                _fail(future.exception())
+        
+        def _queue_next_chunk():
+            future = scheduler.submit(BULK, _send_chunk_job, min(CHUNK_SIZE, size - state["offset"]))
+            future.add_done_callback(_check_chunk_future)
+        
+        _queue_next_chunk()
+        return True
 
-    def initiate_key_exchange(self, peer_ip, peer_port, peer_username):
-        """Initiate key exchange with a peer"""
+    def _handle_file_chunk(self, message_data, decrypted, reply):
+        """Spool an incoming file chunk to disk"""
+        transfer_id = message_data.get("transfer_id", "")
         try:
-            # Create a temporary socket for key exchange
-            exchange_socket = self.context.socket(zmq.REQ)
-            exchange_socket.setsockopt(zmq.RCVTIMEO, 5000)  # 5 second timeout
-            exchange_socket.connect(f"tcp://{peer_ip}:{peer_port}")
+            data = base64.b64decode(message_data["data"])
             
-            # Send our public key
-            key_exchange_msg = {
-                "type": "key_exchange",
-                "username": self.username,
-                "public_key": self.get_public_key_pem()
-            }
-            exchange_socket.send_json(key_exchange_msg)
+            # Start tracking progress on the first chunk
+            if not self.progress.is_tracking(transfer_id):
+                self.progress.start(transfer_id, message_data["username"], message_data["filename"],
+                                    message_data["size"], "receive")
             
-            # Receive peer's public key
-            response = exchange_socket.recv_json()
-            if response["type"] == "key_exchange":
-                self.peer_public_keys[peer_username] = response["public_key"]
-                print(f"Key exchange completed with {peer_username}")
-                self.key_exchange_complete.emit(peer_username)
-                self.connection_status.emit(peer_username, True)
-                
-                # Update connection state
-                if peer_username in self.pending_connections:
-                    self.connected_peers[peer_username] = self.pending_connections[peer_username]
-            else:
-                print("Invalid key exchange response")
-                self.connection_status.emit(peer_username, False)
+            filepath = self.spool.write_chunk(
+                transfer_id,
+                message_data["filename"],
+                message_data["size"],
+                message_data["offset"],
+                data
+            )
+            self.progress.update(transfer_id, message_data["offset"] + len(data))
             
-            exchange_socket.close()
-        except zmq.error.Again:
-            # Timeout error
-            print(f"Key exchange with {peer_username} timed out")
-            self.connection_status.emit(peer_username, False)
+            # Last chunk written, hand the spooled file to the UI
+            if filepath:
+                print(f"File {message_data['filename']} received from {message_data['username']}")
+                self.progress.finish(transfer_id)
+                self.file_received.emit(message_data["username"], message_data["filename"], filepath)
         except Exception as e:
-            print(f"Key exchange failed: {str(e)}")
-            self.connection_status.emit(peer_username, False)
-
-    def send_message(self, receiver_ip, port, message, recipient_username):
-        """Send a message to a receiver"""
-        def _send_message_thread():
-            try:
-                # Create a temporary socket for sending
-                send_socket = self.context.socket(zmq.REQ)
-                send_socket.setsockopt(zmq.RCVTIMEO, 5000)  # 5 second timeout
-                send_socket.connect(f"tcp://{receiver_ip}:{port}")
-                
-                # First create the JSON message
-                message_data = {
-                    "type": "message",
-                    "username": self.username,
-                    "content": message
-                }
-                json_message = json.dumps(message_data)
-                
-                # Then encrypt if we have the recipient's public key
-                if recipient_username in self.peer_public_keys:
-                    try:
-                        print(f"Encrypting message for {recipient_username}")
-                        encrypted_message = self.encrypt_message(json_message, recipient_username)
-                        send_socket.send_string(encrypted_message)
-                    except Exception as e:
-                        print(f"Encryption failed: {e}")
-                        self.message_sent.emit(False, f"Encryption failed: {str(e)}")
-                        return
-                else:
-                    print(f"No public key for {recipient_username}, sending unencrypted")
-                    send_socket.send_string(json_message)
-                
-                # Wait for acknowledgment
-                response = send_socket.recv_string()
-                if response == "OK":
-                    self.message_sent.emit(True, "")
-                else:
-                    self.message_sent.emit(False, "Failed to send message")
-                
-                send_socket.close()
-            except Exception as e:
-                print(f"Error sending message: {e}")
-                self.message_sent.emit(False, str(e))
-        
-        # Start sending in a separate thread
-        threading.Thread(target=_send_message_thread, daemon=True).start()
+            print(f"Error handling file chunk: {str(e)}")
+            self.progress.finish(transfer_id, success=False)
+            self.spool.discard(transfer_id)
+            # Anything but OK makes the sender give up on the rest of the file
+            reply.send_json({"type": "error", "error": f"File chunk rejected: {str(e)}"})
 
     def receive_loop(self):
-        """Continuously receive messages"""
-        while self.running:
-            try:
-                # Set a timeout for receiving messages
-                if self.socket.poll(timeout=1000) == 0:  # 1 second timeout
-                    continue
-                
-                # Receive message
-                message = self.socket.recv_string()
-                print(f"Raw message received: {message[:100]}...")
-                
-                # First try to decrypt if it's encrypted
+        """Receive stage: drain the listening socket into the pipeline and send replies back out"""
+        replies = self.context.socket(zmq.PULL)
+        replies.setsockopt(zmq.LINGER, 0)
+        replies.bind(self.reply_endpoint)
+        inbound = self.pipeline.input()
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(replies, zmq.POLLIN)
+        try:
+            while self.running:
                 try:
-                    decrypted = self.decrypt_message(message)
-                    print(f"Decrypted message: {decrypted[:100]}...")
-                    # If decryption succeeded, try to parse as JSON
-                    try:
-                        message_data = json.loads(decrypted)
-                        print(f"Parsed JSON from decrypted message: {message_data.get('type', 'unknown')}")
-                    except json.JSONDecodeError as e:
-                        print(f"JSON decode error after decryption: {e}")
-                        # If not JSON, treat as plain text
-                        self.message_received.emit(decrypted)
-                        self.socket.send_string("OK")
-                        continue
+                    events = dict(poller.poll(timeout=1000))
+                    
+                    # Requests arrive as [routing id, empty delimiter, body] from the peers' REQ sockets
+                    if self.socket in events:
+                        while True:
+                            try:
+                                frames = self.socket.recv_multipart(flags=zmq.NOBLOCK)
+                            except zmq.error.Again:
+                                break
+                            inbound.send([frames[0], frames[-1]])
+                    
+                    # Replies come back from the dispatch stage in whatever order it finishes them
+                    if replies in events:
+                        while True:
+                            try:
+                                routing_id, reply = replies.recv_multipart(flags=zmq.NOBLOCK)
+                            except zmq.error.Again:
+                                break
+                            self.socket.send_multipart([routing_id, b"", reply])
                 except Exception as e:
-                    print(f"Decryption failed: {e}")
-                    # If decryption failed, try to parse as JSON directly
-                    try:
-                        message_data = json.loads(message)
-                        print(f"Parsed JSON from raw message: {message_data.get('type', 'unknown')}")
-                    except json.JSONDecodeError as e:
-                        print(f"JSON decode error on raw message: {e}")
-                        # If neither decryption nor JSON parsing worked, treat as plain text
-                        self.message_received.emit(message)
-                        self.socket.send_string("OK")
-                        continue
-                
-                # Handle different message types
-                if message_data["type"] == "connection_request":
-                    # Only emit if we're not already connected or connecting
-                    peer_username = message_data["username"]
-                    print(f"Connection request from {peer_username}")
-                    if (peer_username not in self.connected_peers and 
-                        peer_username not in self.pending_connections and
-                        self.connection_state.get(peer_username) != "connecting"):
-                        print(f"Emitting connection request for {peer_username}")
-                        # Store the connection info for later use
-                        self.pending_connections[peer_username] = {
-                            "ip": message_data["ip"],
-                            "port": message_data["port"]
-                        }
-                        # Emit the connection request to the UI
-                        self.connection_request.emit(
-                            message_data["username"],
-                            message_data["ip"],
-                            message_data["port"]
-                        )
-                        # Don't send a response yet - wait for user decision
-                        # The UI will call accept_connection or refuse_connection
-                    else:
-                        print(f"Ignoring connection request from {peer_username} - already connected or connecting")
-                        # Send a response for duplicate requests
-                        self.socket.send_json({"type": "connection_accepted", "username": self.username})
-                elif message_data["type"] == "connection_accepted":
-                    print(f"Connection accepted by {message_data['username']}")
-                    if message_data["username"] not in self.connected_peers:
-                        self.connection_status.emit(message_data["username"], True)
-                elif message_data["type"] == "connection_refused":
-                    print(f"Connection refused by {message_data['username']}")
-                    self.connection_status.emit(message_data["username"], False)
-                elif message_data["type"] == "key_exchange":
-                    print(f"Key exchange from {message_data['username']}")
-                    self._handle_key_exchange(message_data)
-                elif message_data["type"] == "key_exchange_complete":
-                    print(f"Key exchange complete with {message_data['username']}")
-                    if message_data["username"] not in self.connected_peers:
-                        self.key_exchange_complete.emit(message_data["username"])
-                elif message_data["type"] == "disconnect":
-                    peer_username = message_data["username"]
-                    print(f"Disconnect request from {peer_username}")
-                    if peer_username in self.connected_peers:
-                        del self.connected_peers[peer_username]
-                        if peer_username in self.peer_public_keys:
-                            del self.peer_public_keys[peer_username]
-                        print(f"Peer {peer_username} disconnected")
-                        self.connection_status.emit(peer_username, False)
-                    self.socket.send_json({"type": "disconnect_ack"})
-                elif message_data["type"] == "disconnect_ack":
-                    print("Disconnect acknowledged")
-                elif message_data["type"] == "message":
-                    print(f"Message from {message_data.get('username', 'unknown')}")
-                    self.message_received.emit(message)
-                elif message_data["type"] == "file":
-                    print(f"File from {message_data.get('username', 'unknown')}")
-                    self.message_received.emit(message)
-                else:
-                    print(f"Received unknown message type: {message_data.get('type', 'unknown')}")
-                    self.message_received.emit(message)
-                
-                # Send acknowledgment for all message types except connection_request
-                # (which is handled separately)
-                if message_data["type"] != "connection_request":
-                    self.socket.send_string("OK")
-            except zmq.error.Again:
-                continue
-            except Exception as e:
-                print(f"Error in receive loop: {e}")
-                continue
+                    print(f"Error in receive loop: {e}")
+        finally:
+            inbound.close()
+            replies.close(linger=0)
 
-    def _handle_key_exchange(self, message_data):
+    def _decode_stage(self, frames, forward):
+        """Decode stage: decrypt and parse a request, off the thread that drains the socket"""
+        routing_id, body = frames
+        message = body.decode()
+        print(f"Raw message received: {message[:100]}...")
+        
+        # First try to decrypt if it's encrypted
+        message_data = None
+        try:
+            decrypted = self.decrypt_message(message)
+            print(f"Decrypted message: {decrypted[:100]}...")
+            # If decryption succeeded, try to parse as JSON
+            try:
+                message_data = json.loads(decrypted)
+                print(f"Parsed JSON from decrypted message: {message_data.get('type', 'unknown')}")
+            except json.JSONDecodeError as e:
+                print(f"JSON decode error after decryption: {e}")
+        except Exception as e:
+            print(f"Decryption failed: {e}")
+            decrypted = message
+            # If decryption failed, try to parse as JSON directly
+            try:
+                message_data = json.loads(message)
+                print(f"Parsed JSON from raw message: {message_data.get('type', 'unknown')}")
+            except json.JSONDecodeError as e:
+                print(f"JSON decode error on raw message: {e}")
+        
+        if isinstance(message_data, dict):
+            self._count_traffic(self.messages_received, self.bytes_received, message_data.get("username"),
+                                message_data.get("type"), len(body))
+        else:
+            self._count_traffic(self.messages_received, self.bytes_received, None, None, len(body))
+        # Everything here came from JSON, so it goes on as JSON
+        forward([routing_id, json.dumps([message_data, decrypted]).encode()])
+
+    def _dispatch_stage(self, frames, forward):
+        """Dispatch stage: act on a decoded request and send exactly one reply"""
+        routing_id, payload = frames
+        message_data, decrypted = json.loads(payload)
+        reply = Reply(lambda body: forward([routing_id, body]))
+        
+        # Any request from a connected peer shows it is alive
+        if isinstance(message_data, dict) and message_data.get("username") in self.connected_peers:
+            self.last_seen[message_data["username"]] = time.monotonic()
+        try:
+            if message_data is None:
+                # Neither JSON nor encrypted JSON, treat as plain text
+                self.message_received.emit("Unknown", decrypted)
+            else:
+                self._dispatch(message_data, decrypted, reply)
+        finally:
+            # Every request gets an answer, or the peer's REQ socket is stuck waiting
+            if not reply.sent:
+                reply.send_string("OK")
+
+    def register_handler(self, message_type, handler):
+        """Handle requests of message_type with handler(message_data, decrypted, reply)
+        
+        Replaces any handler already registered for the type. reply may be used once; a request
+        the handler doesn't answer gets a plain OK.
+        """
+        self.handlers[message_type] = MessageHandler(handler, self.handler_errors.labels(message_type),
+                                                     self.handler_seconds.labels(message_type))
+
+    def _register_handlers(self):
+        self.register_handler("connection_request", self._handle_connection_request)
+        self.register_handler("connection_accepted", self._handle_connection_accepted)
+        self.register_handler("connection_refused", self._handle_connection_refused)
+        self.register_handler("connection_cancelled", self._handle_connection_cancelled)
+        self.register_handler("reconnect", self._handle_reconnect)
+        self.register_handler("key_exchange", self._handle_key_exchange)
+        self.register_handler("key_exchange_complete", self._handle_key_exchange_complete)
+        self.register_handler("disconnect", self._handle_disconnect)
+        self.register_handler("disconnect_ack", self._handle_disconnect_ack)
+        self.register_handler("ping", self._handle_ping)
+        self.register_handler("message", self._handle_message)
+        self.register_handler("file", self._handle_file)
+        self.register_handler("file_chunk", self._handle_file_chunk)
+
+    def handler_stats(self):
+        """Calls, errors and handling time of each message type seen so far"""
+        stats = {message_type: entry.snapshot() for message_type, entry in list(self.handlers.items())
+                 if entry.timings.count}
+        if self.unknown_handler.timings.count:
+            stats["other"] = self.unknown_handler.snapshot()
+        return stats
+
+    def _dispatch(self, message_data, decrypted, reply):
+        """Hand a request to the handler for its type; reply may be used once, otherwise the peer gets a plain OK"""
+        entry = self.handlers.get(message_data.get("type"), self.unknown_handler)
+        started = time.perf_counter()
+        try:
+            entry.handler(message_data, decrypted, reply)
+        except Exception:
+            entry.errors.inc()
+            raise
+        finally:
+            entry.timings.observe(time.perf_counter() - started)
+
+    def _handle_connection_request(self, message_data, decrypted, reply):
+        # Only emit if we're not already connected or connecting
+        peer_username = message_data["username"]
+        print(f"Connection request from {peer_username}")
+        if (peer_username not in self.connected_peers and
+            self.handshakes.transition(peer_username, REQUESTED, expected=IDLE)):
+            print(f"Emitting connection request for {peer_username}")
+            # Store the connection info for later use
+            self.peers.add_pending(peer_username, message_data["ip"], message_data["port"])
+            # Emit the connection request to the UI
+            self.connection_request.emit(
+                message_data["username"],
+                message_data["ip"],
+                message_data["port"]
+            )
+            # Answer right away so the socket is free while the user decides;
+            # the UI will call accept_connection or refuse_connection
+            reply.send_json({"type": "connection_pending", "username": self.username})
+        else:
+            print(f"Ignoring connection request from {peer_username} - already connected or connecting")
+            # Send a response for duplicate requests
+            reply.send_json({"type": "connection_accepted", "username": self.username})
+
+    def _handle_connection_accepted(self, message_data, decrypted, reply):
+        peer_username = message_data["username"]
+        print(f"Connection accepted by {peer_username}")
+        # The peer's key exchange follows and completes the connection
+        if self.handshakes.transition(peer_username, KEY_EXCHANGE, expected=(CONNECTING, AWAITING_ACCEPT)):
+            self.connection_progress.emit(peer_username, "key_exchange")
+
+    def _handle_connection_refused(self, message_data, decrypted, reply):
+        peer_username = message_data["username"]
+        print(f"Connection refused by {peer_username}")
+        if self.is_connecting(peer_username):
+            self._end_handshake(peer_username, REFUSED, OUTBOUND)
+        else:
+            self.connection_status.emit(peer_username, False)
+
+    def _handle_connection_cancelled(self, message_data, decrypted, reply):
+        peer_username = message_data["username"]
+        print(f"Connection request from {peer_username} cancelled")
+        if self.handshakes.transition(peer_username, CANCELLED, expected=(REQUESTED,)):
+            self.peers.discard_pending(peer_username)
+        elif not self.is_connecting(peer_username):
+            self._end_handshake(peer_username, CANCELLED, (ACCEPTING, KEY_EXCHANGE))
+
+    def _handle_key_exchange_complete(self, message_data, decrypted, reply):
+        print(f"Key exchange complete with {message_data['username']}")
+        if message_data["username"] not in self.connected_peers:
+            self.key_exchange_complete.emit(message_data["username"])
+
+    def _handle_disconnect(self, message_data, decrypted, reply):
+        peer_username = message_data["username"]
+        print(f"Disconnect request from {peer_username}")
+        if self.peers.disconnect(peer_username) is not None:
+            self.handshakes.transition(peer_username, CLOSED, expected=(CONNECTED,))
+            print(f"Peer {peer_username} disconnected")
+            self.connection_closed.emit(peer_username)
+        reply.send_json({"type": "disconnect_ack"})
+
+    def _handle_disconnect_ack(self, message_data, decrypted, reply):
+        print("Disconnect acknowledged")
+
+    def _handle_ping(self, message_data, decrypted, reply):
+        # Liveness is already recorded; the plain OK reply is the pong
+        pass
+
+    def _handle_message(self, message_data, decrypted, reply):
+        print(f"Message from {message_data.get('username', 'unknown')}")
+        if self._is_new_message(message_data.get("message_id")):
+            self.message_received.emit(message_data.get("username", "Unknown"), message_data.get("content", ""))
+
+    def _handle_file(self, message_data, decrypted, reply):
+        print(f"File from {message_data.get('username', 'unknown')}")
+        self.message_received.emit(message_data.get("username", "Unknown"), decrypted)
+
+    def _handle_unknown(self, message_data, decrypted, reply):
+        print(f"Received unknown message type: {message_data.get('type', 'unknown')}")
+        self.message_received.emit(message_data.get("username", "Unknown"), decrypted)
+
+    def _is_new_message(self, message_id):
+        """Whether a message hasn't been seen yet; a retry may deliver it twice"""
+        if not message_id:
+            return True
+        if message_id in self.seen_message_ids:
+            print(f"Dropping duplicate message {message_id}")
+            return False
+        self.seen_message_ids[message_id] = True
+        if len(self.seen_message_ids) > SEEN_MESSAGE_IDS:
+            self.seen_message_ids.popitem(last=False)
+        return True
+
+    def _handle_key_exchange(self, message_data, decrypted, reply):
         """Handle key exchange message"""
         try:
             # Extract peer information
             peer_username = message_data["username"]
+            print(f"Key exchange from {peer_username}")
             peer_public_key = message_data["public_key"]
             
-            # Check if we already have this peer's key
-            if peer_username in self.peer_public_keys:
+            # Both sides connected at once and ours finished first
+            if self.peer_public_keys.get(peer_username) == peer_public_key:
                 print(f"Already have key for {peer_username}")
-                # Send acknowledgment
-                self.socket.send_json({
+                reply.send_json({
                     "type": "key_exchange_ack",
                     "username": self.username
                 })
                 return
             
+            # Keys are only taken as part of a handshake we started or accepted
+            expected = OUTBOUND + (ACCEPTING,)
+            if peer_username not in self.pending_connections or self.handshakes.state(peer_username) not in expected:
+                print(f"Ignoring unexpected key exchange from {peer_username}")
+                reply.send_json({"type": "error", "error": "Unexpected key exchange"})
+                return
+            if not self._matches_pin(peer_username, peer_public_key):
+                reply.send_json({"type": "error", "error": "Key does not match the pinned key"})
+                self._end_handshake(peer_username, FAILED, expected)
+                return
+            
             # Store the peer's public key
-            self.peer_public_keys[peer_username] = peer_public_key
+            self.peers.set_key(peer_username, peer_public_key)
             print(f"Stored public key for {peer_username}")
             
             # Send our public key in response
@@ -615,17 +1521,16 @@ class MessengerNetwork(QObject):
                 "username": self.username,
                 "public_key": self.get_public_key_pem()
             }
-            self.socket.send_json(response)
+            reply.send_json(response)
             print(f"Sent our public key to {peer_username}")
             
             # Update connection state
-            if peer_username in self.pending_connections:
-                if peer_username not in self.connected_peers:
-                    print(f"Moving {peer_username} from pending to connected")
-                    self.connected_peers[peer_username] = self.pending_connections[peer_username]
-                    self.connection_state[peer_username] = "connected"
-                    self.key_exchange_complete.emit(peer_username)
-                    self.connection_status.emit(peer_username, True)
+            # A request the user hasn't accepted yet stays pending
+            if (peer_username in self.pending_connections and
+                self.handshakes.transition(peer_username, CONNECTED, expected=OUTBOUND + (ACCEPTING,))):
+                print(f"Moving {peer_username} from pending to connected")
+                self.peers.connect(peer_username)
+                self._handshake_succeeded(peer_username)
                 
         except Exception as e:
             print(f"Error handling key exchange: {str(e)}")
@@ -634,44 +1539,43 @@ class MessengerNetwork(QObject):
                 "type": "error",
                 "error": f"Key exchange failed: {str(e)}"
             }
-            self.socket.send_json(error_response)
+            reply.send_json(error_response)
 
-    def disconnect_from_peer(self, peer_ip, peer_port):
-        """Disconnect from a peer"""
+    def disconnect_from_peer(self, peer, peer_port=None):
+        """Disconnect from a peer given by username, or by IP and port"""
+        peer_username = self.peers.username_at(peer, peer_port) if peer_port is not None else peer
+        peer_info = self.connected_peers.get(peer_username)
+        if peer_info is None:
+            print(f"Not connected to {peer}")
+            return False
+        peer_ip, peer_port = peer_info["ip"], peer_info["port"]
         try:
-            # Create a temporary socket for disconnect request
-            disconnect_socket = self.context.socket(zmq.REQ)
-            disconnect_socket.setsockopt(zmq.RCVTIMEO, 5000)  # 5 second timeout
-            disconnect_socket.connect(f"tcp://{peer_ip}:{peer_port}")
-            
-            # Send disconnect request
-            disconnect_request = {
+            # Send disconnect request on the control lane, ahead of any queued data
+            disconnect_request = json.dumps({
                 "type": "disconnect",
                 "username": self.username
-            }
-            disconnect_socket.send_json(disconnect_request)
+            })
+            scheduler = self._scheduler_for(peer_ip, peer_port)
+            self._count_sent(peer_username, "disconnect", disconnect_request)
+            future = scheduler.submit(CONTROL, lambda s: s.request(disconnect_request))
             
             # Wait for response
             try:
-                response = disconnect_socket.recv_json()
+                response = json.loads(future.result())
                 print(f"Disconnect response: {response}")
             except zmq.error.Again:
                 print("Disconnect request timed out")
             except Exception as e:
                 print(f"Error receiving disconnect response: {str(e)}")
-                
-            disconnect_socket.close()
             
-            # Remove from connected peers
-            for peer_username, peer_info in list(self.connected_peers.items()):
-                if peer_info["ip"] == peer_ip and peer_info["port"] == peer_port:
-                    del self.connected_peers[peer_username]
-                    if peer_username in self.peer_public_keys:
-                        del self.peer_public_keys[peer_username]
-                    print(f"Disconnected from {peer_username}")
-                    return True
-                    
-            return False
+            # Nothing else will be sent to this peer
+            self._stop_scheduler(peer_ip, peer_port)
+            
+            # Remove from connected peers, unless the peer got there first
+            if self.peers.disconnect(peer_username) is not None:
+                self.handshakes.transition(peer_username, CLOSED, expected=(CONNECTED,))
+            print(f"Disconnected from {peer_username}")
+            return True
         except Exception as e:
             print(f"Error disconnecting from peer: {str(e)}")
             return False
\ No newline at end of file
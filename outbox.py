@@ -0,0 +1,195 @@
+import heapq
+import itertools
+import os
+import random
+import sqlite3
+import threading
+import time
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from storage import load_store_key, NONCE_SIZE
+
+# Retry delays grow from the base to the cap, doubling per failed attempt
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 300.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    peer TEXT NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    nonce BLOB NOT NULL,
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_peer ON outbox (peer, id);
+CREATE TABLE IF NOT EXISTS outbox_failed (
+    id INTEGER PRIMARY KEY,
+    peer TEXT NOT NULL,
+    created REAL NOT NULL,
+    failed REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    reason TEXT NOT NULL,
+    nonce BLOB NOT NULL,
+    body BLOB NOT NULL
+);
+"""
+
+
+def backoff_delay(attempts, base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY):
+    """Exponential backoff with full jitter, so retries to many peers don't line up"""
+    return random.uniform(0, min(cap, base * 2 ** attempts))
+
+
+class OutboxEntry:
+    """A message waiting to be delivered"""
+    __slots__ = ("entry_id", "peer", "message", "created", "attempts")
+
+    def __init__(self, entry_id, peer, message, created, attempts):
+        self.entry_id = entry_id
+        self.peer = peer
+        self.message = message
+        self.created = created
+        self.attempts = attempts
+
+
+class Outbox:
+    """Undelivered messages per peer, kept on disk in send order until acknowledged"""
+
+    def __init__(self, path, key=None):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.aead = AESGCM(key or load_store_key(os.path.splitext(path)[0] + ".key"))
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def push(self, peer, message):
+        """Queue a message behind any others for the peer, returning its entry id"""
+        nonce = os.urandom(NONCE_SIZE)
+        body = self.aead.encrypt(nonce, message.encode(), peer.encode())
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO outbox (peer, created, nonce, body) VALUES (?, ?, ?, ?)",
+                (peer, time.time(), nonce, body)
+            )
+            return cursor.lastrowid
+
+    def head(self, peer):
+        """The oldest undelivered message for a peer, or None"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT id, created, attempts, nonce, body FROM outbox WHERE peer = ? ORDER BY id LIMIT 1",
+                (peer,)
+            ).fetchone()
+        if row is None:
+            return None
+        entry_id, created, attempts, nonce, body = row
+        message = self.aead.decrypt(nonce, body, peer.encode()).decode()
+        return OutboxEntry(entry_id, peer, message, created, attempts)
+
+    def remove(self, entry_id):
+        """Forget a delivered message"""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def record_attempt(self, entry_id):
+        """Count a failed delivery, returning how many there have been"""
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE outbox SET attempts = attempts + 1 WHERE id = ?", (entry_id,))
+            row = self.connection.execute("SELECT attempts FROM outbox WHERE id = ?", (entry_id,)).fetchone()
+        return row[0] if row else 0
+
+    def fail(self, entry_id, reason):
+        """Move a message that will not be delivered out of the queue, keeping it for inspection"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO outbox_failed (id, peer, created, failed, attempts, reason, nonce, body) "
+                "SELECT id, peer, created, ?, attempts, ?, nonce, body FROM outbox WHERE id = ?",
+                (time.time(), reason, entry_id)
+            )
+            self.connection.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def failed(self, peer=None):
+        """Number of messages given up on, for one peer or all of them"""
+        with self.lock:
+            if peer is None:
+                return self.connection.execute("SELECT COUNT(*) FROM outbox_failed").fetchone()[0]
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM outbox_failed WHERE peer = ?", (peer,)).fetchone()[0]
+
+    def pending(self, peer=None):
+        """Number of undelivered messages, for one peer or all of them"""
+        with self.lock:
+            if peer is None:
+                return self.connection.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+            return self.connection.execute("SELECT COUNT(*) FROM outbox WHERE peer = ?", (peer,)).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class TimerHandle:
+    """A callback scheduled on a RetryTimer"""
+    __slots__ = ("callback", "cancelled")
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class RetryTimer:
+    """Runs delayed callbacks from a single thread, ordered by a heap of due times"""
+
+    def __init__(self):
+        self.heap = []  # (due, sequence, handle)
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def call_later(self, delay, callback):
+        """Run callback() on the timer thread after delay seconds, returning a cancellable handle"""
+        handle = TimerHandle(callback)
+        with self.condition:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.sequence), handle))
+            # Only the earliest deadline can change how long the thread sleeps
+            if self.heap[0][2] is handle:
+                self.condition.notify()
+        return handle
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    due = self.heap[0][0]
+                    now = time.monotonic()
+                    if due <= now:
+                        break
+                    self.condition.wait(due - now)
+                if not self.running:
+                    return
+                _, _, handle = heapq.heappop(self.heap)
+
+            if handle.cancelled:
+                continue
+            try:
+                handle.callback()
+            except Exception as e:
+                print(f"Error in retry callback: {e}")
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.heap.clear()
+            self.condition.notify()
+        if threading.current_thread() is not self.thread:
+            self.thread.join(timeout=1)
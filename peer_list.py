@@ -0,0 +1,217 @@
+import time
+from PyQt6.QtWidgets import QListView, QStyledItemDelegate, QStyle, QAbstractItemView
+from PyQt6.QtCore import Qt, QAbstractListModel, QModelIndex, QSortFilterProxyModel, QSize, QRectF
+from PyQt6.QtGui import QColor, QFont, QPainter, QPen
+
+ROW_HEIGHT = 48
+PRESENCE_DOT_SIZE = 10
+
+ONLINE_COLOR = QColor("#34C759")
+OFFLINE_COLOR = QColor("#C7C7CC")
+UNREAD_COLOR = QColor("#007AFF")
+SECONDARY_TEXT_COLOR = QColor("#8E8E93")
+SEPARATOR_COLOR = QColor("#C7C7CC")
+SELECTED_COLOR = QColor("#E5E5EA")
+
+# Roles exposed by PeerListModel
+OnlineRole = Qt.ItemDataRole.UserRole + 1
+UnreadRole = Qt.ItemDataRole.UserRole + 2
+LastActivityRole = Qt.ItemDataRole.UserRole + 3
+
+
+class PeerEntry:
+    """Presence and activity of one peer"""
+    __slots__ = ("username", "online", "unread", "last_activity")
+
+    def __init__(self, username, online=False, unread=0, last_activity=0.0):
+        self.username = username
+        self.online = online
+        self.unread = unread
+        self.last_activity = last_activity
+
+
+class PeerListModel(QAbstractListModel):
+    """Peers indexed by username so every update touches a single row"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.peers = []
+        self.rows = {}  # username -> row in self.peers
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.peers)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.peers):
+            return None
+        peer = self.peers[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return peer.username
+        if role == OnlineRole:
+            return peer.online
+        if role == UnreadRole:
+            return peer.unread
+        if role == LastActivityRole:
+            return peer.last_activity
+        return None
+
+    def peer(self, username):
+        """Get a peer's entry, or None"""
+        row = self.rows.get(username)
+        return self.peers[row] if row is not None else None
+
+    def row_of(self, username):
+        return self.rows.get(username, -1)
+
+    def add_peer(self, username):
+        """Add a peer if it isn't listed yet, returning its entry"""
+        row = self.rows.get(username)
+        if row is not None:
+            return self.peers[row]
+
+        row = len(self.peers)
+        entry = PeerEntry(username, last_activity=time.time())
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.peers.append(entry)
+        self.rows[username] = row
+        self.endInsertRows()
+        return entry
+
+    def _changed(self, username):
+        index = self.index(self.rows[username], 0)
+        self.dataChanged.emit(index, index)
+
+    def record_activity(self, username, unread=0, timestamp=None):
+        """Note new messages from a peer, adding it if needed"""
+        entry = self.add_peer(username)
+        entry.unread += unread
+        entry.last_activity = timestamp if timestamp is not None else time.time()
+        self._changed(username)
+
+    def mark_read(self, username):
+        entry = self.peer(username)
+        if entry and entry.unread:
+            entry.unread = 0
+            self._changed(username)
+
+    def set_online(self, username, online):
+        """Update a peer's presence, adding it if needed"""
+        entry = self.add_peer(username)
+        if entry.online != online:
+            entry.online = online
+            self._changed(username)
+
+    def remove_peer(self, username):
+        row = self.rows.get(username)
+        if row is None:
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.peers[row]
+        del self.rows[username]
+        # Rows after the removed one shift up
+        for shifted_row in range(row, len(self.peers)):
+            self.rows[self.peers[shifted_row].username] = shifted_row
+        self.endRemoveRows()
+
+
+class PeerFilterProxy(QSortFilterProxyModel):
+    """Most recently active peers first, filtered by a search string"""
+
+    def __init__(self, source_model, parent=None):
+        super().__init__(parent)
+        self.setSourceModel(source_model)
+
+        # Sorting and filtering run on plain roles so Qt never calls back into Python
+        self.setSortRole(LastActivityRole)
+        self.setFilterRole(Qt.ItemDataRole.DisplayRole)
+        self.setFilterCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
+        self.setDynamicSortFilter(True)
+        self.sort(0, Qt.SortOrder.DescendingOrder)
+
+    def set_search(self, text):
+        self.setFilterFixedString(text.strip())
+
+
+class PeerDelegate(QStyledItemDelegate):
+    """Paints presence, username, unread count and last activity for a peer"""
+
+    def sizeHint(self, option, index):
+        return QSize(option.rect.width(), ROW_HEIGHT)
+
+    def paint(self, painter, option, index):
+        painter.save()
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        rect = option.rect
+
+        if option.state & QStyle.StateFlag.State_Selected:
+            painter.fillRect(rect, SELECTED_COLOR)
+
+        # Separator
+        painter.setPen(QPen(SEPARATOR_COLOR))
+        painter.drawLine(rect.bottomLeft(), rect.bottomRight())
+
+        # Presence dot
+        online = index.data(OnlineRole)
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(ONLINE_COLOR if online else OFFLINE_COLOR)
+        dot_top = rect.top() + (rect.height() - PRESENCE_DOT_SIZE) / 2
+        painter.drawEllipse(QRectF(rect.left() + 10, dot_top, PRESENCE_DOT_SIZE, PRESENCE_DOT_SIZE))
+
+        # Unread badge on the right
+        unread = index.data(UnreadRole) or 0
+        right = rect.right() - 10
+        if unread:
+            badge_font = QFont(option.font)
+            badge_font.setBold(True)
+            badge_font.setPixelSize(11)
+            painter.setFont(badge_font)
+            badge_text = str(unread) if unread < 1000 else "999+"
+            badge_width = max(painter.fontMetrics().horizontalAdvance(badge_text) + 10, 20)
+            badge_rect = QRectF(right - badge_width, rect.top() + (rect.height() - 20) / 2, badge_width, 20)
+            painter.setBrush(UNREAD_COLOR)
+            painter.drawRoundedRect(badge_rect, 10, 10)
+            painter.setPen(QColor("white"))
+            painter.drawText(badge_rect, Qt.AlignmentFlag.AlignCenter, badge_text)
+            right = badge_rect.left() - 8
+
+        # Last activity, as a time for today and a date otherwise
+        last_activity = index.data(LastActivityRole) or 0
+        if last_activity:
+            if time.localtime(last_activity)[:3] == time.localtime()[:3]:
+                activity_text = time.strftime("%H:%M", time.localtime(last_activity))
+            else:
+                activity_text = time.strftime("%d/%m/%y", time.localtime(last_activity))
+            small_font = QFont(option.font)
+            small_font.setPixelSize(11)
+            painter.setFont(small_font)
+            painter.setPen(SECONDARY_TEXT_COLOR)
+            activity_width = painter.fontMetrics().horizontalAdvance(activity_text)
+            painter.drawText(QRectF(right - activity_width, rect.top(), activity_width, rect.height()),
+                             Qt.AlignmentFlag.AlignVCenter, activity_text)
+            right -= activity_width + 8
+
+        # Username
+        name_font = QFont(option.font)
+        name_font.setBold(bool(unread))
+        painter.setFont(name_font)
+        painter.setPen(QColor("black"))
+        name_left = rect.left() + 10 + PRESENCE_DOT_SIZE + 10
+        name_rect = QRectF(name_left, rect.top(), max(right - name_left, 0), rect.height())
+        name = painter.fontMetrics().elidedText(index.data(), Qt.TextElideMode.ElideRight, int(name_rect.width()))
+        painter.drawText(name_rect, Qt.AlignmentFlag.AlignVCenter, name)
+
+        painter.restore()
+
+
+class PeerListView(QListView):
+    """Peer list with fixed-height rows, so thousands of peers lay out in constant time"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setItemDelegate(PeerDelegate(self))
+        self.setUniformItemSizes(True)
+        self.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
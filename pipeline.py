@@ -0,0 +1,147 @@
+import threading
+import zmq
+
+STOP_POLL_INTERVAL = 1000  # Milliseconds an idle worker waits before checking whether to stop
+
+
+class StageStats:
+    """Message counts for one stage; queued is what has reached the stage but not its handler"""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.enqueued = 0
+        self.taken = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def add(self):
+        with self.lock:
+            self.enqueued += 1
+            depth = self.enqueued - self.taken
+            if depth > self.peak:
+                self.peak = depth
+
+    def take(self):
+        with self.lock:
+            self.taken += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "queued": self.enqueued - self.taken,
+                "peak_queued": self.peak,
+                "processed": self.taken
+            }
+
+
+class PipelinePort:
+    """A PUSH socket feeding a stage, counting what it sends; use it from one thread only"""
+
+    def __init__(self, socket, stats=None):
+        self.socket = socket
+        self.stats = stats
+
+    def send(self, frames):
+        self.socket.send_multipart(frames)
+        if self.stats is not None:
+            self.stats.add()
+
+    def close(self):
+        self.socket.close(linger=0)
+
+
+class PipelineStage:
+    def __init__(self, name, handler, endpoints):
+        self.name = name
+        self.handler = handler
+        self.endpoints = endpoints
+        self.stats = StageStats(len(endpoints))
+
+
+class Pipeline:
+    """Stages of worker threads joined by inproc PUSH/PULL sockets
+
+    Every worker binds a PULL socket of its own and whatever feeds the stage connects a PUSH
+    socket to all of them, so messages are spread round robin with no broker in between.
+    """
+
+    def __init__(self, context, name, queue_limit=10000):
+        self.context = context
+        self.name = name
+        self.queue_limit = queue_limit
+        self.stages = []
+        self.output_endpoints = []
+        self.threads = []
+        self.running = False
+
+    def add_stage(self, name, handler, workers=1):
+        """Append a stage running handler(frames, forward) on each message
+
+        forward(frames) passes frames to the next stage, or to the output after the last one.
+        """
+        endpoints = [f"inproc://{self.name}-{name}-{i}" for i in range(max(1, workers))]
+        self.stages.append(PipelineStage(name, handler, endpoints))
+
+    def set_output(self, endpoint):
+        """Where the last stage forwards to; the consumer binds a PULL socket there"""
+        self.output_endpoints = [endpoint]
+
+    def _push(self, endpoints, stats=None):
+        socket = self.context.socket(zmq.PUSH)
+        socket.setsockopt(zmq.SNDHWM, self.queue_limit)
+        socket.setsockopt(zmq.LINGER, 0)
+        for endpoint in endpoints:
+            socket.connect(endpoint)
+        return PipelinePort(socket, stats)
+
+    def input(self):
+        """A port into the first stage, for the thread that produces messages"""
+        return self._push(self.stages[0].endpoints, self.stages[0].stats)
+
+    def start(self):
+        self.running = True
+        for index, stage in enumerate(self.stages):
+            if index + 1 < len(self.stages):
+                following = self.stages[index + 1]
+                next_endpoints, next_stats = following.endpoints, following.stats
+            else:
+                next_endpoints, next_stats = self.output_endpoints, None
+            for worker, endpoint in enumerate(stage.endpoints):
+                thread = threading.Thread(target=self._work, args=(stage, endpoint, next_endpoints, next_stats),
+                                          name=f"{self.name}-{stage.name}-{worker}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self, stage, endpoint, next_endpoints, next_stats):
+        # Sockets belong to the thread that uses them
+        pull = self.context.socket(zmq.PULL)
+        pull.setsockopt(zmq.RCVHWM, self.queue_limit)
+        pull.setsockopt(zmq.LINGER, 0)
+        pull.bind(endpoint)
+        forward = self._push(next_endpoints, next_stats) if next_endpoints else None
+        try:
+            while self.running:
+                if pull.poll(timeout=STOP_POLL_INTERVAL) == 0:
+                    continue
+                frames = pull.recv_multipart()
+                stage.stats.take()
+                try:
+                    stage.handler(frames, forward.send if forward else None)
+                except Exception as e:
+                    print(f"Error in {stage.name} stage: {e}")
+        finally:
+            pull.close(linger=0)
+            if forward:
+                forward.close()
+
+    def stats(self):
+        """Workers, queue depth and throughput of every stage, by stage name"""
+        return {stage.name: stage.stats.snapshot() for stage in self.stages}
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout=STOP_POLL_INTERVAL / 1000 + 1)
+        self.threads.clear()
@@ -0,0 +1,53 @@
+from PyQt6.QtCore import QObject, pyqtSignal
+
+
+class QtNetworkBridge(QObject):
+    """Re-emits MessengerNetwork callbacks as Qt signals, delivered on the GUI thread"""
+    message_received = pyqtSignal(str, str)  # username, message
+    message_sent = pyqtSignal(bool, str)
+    key_exchange_complete = pyqtSignal(str)
+    connection_request = pyqtSignal(str, str, int)  # username, ip, port
+    connection_status = pyqtSignal(str, bool)  # username, success
+    file_received = pyqtSignal(str, str, str)  # username, filename, filepath
+    transfer_progress = pyqtSignal(dict)  # progress snapshot, at most every 100 ms per transfer
+    connection_progress = pyqtSignal(str, str)  # username, stage
+    connection_closed = pyqtSignal(str)  # username
+    network_ready = pyqtSignal(bool, str)  # success, error
+    peer_key_changed = pyqtSignal(str, str)  # username, new key fingerprint
+    peer_discovered = pyqtSignal(str, str, int)  # username, ip, port
+    peer_lost = pyqtSignal(str)  # username
+
+    SIGNALS = (
+        "message_received",
+        "message_sent",
+        "key_exchange_complete",
+        "connection_request",
+        "connection_status",
+        "file_received",
+        "transfer_progress",
+        "connection_progress",
+        "connection_closed",
+        "network_ready",
+        "peer_key_changed",
+        "peer_discovered",
+        "peer_lost",
+    )
+
+    def __init__(self, network, parent=None):
+        super().__init__(parent)
+        self.network = network
+
+        # Network threads emit on the Qt signal, which queues the call to the receiver's thread
+        for name in self.SIGNALS:
+            getattr(network, name).connect(getattr(self, name).emit)
+
+    def __getattr__(self, name):
+        # Everything that isn't a signal goes straight to the network
+        if name == "network":
+            raise AttributeError(name)
+        return getattr(self.network, name)
+
+    def cleanup(self):
+        for name in self.SIGNALS:
+            getattr(self.network, name).disconnect()
+        self.network.cleanup()
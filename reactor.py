@@ -0,0 +1,134 @@
+import itertools
+import socket
+import threading
+from collections import deque
+import zmq
+
+
+class RequestReactor:
+    """Request/reply round trips to many peers from a single thread
+
+    Every request gets a DEALER socket of its own and one poller watches them all, so requests
+    waiting on slow peers cost a socket each rather than a blocked thread. Timeouts are kept on
+    the shared timer. Callbacks run on the reactor thread and must not block.
+    """
+
+    def __init__(self, context, timer):
+        self.context = context
+        self.timer = timer
+        self.commands = deque()  # Filled from any thread, drained by the reactor thread
+        self.ids = itertools.count(1)
+        self.requests = {}  # request id -> (socket, callback, timeout handle)
+        self.sockets = {}  # socket -> request id
+        # Written to whenever a command is queued so the poller wakes up for it
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="request-reactor", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def request(self, endpoint, payload, callback, timeout=None):
+        """Send payload to the ROUTER at endpoint, returning an id for cancel()
+
+        callback(reply) gets the reply as a string, or None if timeout seconds pass first.
+        """
+        request_id = next(self.ids)
+        handle = None
+        if timeout:
+            handle = self.timer.call_later(timeout, lambda: self._post(("expire", request_id)))
+        self._post(("send", request_id, endpoint, payload, callback, handle))
+        return request_id
+
+    def cancel(self, request_id):
+        """Abandon a request without calling its callback"""
+        self._post(("cancel", request_id))
+
+    def _post(self, command):
+        self.commands.append(command)
+        try:
+            self.wake_writer.send(b"\0")
+        except OSError:
+            # The buffer is full, so a wakeup is already pending, or we have stopped
+            pass
+
+    def _run(self):
+        poller = zmq.Poller()
+        wake = self.wake_reader.fileno()
+        poller.register(wake, zmq.POLLIN)
+        try:
+            while self.running:
+                for sock, _ in poller.poll():
+                    if sock == wake:
+                        try:
+                            self.wake_reader.recv(4096)
+                        except BlockingIOError:
+                            pass
+                        self._run_commands(poller)
+                    elif sock in self.sockets:
+                        # Skipped if a command earlier in this batch finished its request
+                        self._receive(poller, sock)
+        finally:
+            for sock in self.sockets:
+                sock.close(linger=0)
+            self.sockets.clear()
+            self.requests.clear()
+
+    def _run_commands(self, poller):
+        while self.commands and self.running:
+            command = self.commands.popleft()
+            if command[0] == "send":
+                _, request_id, endpoint, payload, callback, handle = command
+                sock = self.context.socket(zmq.DEALER)
+                sock.setsockopt(zmq.LINGER, 0)
+                sock.connect(endpoint)
+                # Messages queue on the socket until the connection is up
+                sock.send_multipart([b"", payload.encode()])
+                poller.register(sock, zmq.POLLIN)
+                self.requests[request_id] = (sock, callback, handle)
+                self.sockets[sock] = request_id
+            elif command[0] == "cancel":
+                self._finish(poller, command[1])
+            elif command[0] == "expire":
+                callback = self._finish(poller, command[1])
+                if callback is not None:
+                    self._call(callback, None)
+
+    def _receive(self, poller, sock):
+        frames = sock.recv_multipart()
+        callback = self._finish(poller, self.sockets.get(sock))
+        if callback is not None:
+            self._call(callback, frames[-1].decode())
+
+    def _finish(self, poller, request_id):
+        """Close a request's socket, returning its callback, or None if it has already finished"""
+        request = self.requests.pop(request_id, None)
+        if request is None:
+            return None
+        sock, callback, handle = request
+        if handle is not None:
+            handle.cancel()
+        del self.sockets[sock]
+        poller.unregister(sock)
+        sock.close(linger=0)
+        return callback
+
+    def _call(self, callback, reply):
+        try:
+            callback(reply)
+        except Exception as e:
+            print(f"Error handling reply: {e}")
+
+    def pending(self):
+        """Requests still waiting for a reply"""
+        return len(self.requests)
+
+    def stop(self):
+        self.running = False
+        self._post(("stop",))
+        if threading.current_thread() is not self.thread and self.thread.is_alive():
+            self.thread.join(timeout=1)
+        self.wake_reader.close()
+        self.wake_writer.close()
@@ -0,0 +1,100 @@
+import threading
+from types import MappingProxyType
+
+_REMOVE = object()
+
+
+class PeerRegistry:
+    """This session's peers, indexed by username and by endpoint
+
+    Writers serialise on a lock and publish new dicts instead of changing the old ones, so
+    readers look things up in O(1) on whatever was last published without ever taking the lock.
+    Writes only happen as peers connect and disconnect, which keeps the copying cheap.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._connected = {}  # username -> {"ip": ..., "port": ...}
+        self._endpoints = {}  # (ip, port) -> username, for connected peers
+        self._pending = {}  # username -> {"ip": ..., "port": ...} until the handshake finishes
+        self._keys = {}  # username -> PEM public key
+
+    @property
+    def connected(self):
+        return MappingProxyType(self._connected)
+
+    @property
+    def pending(self):
+        return MappingProxyType(self._pending)
+
+    @property
+    def keys(self):
+        return MappingProxyType(self._keys)
+
+    def username_at(self, ip, port):
+        """The connected peer at an endpoint, or None"""
+        return self._endpoints.get((ip, port))
+
+    def _update(self, attribute, key, value=_REMOVE):
+        # Only call with the lock held
+        table = dict(getattr(self, attribute))
+        if value is _REMOVE:
+            table.pop(key, None)
+        else:
+            table[key] = value
+        setattr(self, attribute, table)
+
+    def add_pending(self, username, ip, port):
+        with self.lock:
+            self._update("_pending", username, {"ip": ip, "port": port})
+
+    def discard_pending(self, username):
+        with self.lock:
+            self._update("_pending", username)
+
+    def set_key(self, username, public_key):
+        with self.lock:
+            self._update("_keys", username, public_key)
+
+    def connect(self, username, ip=None, port=None, public_key=None):
+        """Mark a peer connected at the given endpoint, or its pending one
+
+        Returns False if it was already connected or we don't know where it is.
+        """
+        with self.lock:
+            if public_key is not None:
+                self._update("_keys", username, public_key)
+            if username in self._connected:
+                return False
+            if ip is not None:
+                info = {"ip": ip, "port": port}
+            else:
+                info = self._pending.get(username)
+                if info is None:
+                    return False
+            self._update("_connected", username, info)
+            self._update("_endpoints", (info["ip"], info["port"]), username)
+            self._update("_pending", username)
+            return True
+
+    def disconnect(self, username, expected=None):
+        """Forget a connected peer and its key, returning its endpoint info or None
+
+        With expected, only a peer still connected through that very info is removed.
+        """
+        with self.lock:
+            info = self._connected.get(username)
+            if info is None or (expected is not None and info is not expected):
+                return None
+            self._update("_connected", username)
+            if self._endpoints.get((info["ip"], info["port"])) == username:
+                self._update("_endpoints", (info["ip"], info["port"]))
+            self._update("_keys", username)
+            return info
+
+    def clear(self):
+        with self.lock:
+            self._connected = {}
+            self._endpoints = {}
+            self._pending = {}
+            self._keys = {}
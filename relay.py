@@ -0,0 +1,234 @@
+import os
+import signal
+import zmq
+from encryption import verify_signature
+
+# Frames are [command, username, payload]; payloads are opaque to the relay
+REGISTER = b"REGISTER"  # Payload is the client's PEM public key
+CHALLENGE = b"CHALLENGE"  # Payload is a nonce the client must sign
+PROVE = b"PROVE"  # Payload is the signature over registration_payload()
+REGISTERED = b"REGISTERED"
+SEND = b"SEND"
+DELIVER = b"DELIVER"
+UNKNOWN = b"UNKNOWN"  # The recipient isn't registered
+BUSY = b"BUSY"  # The recipient isn't reading fast enough; try again later
+ERROR = b"ERROR"
+
+# Plain ints: pyzmq's flag enums cost more than the send itself at relay rates
+MORE = int(zmq.SNDMORE | zmq.NOBLOCK)
+LAST = int(zmq.NOBLOCK)
+
+RELAY_BATCH = 1000  # Messages handled per wakeup before checking whether to stop
+POLL_INTERVAL = 1000  # Milliseconds between checks of running while idle
+MAX_CHALLENGES = 10000  # Registrations waiting for a signature; the oldest are dropped past this
+
+
+def registration_payload(username, nonce):
+    """What a client signs to claim a username on a relay"""
+    return b"relay-register|" + username + b"|" + nonce
+
+
+class RelayServer:
+    """Forwards opaque envelopes between clients registered by username
+
+    One ROUTER socket serves every client, so thousands of connections cost one thread.
+    A username is bound to the key that first registered it, for as long as the relay runs;
+    registering again, e.g. from a new address, needs a signature from that same key.
+    """
+
+    def __init__(self, port=5600, bind_address="*", context=None):
+        self.context = context or zmq.Context.instance()
+        self.socket = self.context.socket(zmq.ROUTER)
+        # Report unroutable clients instead of silently dropping what is sent to them
+        self.socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(f"tcp://{bind_address}:{port}")
+        self.port = port
+        self.routes = {}  # username -> routing id
+        self.usernames = {}  # routing id -> username
+        self.keys = {}  # username -> PEM public key it is bound to
+        self.challenges = {}  # routing id -> (username, PEM public key, nonce) awaiting PROVE
+        self.forwarded = 0
+        self.dropped = 0
+        self.running = True
+
+    def serve(self):
+        """Forward messages until stop() is called"""
+        while self.running:
+            if self.socket.poll(timeout=POLL_INTERVAL) == 0:
+                continue
+            # Drain what has arrived before polling again
+            for _ in range(RELAY_BATCH):
+                try:
+                    frames = self._recv_frames()
+                except zmq.error.Again:
+                    break
+                try:
+                    self._handle(frames)
+                except Exception as e:
+                    print(f"Error relaying message: {e}")
+        self.socket.close(linger=0)
+
+    def _recv_frames(self):
+        """One message as frames, reading each frame's more flag instead of asking the socket"""
+        frame = self.socket.recv(LAST, copy=False)
+        frames = [frame]
+        while frame.more:
+            frame = self.socket.recv(LAST, copy=False)
+            frames.append(frame)
+        return frames
+
+    def _handle(self, frames):
+        routing_id = frames[0].bytes
+        command = frames[1].bytes if len(frames) > 1 else b""
+
+        if command == SEND and len(frames) == 4:
+            sender = self.usernames.get(routing_id)
+            if sender is None:
+                self._reply(routing_id, ERROR, b"not registered")
+                return
+            recipient = frames[2].bytes
+            target = self.routes.get(recipient)
+            if target is None:
+                self.dropped += 1
+                self._reply(routing_id, UNKNOWN, recipient)
+                return
+            try:
+                # Unroutable or full recipients fail on the first frame, so nothing partial is sent
+                send = self.socket.send
+                send(target, MORE)
+                send(DELIVER, MORE)
+                send(sender, MORE)
+                # The payload frame is passed on without being copied
+                send(frames[3], LAST, copy=False)
+                self.forwarded += 1
+            except zmq.error.Again:
+                self.dropped += 1
+                self._reply(routing_id, BUSY, recipient)
+            except zmq.error.ZMQError as e:
+                if e.errno != zmq.EHOSTUNREACH:
+                    raise
+                # The recipient went away without unregistering
+                self._forget(target)
+                self.dropped += 1
+                self._reply(routing_id, UNKNOWN, recipient)
+        elif command == REGISTER and len(frames) == 4:
+            username = frames[2].bytes
+            public_key = frames[3].bytes.decode(errors="replace")
+            pinned = self.keys.get(username)
+            if pinned is not None and pinned != public_key:
+                self._reply(routing_id, ERROR, b"username taken")
+                return
+            nonce = os.urandom(16)
+            self.challenges.pop(routing_id, None)
+            if len(self.challenges) >= MAX_CHALLENGES:
+                del self.challenges[next(iter(self.challenges))]
+            self.challenges[routing_id] = (username, public_key, nonce)
+            self._reply(routing_id, CHALLENGE, username, nonce)
+        elif command == PROVE and len(frames) == 4:
+            username = frames[2].bytes
+            challenge = self.challenges.pop(routing_id, None)
+            if challenge is None or challenge[0] != username:
+                self._reply(routing_id, ERROR, b"no registration pending")
+                return
+            _, public_key, nonce = challenge
+            signature = frames[3].bytes.decode(errors="replace")
+            if not verify_signature(public_key, registration_payload(username, nonce), signature):
+                self._reply(routing_id, ERROR, b"bad signature")
+                return
+            # Another key may have claimed the name while this one was signing
+            if self.keys.setdefault(username, public_key) != public_key:
+                self._reply(routing_id, ERROR, b"username taken")
+                return
+            # Only the key holder gets here, so a client that reconnects from a new address takes over
+            previous = self.routes.get(username)
+            if previous is not None and previous != routing_id:
+                self.usernames.pop(previous, None)
+            self._forget(routing_id)
+            self.routes[username] = routing_id
+            self.usernames[routing_id] = username
+            print(f"{username.decode(errors='replace')} registered")
+            self._reply(routing_id, REGISTERED, username)
+        else:
+            self._reply(routing_id, ERROR, b"bad request")
+
+    def _forget(self, routing_id):
+        username = self.usernames.pop(routing_id, None)
+        if username is not None and self.routes.get(username) == routing_id:
+            del self.routes[username]
+
+    def _reply(self, routing_id, command, argument, payload=b""):
+        try:
+            self.socket.send_multipart([routing_id, command, argument, payload], flags=zmq.NOBLOCK)
+        except zmq.error.ZMQError:
+            # A client that can't take a reply can't take anything else either
+            self._forget(routing_id)
+
+    def stop(self):
+        self.running = False
+
+
+class RelayClient:
+    """A connection to a relay, sending and receiving envelopes by username
+
+    encryption holds the key the username is bound to on the relay (an RSAEncryption).
+    """
+
+    def __init__(self, endpoint, username, encryption, context=None):
+        self.context = context or zmq.Context.instance()
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(endpoint)
+        self.username = username
+        self.encryption = encryption
+
+    def register(self, timeout=5000):
+        """Claim our username on the relay, proving we hold its key, returning whether it confirmed in time"""
+        username = self.username.encode()
+        self.socket.send_multipart([REGISTER, username, self.encryption.get_public_key_pem().encode()])
+        reply = self.recv(timeout)
+        if reply is None or reply[0] != CHALLENGE:
+            return False
+        signature = self.encryption.sign(registration_payload(username, reply[2]))
+        self.socket.send_multipart([PROVE, username, signature.encode()])
+        reply = self.recv(timeout)
+        return reply is not None and reply[0] == REGISTERED
+
+    def send(self, recipient, payload):
+        """Queue bytes for a registered user; delivery failures come back through recv
+
+        Never blocks: raises zmq.error.Again if too much is already queued for the relay.
+        """
+        send = self.socket.send
+        send(SEND, MORE)
+        send(recipient.encode(), MORE)
+        send(payload, LAST)
+
+    def recv(self, timeout=None):
+        """The next (command, username, payload) from the relay, or None on timeout
+
+        DELIVER carries the sender's name; UNKNOWN and BUSY name the recipient that failed.
+        """
+        if timeout is not None and self.socket.poll(timeout=timeout) == 0:
+            return None
+        command, username, payload = self.socket.recv_multipart()
+        return command, username.decode(errors="replace"), payload
+
+    def close(self):
+        self.socket.close(linger=0)
+
+
+def run_relay(port):
+    """Serve as a relay until SIGINT or SIGTERM, returning an exit code"""
+    try:
+        server = RelayServer(port)
+    except zmq.error.ZMQError as e:
+        print(f"Could not start relay on port {port}: {e}")
+        return 1
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: server.stop())
+
+    print(f"Relay listening on port {port}")
+    server.serve()
+    print(f"Relay stopped after forwarding {server.forwarded} messages ({server.dropped} undeliverable)")
+    return 0
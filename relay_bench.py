@@ -0,0 +1,103 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import struct
+import sys
+import tempfile
+import time
+import zmq
+from encryption import RSAEncryption
+from relay import RelayServer, RelayClient, DELIVER
+
+STALL_TIMEOUT = 5000  # Milliseconds without any delivery before the run is abandoned
+
+
+def _serve(port):
+    # The relay gets its own process, and so its own core, as it would in a deployment
+    sys.stdout = open(os.devnull, "w")
+    RelayServer(port, "127.0.0.1", zmq.Context()).serve()
+
+
+def run_benchmark(clients=1000, messages=200000, size=256, window=2000, port=5601):
+    """Push messages between many clients through a relay, returning (rate, p50, p99, relay_cpu)
+
+    The rate is in messages per second, the latencies in milliseconds and relay_cpu is the relay
+    process's CPU time per message in microseconds. When the driver and the relay share a core the
+    rate is bounded by the driver; relay_cpu shows what the relay alone could sustain.
+    """
+    server = multiprocessing.Process(target=_serve, args=(port,), daemon=True)
+    server.start()
+    context = zmq.Context()
+    context.set(zmq.MAX_SOCKETS, clients + 16)
+    # Usernames are bound to keys, not the other way round, so every client can share one
+    encryption = RSAEncryption()
+    with tempfile.TemporaryDirectory() as key_dir:
+        encryption.load_or_generate_keys(os.path.join(key_dir, "identity.pem"))
+    nodes = [RelayClient(f"tcp://127.0.0.1:{port}", f"client{i}", encryption, context) for i in range(clients)]
+    try:
+        poller = zmq.Poller()
+        for node in nodes:
+            if not node.register(STALL_TIMEOUT):
+                raise RuntimeError(f"{node.username} could not register")
+            poller.register(node.socket, zmq.POLLIN)
+
+        padding = b"\0" * max(0, size - 8)
+        latencies = []
+        failed = 0
+        sent = 0
+        received = 0
+        started = time.perf_counter()
+        while received < messages:
+            # Keep a bounded number of messages in flight so no queue overflows
+            while sent < messages and sent - received < window:
+                sender = nodes[sent % clients]
+                recipient = nodes[(sent + 1) % clients]
+                sender.send(recipient.username, struct.pack("d", time.perf_counter()) + padding)
+                sent += 1
+
+            events = poller.poll(STALL_TIMEOUT)
+            if not events:
+                raise RuntimeError(f"no deliveries for {STALL_TIMEOUT} ms after {received} messages")
+            for sock, _ in events:
+                while True:
+                    try:
+                        command, _, payload = sock.recv_multipart(flags=zmq.NOBLOCK)
+                    except zmq.error.Again:
+                        break
+                    received += 1
+                    if command == DELIVER:
+                        latencies.append(time.perf_counter() - struct.unpack("d", payload[:8])[0])
+                    else:
+                        failed += 1
+        elapsed = time.perf_counter() - started
+    finally:
+        for node in nodes:
+            node.close()
+        context.term()
+        server.terminate()
+        server.join()
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    relay_cpu = (usage.ru_utime + usage.ru_stime) / messages * 1e6
+
+    if failed:
+        print(f"{failed} messages were not delivered")
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0.0
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0.0
+    return messages / elapsed, p50, p99, relay_cpu
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Relay throughput benchmark')
+    parser.add_argument('--clients', type=int, default=1000, help='Number of connected clients')
+    parser.add_argument('--messages', type=int, default=200000, help='Messages to relay in total')
+    parser.add_argument('--size', type=int, default=256, help='Payload size in bytes')
+    parser.add_argument('--window', type=int, default=2000, help='Most messages in flight at once')
+    parser.add_argument('--port', type=int, default=5601, help='Port for the benchmark relay')
+    args = parser.parse_args()
+
+    rate, p50, p99, relay_cpu = run_benchmark(args.clients, args.messages, args.size, args.window, args.port)
+    print(f"{args.clients} clients, {args.messages} messages of {args.size} bytes")
+    print(f"  {rate:,.0f} msgs/s ({rate * args.size / 1e6:.1f} MB/s), latency p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+    print(f"  relay CPU {relay_cpu:.1f} us per message, about {1e6 / relay_cpu:,.0f} msgs/s on a core of its own")
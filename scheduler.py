@@ -0,0 +1,159 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+import zmq
+
+# Priority classes, lower values are sent first
+CONTROL = 0  # Key exchange, disconnect and other protocol traffic
+CHAT = 1  # Interactive messages
+BULK = 2  # File chunks
+
+
+class TokenBucket:
+    """Token bucket capping bulk traffic in bytes per second"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate  # Bytes per second, 0 disables the cap
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def delay(self, size):
+        """Seconds to wait before size bytes may be sent"""
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            self._refill()
+            # Anything bigger than the burst only has to wait for a full bucket
+            needed = min(size, self.burst)
+            if self.tokens >= needed:
+                return 0.0
+            return (needed - self.tokens) / self.rate
+
+    def consume(self, size):
+        """Take size bytes worth of tokens, going into debt if needed"""
+        if not self.rate:
+            return
+        with self.lock:
+            self._refill()
+            self.tokens -= size
+
+
+class PeerScheduler:
+    """Sends requests to one peer from a single thread, highest priority first"""
+
+    def __init__(self, context, endpoint, bulk_bucket=None, timeout=5000, heartbeat=0):
+        self.context = context
+        self.endpoint = endpoint
+        self.bulk_bucket = bulk_bucket
+        self.timeout = timeout
+        self.heartbeat = heartbeat  # Milliseconds between transport-level pings, 0 for none
+        self.socket = None
+        self.last_reply = 0.0  # time.monotonic() of the last reply from the peer
+
+        self.queue = []  # Heap of (priority, sequence, job, size, future)
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, priority, job, size=0):
+        """Queue job(scheduler) to run on the peer thread, returning a Future for its result"""
+        future = Future()
+        with self.condition:
+            if not self.running:
+                future.set_exception(RuntimeError(f"Scheduler for {self.endpoint} is stopped"))
+                return future
+            heapq.heappush(self.queue, (priority, next(self.sequence), job, size, future))
+            self.condition.notify()
+        return future
+
+    def request(self, message):
+        """Send one request and return the reply; only call this from a job"""
+        if self.socket is None:
+            self.socket = self.context.socket(zmq.REQ)
+            self.socket.setsockopt(zmq.RCVTIMEO, self.timeout)
+            self.socket.setsockopt(zmq.LINGER, 0)
+            if self.heartbeat:
+                # ZMTP pings drop a dead connection so it is re-established, even with no request pending
+                self.socket.setsockopt(zmq.HEARTBEAT_IVL, self.heartbeat)
+                self.socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, self.heartbeat * 3)
+            self.socket.connect(self.endpoint)
+
+        try:
+            self.socket.send_string(message)
+            reply = self.socket.recv_string()
+            self.last_reply = time.monotonic()
+            return reply
+        except zmq.error.ZMQError:
+            # A REQ socket can't recover from a lost reply, so start over with a new one
+            self._close_socket()
+            raise
+
+    def _close_socket(self):
+        if self.socket is not None:
+            self.socket.close(linger=0)
+            self.socket = None
+
+    def _next_job(self):
+        """Wait for the next job that is allowed to run, or None once stopped"""
+        with self.condition:
+            while self.running:
+                if not self.queue:
+                    self.condition.wait()
+                    continue
+
+                priority, _, job, size, future = self.queue[0]
+                if priority == BULK and self.bulk_bucket:
+                    delay = self.bulk_bucket.delay(size)
+                    if delay > 0:
+                        # Wait for tokens, but wake early if something more urgent is queued
+                        self.condition.wait(delay)
+                        continue
+
+                heapq.heappop(self.queue)
+                return priority, job, size, future
+            return None
+
+    def _run(self):
+        while True:
+            next_job = self._next_job()
+            if next_job is None:
+                break
+
+            priority, job, size, future = next_job
+            if priority == BULK and self.bulk_bucket:
+                self.bulk_bucket.consume(size)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(job(self))
+            except Exception as e:
+                future.set_exception(e)
+
+        # Fail whatever is still queued and release the socket from this thread
+        self._close_socket()
+        with self.condition:
+            pending, self.queue = self.queue, []
+        for _, _, _, _, future in pending:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RuntimeError(f"Scheduler for {self.endpoint} is stopped"))
+
+    def stop(self, wait=True):
+        """Stop the scheduler thread after the job in progress"""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if wait and threading.current_thread() is not self.thread:
+            self.thread.join(timeout=self.timeout / 1000 + 1)
@@ -0,0 +1,48 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Taken as early as possible; main.py imports this module first
+PROCESS_START = time.perf_counter()
+
+
+class StartupTimer:
+    """Records when each startup stage began and ended, relative to launch"""
+
+    def __init__(self, start=PROCESS_START):
+        self.start = start
+        self.stages = {}  # name -> (started, finished) in seconds since start
+        self.lock = threading.Lock()
+
+    def mark(self, name):
+        """Record an instant, such as the first paint; only the first call counts"""
+        now = time.perf_counter() - self.start
+        with self.lock:
+            self.stages.setdefault(name, (now, now))
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block, which may run on any thread"""
+        started = time.perf_counter() - self.start
+        try:
+            yield
+        finally:
+            finished = time.perf_counter() - self.start
+            with self.lock:
+                self.stages[name] = (started, finished)
+
+    def has(self, *names):
+        with self.lock:
+            return all(name in self.stages for name in names)
+
+    def report(self):
+        """Stages in the order they finished, as printable lines"""
+        with self.lock:
+            stages = sorted(self.stages.items(), key=lambda item: item[1][1])
+        lines = ["Startup timings (ms since launch):"]
+        for name, (started, finished) in stages:
+            if finished > started:
+                lines.append(f"  {name:<14} {finished * 1000:8.1f}  (took {(finished - started) * 1000:.1f})")
+            else:
+                lines.append(f"  {name:<14} {finished * 1000:8.1f}")
+        return "\n".join(lines)
@@ -0,0 +1,325 @@
+import hashlib
+import itertools
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# Most rows written in one transaction; appends queued meanwhile go into the next one
+WRITE_BATCH_SIZE = 5000
+
+# A batch that fails is tried this many more times, waiting twice as long each time, before it is reported
+WRITE_RETRIES = 3
+WRITE_RETRY_DELAY = 0.1
+
+# Rows returned by one page() call unless asked otherwise
+PAGE_SIZE = 100
+
+NONCE_SIZE = 12
+
+# Words as the search index sees them
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# Hashed words remembered by the writer; chat vocabulary repeats a lot
+TERM_CACHE_SIZE = 100000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    peer TEXT NOT NULL,
+    username TEXT NOT NULL,
+    is_self INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    nonce BLOB NOT NULL,
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_peer_time ON messages (peer, timestamp, id);
+
+-- Contentless full-text index over keyed hashes of each word, so it reveals no plaintext
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(body, peer, content='');
+CREATE TABLE IF NOT EXISTS search_state (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    indexed_upto INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO search_state (id, indexed_upto) VALUES (0, 0);
+"""
+
+
+def load_store_key(path):
+    """Read the AES-256 key protecting message bodies, creating it on first use"""
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    key = AESGCM.generate_key(bit_length=256)
+    # Readable by the owner only
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+
+class MessageStore:
+    """Chat history in SQLite (WAL), with message bodies encrypted with AES-GCM
+
+    The key is kept in a file next to the database, so encryption only protects the history
+    when the database is copied without it, e.g. in a backup or a synced folder.
+
+    on_error(ids, error) is called on the writer thread with the ids of messages that could
+    not be written, even after retrying.
+    """
+
+    def __init__(self, path, key=None, on_error=None):
+        self.path = path
+        self.on_error = on_error
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        key = key or load_store_key(os.path.splitext(path)[0] + ".key")
+        self.aead = AESGCM(key)
+        self.search_key = hashlib.blake2b(b"search index", key=key, digest_size=32).digest()
+        self.term_cache = {}
+
+        # Readers get their own connection; WAL lets them run alongside the writer
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+        self.reader.execute("PRAGMA journal_mode=WAL")
+        self.reader.executescript(SCHEMA)
+        self.reader_lock = threading.Lock()
+
+        # Ids are handed out on append so callers can page from a message before it is written
+        max_id = self.reader.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0
+        self.ids = itertools.count(max_id + 1)
+        self.ids_lock = threading.Lock()
+
+        self.queue = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def append(self, peer, username, text, is_self, timestamp):
+        """Queue a message for writing and return its id"""
+        return self.append_many([(peer, username, text, is_self, timestamp)])[0]
+
+    def append_many(self, messages):
+        """Queue (peer, username, text, is_self, timestamp) tuples, returning their ids"""
+        with self.ids_lock:
+            ids = [next(self.ids) for _ in messages]
+        for message_id, message in zip(ids, messages):
+            self.queue.put((message_id,) + tuple(message))
+        return ids
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far is committed"""
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def _encrypt(self, message_id, peer, text):
+        nonce = os.urandom(NONCE_SIZE)
+        # Binding the id and peer stops rows from being swapped between conversations
+        return nonce, self.aead.encrypt(nonce, text.encode(), f"{message_id}:{peer}".encode())
+
+    def _decrypt(self, message_id, peer, nonce, body):
+        return self.aead.decrypt(nonce, body, f"{message_id}:{peer}".encode()).decode()
+
+    def _term(self, token):
+        return hashlib.blake2b(token.encode(), key=self.search_key, digest_size=8).hexdigest()
+
+    def _index_terms(self, text):
+        """The hashed words of a message body, in order"""
+        cache = self.term_cache
+        terms = []
+        for token in TOKEN_PATTERN.findall(text.lower()):
+            term = cache.get(token)
+            if term is None:
+                if len(cache) >= TERM_CACHE_SIZE:
+                    cache.clear()
+                term = cache[token] = self._term(token)
+            terms.append(term)
+        return " ".join(terms)
+
+    def _peer_term(self, peer):
+        # Prefixed so a peer name never matches the same word in a message body
+        return self._term("peer:" + peer)
+
+    def _index_backlog(self, connection):
+        """Index rows written before the search index existed"""
+        indexed_upto = connection.execute("SELECT indexed_upto FROM search_state").fetchone()[0]
+        while True:
+            rows = connection.execute(
+                "SELECT id, peer, nonce, body FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+                (indexed_upto, WRITE_BATCH_SIZE)
+            ).fetchall()
+            if not rows:
+                return
+            entries = []
+            for message_id, peer, nonce, body in rows:
+                try:
+                    text = self._decrypt(message_id, peer, nonce, body)
+                except Exception:
+                    continue
+                entries.append((message_id, self._index_terms(text), self._peer_term(peer)))
+            indexed_upto = rows[-1][0]
+            with connection:
+                connection.executemany("INSERT INTO messages_fts (rowid, body, peer) VALUES (?, ?, ?)", entries)
+                connection.execute("UPDATE search_state SET indexed_upto = ?", (indexed_upto,))
+
+    def _write_loop(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # WAL with NORMAL sync survives application crashes, only an OS crash can lose the last commits
+        connection.execute("PRAGMA synchronous=NORMAL")
+        self._index_backlog(connection)
+
+        running = True
+        while running:
+            # Block for the first item, then take whatever else is already queued
+            items = [self.queue.get()]
+            while len(items) < WRITE_BATCH_SIZE:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            rows = []
+            entries = []
+            waiters = []
+            for item in items:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    message_id, peer, username, text, is_self, timestamp = item
+                    nonce, body = self._encrypt(message_id, peer, text)
+                    rows.append((message_id, peer, username, int(is_self), timestamp, nonce, body))
+                    entries.append((message_id, self._index_terms(text), self._peer_term(peer)))
+
+            if rows:
+                self._write_batch(connection, rows, entries)
+            for waiter in waiters:
+                waiter.set()
+
+        connection.close()
+
+    def _write_batch(self, connection, rows, entries):
+        """Commit a batch, retrying it if it fails; the ids were handed out already, so it isn't dropped quietly"""
+        delay = WRITE_RETRY_DELAY
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                with connection:
+                    connection.executemany(
+                        "INSERT INTO messages (id, peer, username, is_self, timestamp, nonce, body) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        rows
+                    )
+                    # Indexed in the same transaction, so search never lags behind the history
+                    connection.executemany(
+                        "INSERT INTO messages_fts (rowid, body, peer) VALUES (?, ?, ?)",
+                        entries
+                    )
+                    connection.execute("UPDATE search_state SET indexed_upto = MAX(indexed_upto, ?)",
+                                       (rows[-1][0],))
+                return
+            except sqlite3.Error as e:
+                error = e
+                print(f"Error writing {len(rows)} messages (attempt {attempt + 1}): {e}")
+            if attempt < WRITE_RETRIES:
+                time.sleep(delay)
+                delay *= 2
+
+        if self.on_error is not None:
+            try:
+                self.on_error([row[0] for row in rows], error)
+            except Exception as e:
+                print(f"Error reporting failed write: {e}")
+
+    def page(self, peer, before=None, limit=PAGE_SIZE, after=None):
+        """Messages with a peer older than the (timestamp, id) cursor, oldest first
+
+        With after instead, the messages newer than that cursor. Rows come back as
+        (id, username, text, is_self, timestamp) tuples.
+        """
+        if after is not None:
+            query = ("SELECT id, username, is_self, timestamp, nonce, body FROM messages "
+                     "WHERE peer = ? AND (timestamp, id) > (?, ?) ORDER BY timestamp, id LIMIT ?")
+            params = (peer, after[0], after[1], limit)
+        elif before is None:
+            query = ("SELECT id, username, is_self, timestamp, nonce, body FROM messages "
+                     "WHERE peer = ? ORDER BY timestamp DESC, id DESC LIMIT ?")
+            params = (peer, limit)
+        else:
+            query = ("SELECT id, username, is_self, timestamp, nonce, body FROM messages "
+                     "WHERE peer = ? AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?")
+            params = (peer, before[0], before[1], limit)
+
+        with self.reader_lock:
+            rows = self.reader.execute(query, params).fetchall()
+        if after is None:
+            rows.reverse()
+
+        messages = []
+        for message_id, username, is_self, timestamp, nonce, body in rows:
+            try:
+                text = self._decrypt(message_id, peer, nonce, body)
+            except Exception as e:
+                print(f"Error decrypting message {message_id}: {e}")
+                continue
+            messages.append((message_id, username, text, bool(is_self), timestamp))
+        return messages
+
+    def search(self, text, peer=None, since=None, until=None, limit=PAGE_SIZE, offset=0):
+        """Messages containing every word of text, best match first
+
+        Optionally limited to one peer and to timestamps in [since, until). Rows come back as
+        (id, peer, username, text, is_self, timestamp) tuples; pass offset to page through them.
+        """
+        terms = [f'"{self._term(token)}"' for token in TOKEN_PATTERN.findall(text.lower())]
+        if not terms:
+            return []
+        if peer is not None:
+            terms.append(f'"{self._peer_term(peer)}"')
+
+        query = ("SELECT m.id, m.peer, m.username, m.is_self, m.timestamp, m.nonce, m.body "
+                 "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                 "WHERE messages_fts MATCH ?")
+        params = [" AND ".join(terms)]
+        if since is not None:
+            query += " AND m.timestamp >= ?"
+            params.append(since)
+        if until is not None:
+            query += " AND m.timestamp < ?"
+            params.append(until)
+        # Only the body counts towards the rank; the peer column is just a filter
+        query += " ORDER BY bm25(messages_fts, 1.0, 0.0), m.timestamp DESC LIMIT ? OFFSET ?"
+        params.extend((limit, offset))
+
+        with self.reader_lock:
+            rows = self.reader.execute(query, params).fetchall()
+
+        results = []
+        for message_id, message_peer, username, is_self, timestamp, nonce, body in rows:
+            try:
+                message_text = self._decrypt(message_id, message_peer, nonce, body)
+            except Exception as e:
+                print(f"Error decrypting message {message_id}: {e}")
+                continue
+            results.append((message_id, message_peer, username, message_text, bool(is_self), timestamp))
+        return results
+
+    def peers(self):
+        """Every peer with stored messages, with the time of its latest one"""
+        with self.reader_lock:
+            return self.reader.execute(
+                "SELECT peer, MAX(timestamp) FROM messages GROUP BY peer"
+            ).fetchall()
+
+    def close(self):
+        """Write everything still queued and close the database"""
+        self.queue.put(None)
+        self.writer.join()
+        with self.reader_lock:
+            self.reader.close()
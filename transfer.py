@@ -0,0 +1,323 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# Size of each file chunk sent over the wire
+CHUNK_SIZE = 256 * 1024
+
+# Size of each in-kernel copy call when saving across filesystems
+COPY_BLOCK_SIZE = 8 * 1024 * 1024
+
+# Minimum time between progress updates sent to the UI
+PROGRESS_INTERVAL = 0.1
+
+# A transfer with no new bytes for this long is reported as stalled
+STALL_TIMEOUT = 3.0
+
+# Weight of the newest sample in the smoothed transfer rate
+RATE_SMOOTHING = 0.3
+
+
+class FileSpool:
+    """Managed temp area that incoming files are written into during transfer"""
+
+    def __init__(self, base_dir=None):
+        self.root = tempfile.mkdtemp(prefix="shadow-spool-", dir=base_dir)
+        self.transfers = {}  # transfer_id -> open transfer state
+        self.lock = threading.Lock()
+
+    def _transfer_path(self, transfer_id, filename):
+        """Build the spool path for a transfer, keeping the original filename"""
+        # Both come from the peer: the directory is named by a hash of the id, and only a plain
+        # last path component of the filename is kept, so nothing can land outside the spool
+        safe_name = os.path.basename(filename.replace("\\", "/"))
+        if safe_name in ("", ".", ".."):
+            safe_name = "received_file"
+        safe_id = hashlib.sha256(transfer_id.encode()).hexdigest()
+        return os.path.join(self.root, safe_id, safe_name)
+
+    def write_chunk(self, transfer_id, filename, size, offset, data):
+        """Write a chunk into the spool, returning the file path once the transfer is complete
+
+        Raises ValueError for a chunk that doesn't fit inside the declared size.
+        """
+        if not isinstance(size, int) or not isinstance(offset, int) or offset < 0 or offset + len(data) > size:
+            raise ValueError(f"Chunk at {offset} of {len(data)} bytes doesn't fit a {size} byte file")
+        with self.lock:
+            transfer = self.transfers.get(transfer_id)
+            if transfer is None:
+                # First chunk of this transfer, open the spool file
+                path = self._transfer_path(transfer_id, filename)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                transfer = {
+                    "path": path,
+                    "file": open(path + ".part", "wb"),
+                    "size": size,
+                    "received": 0
+                }
+                self.transfers[transfer_id] = transfer
+
+            if offset + len(data) > transfer["size"]:
+                raise ValueError(f"Chunk at {offset} runs past the {transfer['size']} bytes first declared")
+
+            # Write the chunk at its offset so chunks never have to be buffered
+            transfer["file"].seek(offset)
+            transfer["file"].write(data)
+            transfer["received"] += len(data)
+
+            if transfer["received"] < transfer["size"]:
+                return None
+
+            # Transfer complete, move the file to its final spool name
+            transfer["file"].close()
+            os.replace(transfer["path"] + ".part", transfer["path"])
+            del self.transfers[transfer_id]
+            return transfer["path"]
+
+    def discard(self, transfer_id):
+        """Drop a partially received transfer"""
+        with self.lock:
+            transfer = self.transfers.pop(transfer_id, None)
+        if transfer:
+            try:
+                transfer["file"].close()
+                os.remove(transfer["path"] + ".part")
+            except OSError as e:
+                print(f"Error discarding transfer {transfer_id}: {e}")
+
+    def cleanup(self):
+        """Close open transfers and remove the spool directory"""
+        with self.lock:
+            for transfer in self.transfers.values():
+                try:
+                    transfer["file"].close()
+                except OSError:
+                    pass
+            self.transfers.clear()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class TransferProgress:
+    """Bytes done, throughput and ETA for a single transfer"""
+
+    def __init__(self, transfer_id, username, filename, total, direction):
+        self.transfer_id = transfer_id
+        self.username = username
+        self.filename = filename
+        self.total = total
+        self.direction = direction  # "send" or "receive"
+        self.done = 0
+        self.rate = 0.0  # Smoothed bytes per second
+        self.finished = False
+        self.success = True
+        self.reported_stalled = False
+
+        now = time.monotonic()
+        self.last_progress_time = now
+        self.sample_time = now
+        self.sample_done = 0
+
+    def sample(self, now):
+        """Fold the bytes seen since the last sample into the smoothed rate"""
+        elapsed = now - self.sample_time
+        if elapsed <= 0:
+            return
+        instant_rate = (self.done - self.sample_done) / elapsed
+        if self.rate:
+            self.rate = RATE_SMOOTHING * instant_rate + (1 - RATE_SMOOTHING) * self.rate
+        else:
+            self.rate = instant_rate
+        self.sample_time = now
+        self.sample_done = self.done
+
+    def eta(self):
+        """Seconds left at the current rate, or -1 if unknown"""
+        if self.rate <= 0:
+            return -1.0
+        return max(self.total - self.done, 0) / self.rate
+
+    def is_stalled(self, now):
+        """Check whether the transfer has stopped making progress"""
+        return not self.finished and now - self.last_progress_time >= STALL_TIMEOUT
+
+    def to_dict(self, now):
+        """Snapshot of the transfer for the UI"""
+        return {
+            "transfer_id": self.transfer_id,
+            "username": self.username,
+            "filename": self.filename,
+            "direction": self.direction,
+            "done": self.done,
+            "total": self.total,
+            "rate": self.rate,
+            "eta": self.eta(),
+            "stalled": self.is_stalled(now),
+            "finished": self.finished,
+            "success": self.success
+        }
+
+
+class ProgressTracker:
+    """Collects per-chunk transfer progress and reports it at a bounded rate"""
+
+    def __init__(self, callback, interval=PROGRESS_INTERVAL):
+        self.callback = callback  # Called with one progress dict per changed transfer
+        self.interval = interval
+        self.transfers = {}  # transfer_id -> TransferProgress
+        self.dirty = set()  # Transfers updated since the last report
+        self.lock = threading.Lock()
+        self.flush_thread = None
+        self.running = True
+
+    def start(self, transfer_id, username, filename, total, direction):
+        """Begin tracking a transfer"""
+        with self.lock:
+            self.transfers[transfer_id] = TransferProgress(transfer_id, username, filename, total, direction)
+            self.dirty.add(transfer_id)
+            self._ensure_flush_thread()
+
+    def update(self, transfer_id, done):
+        """Record bytes done; cheap enough to call for every chunk"""
+        with self.lock:
+            progress = self.transfers.get(transfer_id)
+            if progress is None:
+                return
+            if done != progress.done:
+                progress.done = done
+                progress.last_progress_time = time.monotonic()
+            self.dirty.add(transfer_id)
+
+    def finish(self, transfer_id, success=True):
+        """Mark a transfer as done; it is reported once more and then dropped"""
+        with self.lock:
+            progress = self.transfers.get(transfer_id)
+            if progress is None:
+                return
+            progress.finished = True
+            progress.success = success
+            self.dirty.add(transfer_id)
+
+    def is_tracking(self, transfer_id):
+        with self.lock:
+            return transfer_id in self.transfers
+
+    def _ensure_flush_thread(self):
+        """Start the flush thread if it isn't running (called with the lock held)"""
+        if self.flush_thread is None or not self.flush_thread.is_alive():
+            self.flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+            self.flush_thread.start()
+
+    def _flush_loop(self):
+        """Report changed and stalled transfers every interval until none are left"""
+        while self.running:
+            time.sleep(self.interval)
+            for update in self.flush():
+                try:
+                    self.callback(update)
+                except Exception as e:
+                    print(f"Error reporting transfer progress: {e}")
+
+            with self.lock:
+                if not self.transfers:
+                    self.flush_thread = None
+                    return
+
+    def flush(self):
+        """Collect progress for every transfer that changed or stalled since the last flush"""
+        now = time.monotonic()
+        updates = []
+        with self.lock:
+            for transfer_id, progress in list(self.transfers.items()):
+                # Stalls are reported when they start, not on every flush
+                stalled = progress.is_stalled(now)
+                if transfer_id not in self.dirty and stalled == progress.reported_stalled:
+                    continue
+                progress.reported_stalled = stalled
+                progress.sample(now)
+                updates.append(progress.to_dict(now))
+                if progress.finished:
+                    del self.transfers[transfer_id]
+            self.dirty.clear()
+        return updates
+
+    def stop(self):
+        """Stop reporting progress"""
+        self.running = False
+
+
+def _sendfile_supports_files():
+    """Check whether sendfile can write to regular files on this platform"""
+    # Linux has supported file-to-file sendfile since 2.6.33; other platforms need a socket
+    return hasattr(os, "sendfile") and hasattr(os, "uname") and os.uname().sysname == "Linux"
+
+
+def _copy_file(src, dst, progress_callback=None):
+    """Copy src to dst using in-kernel copies where the platform supports them"""
+    total = os.path.getsize(src)
+    copied = 0
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        in_fd = fsrc.fileno()
+        out_fd = fdst.fileno()
+
+        # Prefer copy_file_range, then sendfile, then a plain read/write loop
+        use_copy_file_range = hasattr(os, "copy_file_range")
+        use_sendfile = _sendfile_supports_files()
+
+        while copied < total:
+            count = min(COPY_BLOCK_SIZE, total - copied)
+            sent = 0
+            if use_copy_file_range:
+                try:
+                    sent = os.copy_file_range(in_fd, out_fd, count, copied, copied)
+                except OSError:
+                    use_copy_file_range = False
+                    continue
+            elif use_sendfile:
+                try:
+                    os.lseek(out_fd, copied, os.SEEK_SET)
+                    sent = os.sendfile(out_fd, in_fd, copied, count)
+                except OSError:
+                    use_sendfile = False
+                    continue
+            else:
+                fsrc.seek(copied)
+                fdst.seek(copied)
+                block = fsrc.read(count)
+                fdst.write(block)
+                fdst.flush()
+                sent = len(block)
+
+            if sent == 0:
+                # Source shrank underneath us
+                break
+
+            copied += sent
+            if progress_callback:
+                progress_callback(copied, total)
+
+    shutil.copystat(src, dst)
+    return copied
+
+
+def save_received_file(src, dst, progress_callback=None):
+    """Move a spooled file to dst, renaming when possible and copying in-kernel otherwise"""
+    total = os.path.getsize(src)
+    dst_dir = os.path.dirname(os.path.abspath(dst))
+
+    # On the same filesystem a rename is instant whatever the file size
+    if os.stat(src).st_dev == os.stat(dst_dir).st_dev:
+        try:
+            os.replace(src, dst)
+            if progress_callback:
+                progress_callback(total, total)
+            return dst
+        except OSError as e:
+            print(f"Rename failed, falling back to copy: {e}")
+
+    _copy_file(src, dst, progress_callback)
+    os.remove(src)
+    return dst
@@ -1,88 +1,30 @@
 import sys
 import os
-from PyQt6.QtWidgets import (QApplication, QMainWindow, QPushButton, QTextEdit, 
+import time
+from PyQt6.QtWidgets import (QApplication, QMainWindow, QPushButton, 
                             QVBoxLayout, QWidget, QLineEdit, QLabel, QHBoxLayout,
-                            QDialog, QInputDialog, QMessageBox, QFileDialog, QSplitter,
-                            QListWidget, QListWidgetItem, QFrame, QMenu, QToolButton,
-                            QStyle, QStyleFactory, QScrollArea, QSizePolicy)
-from PyQt6.QtCore import Qt, QTimer, QSize, QPoint, pyqtSignal, QUrl
-from PyQt6.QtGui import (QTextCursor, QColor, QPalette, QFont, QIcon, QAction, QPixmap,
-                        QTextDocument, QPainter, QBrush, QPen)
+                            QDialog, QMessageBox, QFileDialog, QSplitter, QMenu, QToolButton,
+                            QStyle, QProgressDialog, QProgressBar, QComboBox, QAbstractItemView)
+from PyQt6.QtCore import Qt, QTimer, pyqtSignal, QUrl, QThread, QEvent
+from PyQt6.QtGui import QAction, QDesktopServices
 from network import MessengerNetwork
+from qt_bridge import QtNetworkBridge
+from chat_view import ChatView, ConversationModel, MessageListModel, ChatMessage
+from peer_list import PeerListModel, PeerFilterProxy, PeerListView
+from transfer import save_received_file
+from startup import StartupTimer
+from storage import MessageStore
+from config import load_config
 
-class MessageBubble(QFrame):
-    def __init__(self, message, is_self=True, parent=None):
-        super().__init__(parent)
-        self.is_self = is_self
-        self.message = message
-        self.init_ui()
-        
-    def init_ui(self):
-        # Set frame style
-        self.setFrameShape(QFrame.Shape.StyledPanel)
-        self.setFrameShadow(QFrame.Shadow.Raised)
-        
-        # Set background color based on sender
-        if self.is_self:
-            self.setStyleSheet("""
-                QFrame {
-                    background-color: #007AFF;
-                    border-radius: 15px;
-                    padding: 10px;
-                }
-            """)
-        else:
-            self.setStyleSheet("""
-                QFrame {
-                    background-color: #E9E9EB;
-                    border-radius: 15px;
-                    padding: 10px;
-                }
-            """)
-        
-        # Create layout
-        layout = QVBoxLayout(self)
-        layout.setContentsMargins(10, 5, 10, 5)
-        
-        # Add message label
-        message_label = QLabel(self.message)
-        message_label.setWordWrap(True)
-        message_label.setTextInteractionFlags(Qt.TextInteractionFlag.TextSelectableByMouse)
-        
-        # Set text color based on sender
-        if self.is_self:
-            message_label.setStyleSheet("color: white;")
-        else:
-            message_label.setStyleSheet("color: black;")
-        
-        layout.addWidget(message_label)
-        
-        # Set size policy
-        self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Minimum)
-        
-        # Set minimum width
-        self.setMinimumWidth(100)
-        
-        # Set maximum width
-        self.setMaximumWidth(400)
-        
-    def paintEvent(self, event):
-        painter = QPainter(self)
-        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
-        
-        # Set up painter
-        if self.is_self:
-            painter.setBrush(QBrush(QColor("#007AFF")))
-            painter.setPen(QPen(QColor("#007AFF")))
-        else:
-            painter.setBrush(QBrush(QColor("#E9E9EB")))
-            painter.setPen(QPen(QColor("#E9E9EB")))
-        
-        # Draw rounded rectangle
-        painter.drawRoundedRect(self.rect(), 15, 15)
-        
-        # Call parent paint event
-        super().paintEvent(event)
+# Search results fetched per page
+SEARCH_PAGE_SIZE = 50
+
+def format_size(num_bytes):
+    """Format a byte count for display"""
+    for unit in ("B", "KB", "MB", "GB"):
+        if num_bytes < 1024 or unit == "GB":
+            return f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
 
 class ConnectionRequestDialog(QDialog):
     def __init__(self, username, ip, port, parent=None):
@@ -161,12 +103,32 @@ class ConnectionRequestDialog(QDialog):
         self.result = False
         self.accept()
 
+class FileSaveWorker(QThread):
+    progress = pyqtSignal('qint64', 'qint64')  # bytes copied, total bytes; 64-bit, as files can pass 2 GiB
+    saved = pyqtSignal(bool, str)  # success, saved path or error
+
+    def __init__(self, source_path, target_path, parent=None):
+        super().__init__(parent)
+        self.source_path = source_path
+        self.target_path = target_path
+
+    def run(self):
+        # Move the spooled file off the UI thread
+        try:
+            save_received_file(self.source_path, self.target_path, self.progress.emit)
+            self.saved.emit(True, self.target_path)
+        except Exception as e:
+            print(f"Error saving file: {e}")
+            self.saved.emit(False, str(e))
+
 class FileReceivedDialog(QDialog):
     def __init__(self, username, filename, filepath, parent=None):
         super().__init__(parent)
         self.username = username
         self.filename = filename
         self.filepath = filepath
+        self.save_worker = None
+        self.progress_dialog = None
         self.init_ui()
         
     def init_ui(self):
@@ -224,7 +186,7 @@ class FileReceivedDialog(QDialog):
         
     def open_file(self):
         # Open the file with the default application
-        os.startfile(self.filepath) if sys.platform == 'win32' else os.system(f'xdg-open "{self.filepath}"')
+        QDesktopServices.openUrl(QUrl.fromLocalFile(self.filepath))
         self.accept()
         
     def save_file(self):
@@ -236,11 +198,37 @@ class FileReceivedDialog(QDialog):
             "All Files (*.*)"
         )
         
-        if save_path:
-            # Copy the file to the selected location
-            import shutil
-            shutil.copy2(self.filepath, save_path)
-            QMessageBox.information(self, "File Saved", f"File saved to {save_path}")
+        if not save_path:
+            self.accept()
+            return
+        
+        # Show progress while the file is moved in the background
+        self.progress_dialog = QProgressDialog(f"Saving {self.filename}...", None, 0, 100, self)
+        self.progress_dialog.setWindowTitle("Saving File")
+        self.progress_dialog.setMinimumDuration(500)
+        self.progress_dialog.setAutoClose(False)
+        
+        self.save_worker = FileSaveWorker(self.filepath, save_path, self)
+        self.save_worker.progress.connect(self.update_save_progress)
+        self.save_worker.saved.connect(self.handle_file_saved)
+        self.save_worker.start()
+        
+        # Prevent a second save while this one is running
+        for button in self.findChildren(QPushButton):
+            button.setEnabled(False)
+    
+    def update_save_progress(self, copied, total):
+        if self.progress_dialog and total:
+            self.progress_dialog.setValue(int(copied * 100 / total))
+    
+    def handle_file_saved(self, success, result):
+        if self.progress_dialog:
+            self.progress_dialog.close()
+        
+        if success:
+            QMessageBox.information(self, "File Saved", f"File saved to {result}")
+        else:
+            QMessageBox.warning(self, "Save Failed", f"Failed to save file: {result}")
         
         self.accept()
 
@@ -329,15 +317,176 @@ class SettingsDialog(QDialog):
         except ValueError:
             QMessageBox.warning(self, "Invalid Input", "Port must be a number.")
 
+class SearchDialog(QDialog):
+    # peer, store id
+    result_selected = pyqtSignal(str, int)
+    
+    # Label and age in seconds for each date filter
+    PERIODS = [
+        ("Any time", None),
+        ("Past day", 86400),
+        ("Past week", 7 * 86400),
+        ("Past month", 30 * 86400),
+        ("Past year", 365 * 86400),
+    ]
+    
+    def __init__(self, store, current_peer=None, parent=None):
+        super().__init__(parent)
+        self.store = store
+        self.current_peer = current_peer
+        self.offset = 0
+        self.init_ui()
+        
+    def init_ui(self):
+        self.setWindowTitle("Search Messages")
+        self.setStyleSheet("""
+            QDialog {
+                background-color: #F2F2F7;
+            }
+            QLineEdit, QComboBox {
+                padding: 6px;
+                border: 1px solid #C7C7CC;
+                border-radius: 8px;
+                background-color: white;
+                font-size: 14px;
+            }
+            QPushButton {
+                background-color: #007AFF;
+                color: white;
+                border: none;
+                border-radius: 8px;
+                padding: 8px 16px;
+                font-size: 14px;
+            }
+            QPushButton:disabled {
+                background-color: #C7C7CC;
+            }
+        """)
+        
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(15, 15, 15, 15)
+        
+        # Query and filters
+        self.query_input = QLineEdit()
+        self.query_input.setPlaceholderText("Search messages...")
+        self.query_input.returnPressed.connect(self.run_search)
+        layout.addWidget(self.query_input)
+        
+        filter_layout = QHBoxLayout()
+        self.scope_input = QComboBox()
+        self.set_current_peer(self.current_peer)
+        self.scope_input.currentIndexChanged.connect(self.run_search)
+        filter_layout.addWidget(self.scope_input)
+        
+        self.period_input = QComboBox()
+        for label, age in self.PERIODS:
+            self.period_input.addItem(label, age)
+        self.period_input.currentIndexChanged.connect(self.run_search)
+        filter_layout.addWidget(self.period_input)
+        layout.addLayout(filter_layout)
+        
+        # Results, best match first; double-click one to open it in its conversation
+        self.results = MessageListModel(self)
+        self.result_peers = []
+        self.results_view = ChatView()
+        self.results_view.setModel(self.results)
+        self.results_view.doubleClicked.connect(self.open_result)
+        layout.addWidget(self.results_view)
+        
+        bottom_layout = QHBoxLayout()
+        self.status_label = QLabel()
+        bottom_layout.addWidget(self.status_label, 1)
+        self.more_button = QPushButton("More Results")
+        self.more_button.setEnabled(False)
+        self.more_button.clicked.connect(self.load_more)
+        bottom_layout.addWidget(self.more_button)
+        layout.addLayout(bottom_layout)
+        
+        self.resize(500, 600)
+        
+    def set_current_peer(self, peer):
+        # The scope can be narrowed to the conversation that is open
+        self.current_peer = peer
+        self.scope_input.blockSignals(True)
+        self.scope_input.clear()
+        self.scope_input.addItem("All conversations", None)
+        if peer:
+            self.scope_input.addItem(f"Only {peer}", peer)
+        self.scope_input.blockSignals(False)
+        
+    def run_search(self):
+        self.results.clear()
+        self.result_peers = []
+        self.offset = 0
+        self.load_more()
+        
+    def load_more(self):
+        query = self.query_input.text().strip()
+        if not query:
+            self.status_label.clear()
+            self.more_button.setEnabled(False)
+            return
+        
+        age = self.period_input.currentData()
+        since = time.time() - age if age else None
+        rows = self.store.search(query, peer=self.scope_input.currentData(), since=since,
+                                 limit=SEARCH_PAGE_SIZE, offset=self.offset)
+        self.offset += SEARCH_PAGE_SIZE
+        
+        messages = []
+        for store_id, peer, username, text, is_self, timestamp in rows:
+            # Say which conversation each result comes from
+            if is_self:
+                label = f"{username} to {peer}"
+            elif username != peer:
+                label = f"{username} in {peer}"
+            else:
+                label = username
+            messages.append(ChatMessage(label, text, is_self, timestamp, store_id=store_id))
+            self.result_peers.append(peer)
+        self.results.append_messages(messages)
+        
+        count = len(self.results.messages)
+        self.status_label.setText(f"{count} result{'s' if count != 1 else ''}")
+        self.more_button.setEnabled(len(rows) == SEARCH_PAGE_SIZE)
+        
+    def open_result(self, index):
+        message = self.results.messages[index.row()]
+        self.result_selected.emit(self.result_peers[index.row()], message.store_id)
+
+
 class ChatApp(QMainWindow):
-    def __init__(self, port=5555, username="Anonymous"):
+    history_write_failed = pyqtSignal(int, str)  # messages not saved, error
+
+    def __init__(self, port=5555, username="Anonymous", startup_timer=None, startup_report=False):
         super().__init__()
         self.port = port
         self.username = username
         self.network = None
+        self.startup_timer = startup_timer or StartupTimer()
+        self.startup_report = startup_report
+        self.config = load_config()
         self.current_peer = None
-        self.message_bubbles = {}  # Store message bubbles
+        self.conversations = {}  # peer username -> ConversationModel, None for messages with no peer
+        self.active_transfers = {}  # transfer_id -> latest progress snapshot
+        self.discovered_only = set()  # Peers listed only because their LAN beacons were seen
+        
+        # Inbound messages are applied in frame-sized batches
+        self.inbound_messages = []
+        self.inbound_timer = QTimer(self)
+        self.inbound_timer.setSingleShot(True)
+        self.inbound_timer.setInterval(16)
+        self.inbound_timer.timeout.connect(self.flush_inbound_messages)
+        
+        # Chat history survives restarts; writes happen on the store's own thread
+        with self.startup_timer.stage("store"):
+            self.store = MessageStore(
+                self.config["storage"]["path"],
+                on_error=lambda ids, error: self.history_write_failed.emit(len(ids), str(error)))
+        self.history_write_failed.connect(self.handle_history_write_failed)
+        
         self.init_ui()
+        self.load_stored_peers()
         self.init_network()
         
     def init_ui(self):
@@ -347,20 +496,12 @@ class ChatApp(QMainWindow):
             QMainWindow {
                 background-color: #F2F2F7;
             }
-            QListWidget {
+            QListView#peerList {
                 background-color: #F2F2F7;
                 border: none;
                 font-size: 14px;
             }
-            QListWidget::item {
-                padding: 10px;
-                border-bottom: 1px solid #C7C7CC;
-            }
-            QListWidget::item:selected {
-                background-color: #E5E5EA;
-                color: black;
-            }
-            QTextEdit {
+            QListView#chatDisplay {
                 background-color: white;
                 border: none;
                 font-size: 14px;
@@ -437,15 +578,33 @@ class ChatApp(QMainWindow):
         
         sidebar_layout.addWidget(header)
         
-        # Create peer list
-        self.peer_list = QListWidget()
-        self.peer_list.itemClicked.connect(self.select_peer)
+        # Create peer search
+        search_area = QWidget()
+        search_layout = QHBoxLayout(search_area)
+        search_layout.setContentsMargins(8, 8, 8, 8)
+        self.peer_search = QLineEdit()
+        self.peer_search.setPlaceholderText("Search peers...")
+        self.peer_search.setClearButtonEnabled(True)
+        search_layout.addWidget(self.peer_search)
+        sidebar_layout.addWidget(search_area)
+        
+        # Create peer list, indexed by username and sorted by last activity
+        self.peer_model = PeerListModel(self)
+        self.peer_proxy = PeerFilterProxy(self.peer_model, self)
+        self.peer_search.textChanged.connect(self.peer_proxy.set_search)
+        self.peer_list = PeerListView()
+        self.peer_list.setObjectName("peerList")
+        self.peer_list.setModel(self.peer_proxy)
+        self.peer_list.clicked.connect(self.select_peer)
+        self.peer_list.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        self.peer_list.customContextMenuRequested.connect(self.show_peer_menu)
         sidebar_layout.addWidget(self.peer_list)
         
-        # Add connect button
-        connect_button = QPushButton("Connect to Peer")
-        connect_button.clicked.connect(self.show_connect_dialog)
-        sidebar_layout.addWidget(connect_button)
+        # Add connect button, enabled once the network is ready
+        self.connect_button = QPushButton("Connect to Peer")
+        self.connect_button.setEnabled(False)
+        self.connect_button.clicked.connect(self.show_connect_dialog)
+        sidebar_layout.addWidget(self.connect_button)
         
         # Create chat area
         chat_area = QWidget()
@@ -464,13 +623,26 @@ class ChatApp(QMainWindow):
         self.peer_name_label = QLabel("Select a peer to chat")
         self.peer_name_label.setStyleSheet("font-size: 18px; font-weight: bold;")
         chat_header_layout.addWidget(self.peer_name_label)
+        chat_header_layout.addStretch()
+        
+        # Add message search
+        search_button = QToolButton()
+        search_button.setIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_FileDialogContentsView))
+        search_button.setToolTip("Search Messages (Ctrl+F)")
+        search_button.clicked.connect(self.show_search_dialog)
+        chat_header_layout.addWidget(search_button)
+        search_action = QAction(self)
+        search_action.setShortcut("Ctrl+F")
+        search_action.triggered.connect(self.show_search_dialog)
+        self.addAction(search_action)
+        self.search_dialog = None
         
         chat_layout.addWidget(chat_header)
         
         # Create chat display
-        self.chat_display = QTextEdit()
-        self.chat_display.setReadOnly(True)
-        self.chat_display.setStyleSheet("background-color: white;")
+        self.chat_display = ChatView()
+        self.chat_display.setObjectName("chatDisplay")
+        self.chat_display.show_conversation(self.conversation_for(None))
         chat_layout.addWidget(self.chat_display)
         
         # Create input area
@@ -508,12 +680,26 @@ class ChatApp(QMainWindow):
         # Add splitter to main layout
         main_layout.addWidget(splitter)
         
+        # Create transfer status area
+        self.transfer_label = QLabel()
+        self.transfer_bar = QProgressBar()
+        self.transfer_bar.setFixedWidth(200)
+        self.transfer_bar.setRange(0, 100)
+        self.transfer_bar.hide()
+        self.statusBar().addWidget(self.transfer_label, 1)
+        self.statusBar().addPermanentWidget(self.transfer_bar)
+        
         # Set focus to message input
         self.message_input.setFocus()
         
     def init_network(self):
-        # Initialize network
-        self.network = MessengerNetwork(listen_port=self.port, username=self.username)
+        # Initialize network; keys, binding and address discovery finish in the background
+        self.connect_button.setEnabled(False)
+        self.statusBar().showMessage("Starting network...")
+        self.network = QtNetworkBridge(MessengerNetwork(listen_port=self.port, username=self.username,
+                                                        config=self.config,
+                                                        startup_timer=self.startup_timer), self)
+        self.network.network_ready.connect(self.handle_network_ready)
         
         # Connect signals
         self.network.message_received.connect(self.handle_message_received)
@@ -521,6 +707,19 @@ class ChatApp(QMainWindow):
         self.network.connection_request.connect(self.handle_connection_request)
         self.network.connection_status.connect(self.handle_connection_status)
         self.network.connection_closed.connect(self.handle_connection_closed)
+        self.network.transfer_progress.connect(self.handle_transfer_progress)
+        self.network.connection_progress.connect(self.handle_connection_progress)
+        self.network.message_sent.connect(self.handle_message_sent)
+        self.network.peer_key_changed.connect(self.handle_peer_key_changed)
+        self.network.peer_discovered.connect(self.handle_peer_discovered)
+        self.network.peer_lost.connect(self.handle_peer_lost)
+        
+        # Peers we have connected to before can be reconnected from the list
+        for username in list(self.network.directory.peers):
+            self.add_peer_to_list(username)
+        
+        # Start only once every signal is connected
+        self.network.start()
         
     def show_connect_dialog(self):
         # Create dialog
@@ -563,6 +762,7 @@ class ChatApp(QMainWindow):
         ip_layout = QHBoxLayout()
         ip_label = QLabel("IP:")
         ip_input = QLineEdit()
+        ip_input.setPlaceholderText("Optional for peers on your network")
         ip_layout.addWidget(ip_label)
         ip_layout.addWidget(ip_input)
         layout.addLayout(ip_layout)
@@ -570,6 +770,7 @@ class ChatApp(QMainWindow):
         port_layout = QHBoxLayout()
         port_label = QLabel("Port:")
         port_input = QLineEdit()
+        port_input.setPlaceholderText("Optional for peers on your network")
         port_layout.addWidget(port_label)
         port_layout.addWidget(port_input)
         layout.addLayout(port_layout)
@@ -608,6 +809,12 @@ class ChatApp(QMainWindow):
         dialog.exec()
         
     def connect_to_peer(self, peer_ip, peer_port, peer_username, dialog=None):
+        # Peers found on the LAN or met before only need a username
+        if peer_username and not peer_ip and not peer_port:
+            address = self.network.resolve(peer_username)
+            if address is not None:
+                peer_ip, peer_port = address[0], str(address[1])
+        
         # Validate inputs
         if not peer_ip or not peer_port or not peer_username:
             QMessageBox.warning(self, "Invalid Input", "Please enter peer IP, port, and username.")
@@ -619,21 +826,18 @@ class ChatApp(QMainWindow):
             QMessageBox.warning(self, "Invalid Port", "Port must be a number.")
             return
         
-        # Connect to peer
-        success = self.network.initiate_connection(peer_ip, peer_port, peer_username)
+        # Connect in the background; progress arrives through connection_progress
+        self.network.connect_async(peer_ip, peer_port, peer_username)
         
-        if success:
-            # Add peer to list if not already there
-            self.add_peer_to_list(peer_username)
-            
-            # Select the peer
-            self.select_peer_by_name(peer_username)
-            
-            # Close dialog if it exists
-            if dialog:
-                dialog.accept()
-        else:
-            QMessageBox.warning(self, "Connection Failed", f"Failed to connect to {peer_username}")
+        # Add peer to list if not already there
+        self.add_peer_to_list(peer_username)
+        
+        # Select the peer
+        self.select_peer_by_name(peer_username)
+        
+        # Close dialog if it exists
+        if dialog:
+            dialog.accept()
     
     def disconnect_from_peer(self):
         if self.current_peer:
@@ -657,6 +861,11 @@ class ChatApp(QMainWindow):
         if not message:
             return
         
+        # Return in the input still gets here while the Send button is disabled
+        if not self.network.wait_ready(0):
+            self.statusBar().showMessage("The network is still starting", 3000)
+            return
+        
         # Send message
         success = self.network.send_message(self.current_peer, message)
         
@@ -690,10 +899,25 @@ class ChatApp(QMainWindow):
                 QMessageBox.warning(self, "Send Failed", "Failed to send file.")
     
     def handle_message_received(self, username, message):
-        self.add_message(username, message)
+        # Buffer the message; bursts are applied together once per frame
+        self.inbound_messages.append(ChatMessage(username, message))
+        if not self.inbound_timer.isActive():
+            self.inbound_timer.start()
+    
+    def flush_inbound_messages(self):
+        batch, self.inbound_messages = self.inbound_messages, []
         
-        # Add peer to list if not already there
-        self.add_peer_to_list(username)
+        # Group by sender so each conversation gets a single insertion
+        by_peer = {}
+        for message in batch:
+            by_peer.setdefault(message.username, []).append(message)
+        
+        for username, messages in by_peer.items():
+            self.add_messages(username, messages)
+            
+            # Update the peer's activity, counting unread messages for other conversations
+            unread = 0 if username == self.current_peer else len(messages)
+            self.peer_model.record_activity(username, unread, messages[-1].timestamp)
     
     def handle_file_received(self, username, filename, filepath):
         # Show file received dialog
@@ -701,7 +925,7 @@ class ChatApp(QMainWindow):
         dialog.exec()
         
         # Add message to chat
-        self.add_message(username, f"Sent file: {filename}")
+        self.add_message(username, f"Sent file: {filename}", username)
         
         # Add peer to list if not already there
         self.add_peer_to_list(username)
@@ -712,35 +936,172 @@ class ChatApp(QMainWindow):
         dialog.exec()
         
         if dialog.result:
-            # Accept connection
-            success = self.network.accept_connection(ip, port, username)
+            # Accept connection, the key exchange runs in the background
+            self.network.accept_connection(ip, port, username)
             
-            if success:
-                # Add peer to list if not already there
-                self.add_peer_to_list(username)
-                
-                # Select the peer
-                self.select_peer_by_name(username)
-            else:
-                QMessageBox.warning(self, "Connection Failed", f"Failed to connect to {username}")
+            # Add peer to list if not already there
+            self.add_peer_to_list(username)
+            
+            # Select the peer
+            self.select_peer_by_name(username)
         else:
             # Refuse connection
             self.network.refuse_connection(ip, port, username)
     
     def handle_connection_status(self, username, success):
         if success:
-            self.add_message("System", f"Connected to {username}")
+            self.add_message("System", f"Connected to {username}", username)
             
-            # Add peer to list if not already there
-            self.add_peer_to_list(username)
+            # Add peer to list if not already there and show it online
+            self.peer_model.set_online(username, True)
             
             # Select the peer
             self.select_peer_by_name(username)
         else:
-            self.add_message("System", f"Connection to {username} failed")
+            self.add_message("System", f"Connection to {username} failed", username)
+            if self.peer_model.peer(username):
+                self.peer_model.set_online(username, False)
+    
+    def handle_network_ready(self, success, error):
+        if not success:
+            self.statusBar().clearMessage()
+            QMessageBox.critical(self, "Network Error", f"Could not start the network: {error}")
+            return
+        
+        # The requested port may have been taken
+        self.port = self.network.listen_port
+        self.connect_button.setEnabled(True)
+        self.send_button.setEnabled(self.current_peer is not None)
+        self.statusBar().showMessage(f"Listening on {self.network.local_ip}:{self.port}", 5000)
+        self.print_startup_report()
+    
+    def print_startup_report(self):
+        # Only once both the window and the network are up
+        if self.startup_report and self.startup_timer.has("first_paint", "network_ready"):
+            self.startup_report = False
+            print(self.startup_timer.report())
+    
+    def event(self, event):
+        if event.type() == QEvent.Type.Paint and not self.startup_timer.has("first_paint"):
+            self.startup_timer.mark("first_paint")
+            self.print_startup_report()
+        return super().event(event)
+    
+    def handle_history_write_failed(self, count, error):
+        self.statusBar().showMessage(f"{count} message(s) could not be saved to the history: {error}", 10000)
+    
+    def handle_message_sent(self, success, error):
+        # Sent once per message, when it is given up on; failed attempts before that are retried quietly
+        if not success:
+            self.statusBar().showMessage(error, 5000)
+    
+    def handle_connection_progress(self, username, stage):
+        # Connected and failed are reported by handle_connection_status
+        if stage == "connecting":
+            self.statusBar().showMessage(f"Connecting to {username}...")
+        elif stage == "reconnecting":
+            self.statusBar().showMessage(f"Reconnecting to {username}...")
+        elif stage == "awaiting_accept":
+            self.statusBar().showMessage(f"Waiting for {username} to accept...")
+        elif stage == "key_exchange":
+            self.statusBar().showMessage(f"Exchanging keys with {username}...")
+        elif stage == "cancelled":
+            self.statusBar().showMessage(f"Connection to {username} cancelled", 5000)
+            self.add_message("System", f"Connection to {username} cancelled", username)
+        elif stage == "refused":
+            self.statusBar().showMessage(f"{username} refused the connection", 5000)
+        else:
+            self.statusBar().clearMessage()
+    
+    def show_peer_menu(self, position):
+        index = self.peer_list.indexAt(position)
+        if not index.isValid():
+            return
+        
+        username = index.data()
+        menu = QMenu(self)
+        if self.network.is_connecting(username):
+            cancel_action = menu.addAction("Cancel connection")
+            cancel_action.triggered.connect(lambda: self.network.cancel_connection(username))
+        elif (username not in self.network.connected_peers and
+              self.network.ready.is_set() and self.network.resolve(username) is not None):
+            # Discovered or previously known peers need no address; known ones aren't even asked
+            connect_action = menu.addAction("Connect")
+            connect_action.triggered.connect(lambda: self.network.connect_by_name(username))
+        if username not in self.network.connected_peers and self.network.directory.get(username) is not None:
+            forget_action = menu.addAction("Forget pinned key")
+            forget_action.triggered.connect(lambda: self.network.forget_peer(username))
+        if menu.isEmpty():
+            return
+        menu.exec(self.peer_list.viewport().mapToGlobal(position))
+    
+    def handle_peer_discovered(self, username, ip, port):
+        if self.peer_model.peer(username) is None:
+            self.discovered_only.add(username)
+            self.add_peer_to_list(username)
+        self.statusBar().showMessage(f"{username} is on your network", 5000)
+    
+    def handle_peer_lost(self, username):
+        # Peers we never talked to leave the list with their beacons
+        if (username in self.discovered_only and username not in self.network.connected_peers and
+                username not in self.conversations and username != self.current_peer):
+            self.discovered_only.discard(username)
+            self.peer_model.remove_peer(username)
+    
+    def handle_peer_key_changed(self, username, fingerprint):
+        self.add_message("System", f"Warning: {username} offered a key that doesn't match the pinned one "
+                         f"(new fingerprint {fingerprint[:16]}), so the connection was refused. Forget the "
+                         f"pinned key from the peer list if you trust it.", username)
+    
+    def handle_transfer_progress(self, progress):
+        # Progress arrives already rate-limited by the network layer
+        if progress["finished"]:
+            self.active_transfers.pop(progress["transfer_id"], None)
+            verb = "Sent" if progress["direction"] == "send" else "Received"
+            if progress["success"]:
+                self.statusBar().showMessage(f"{verb} {progress['filename']}", 5000)
+            else:
+                self.statusBar().showMessage(f"Transfer of {progress['filename']} failed", 5000)
+        else:
+            self.active_transfers[progress["transfer_id"]] = progress
+        
+        self.update_transfer_status()
+    
+    def update_transfer_status(self):
+        if not self.active_transfers:
+            self.transfer_label.clear()
+            self.transfer_bar.hide()
+            return
+        
+        transfers = list(self.active_transfers.values())
+        done = sum(t["done"] for t in transfers)
+        total = sum(t["total"] for t in transfers)
+        rate = sum(t["rate"] for t in transfers)
+        
+        # Describe a single transfer in full, several as a summary
+        if len(transfers) == 1:
+            t = transfers[0]
+            verb = "Sending" if t["direction"] == "send" else "Receiving"
+            direction = "to" if t["direction"] == "send" else "from"
+            text = f"{verb} {t['filename']} {direction} {t['username']}"
+        else:
+            text = f"{len(transfers)} transfers"
+        
+        if any(t["stalled"] for t in transfers):
+            text += " - stalled"
+        else:
+            text += f" - {format_size(rate)}/s"
+            eta = max(t["eta"] for t in transfers)
+            if eta >= 0:
+                text += f", {int(eta) + 1} s left"
+        
+        self.transfer_label.setText(text)
+        self.transfer_bar.setValue(int(done * 100 / total) if total else 100)
+        self.transfer_bar.show()
     
     def handle_connection_closed(self, username):
-        self.add_message("System", f"{username} disconnected")
+        self.add_message("System", f"{username} disconnected", username)
+        self.peer_model.set_online(username, False)
         
         if self.current_peer == username:
             self.current_peer = None
@@ -748,58 +1109,90 @@ class ChatApp(QMainWindow):
             self.send_button.setEnabled(False)
             self.message_input.setEnabled(False)
     
-    def add_message(self, username, message):
-        # Create message bubble
-        bubble = MessageBubble(message, username == self.username)
-        
-        # Store bubble
-        bubble_id = f"bubble_{username}_{message}"
-        self.message_bubbles[bubble_id] = bubble
-        
-        # Add bubble to chat display
-        cursor = self.chat_display.textCursor()
-        cursor.movePosition(QTextCursor.MoveOperation.End)
-        
-        # Add username if not system message
-        if username != "System":
-            cursor.insertHtml(f"<p style='margin: 5px 0;'><b>{username}:</b></p>")
-        
-        # Insert bubble
-        self.chat_display.document().addResource(
-            QTextDocument.ResourceType.ImageResource,
-            QUrl(bubble_id),
-            bubble.grab()
-        )
+    def conversation_for(self, peer):
+        # Each peer keeps its own conversation for as long as the app runs
+        conversation = self.conversations.get(peer)
+        if conversation is None:
+            # Messages without a peer aren't worth keeping
+            store = self.store if peer is not None else None
+            conversation = ConversationModel(peer, parent=self, store=store)
+            conversation.load_history()
+            self.conversations[peer] = conversation
+        return conversation
+    
+    def add_message(self, username, message, peer=None):
+        self.add_messages(peer, [ChatMessage(username, message, username == self.username)])
+    
+    def add_messages(self, peer, messages):
+        # Messages go to the given peer's conversation, or the one being shown
+        conversation = self.conversation_for(peer if peer is not None else self.current_peer)
+        is_shown = conversation is self.chat_display.model()
+        
+        # Only follow new messages if the view was already at the bottom
+        follow = is_shown and (self.chat_display.is_at_bottom() or any(m.is_self for m in messages))
+        
+        # Queue the messages for the store, which writes them in batches off this thread
+        if conversation.store is not None:
+            store_ids = self.store.append_many([
+                (conversation.peer, m.username, m.text, m.is_self, m.timestamp) for m in messages
+            ])
+            for message, store_id in zip(messages, store_ids):
+                message.store_id = store_id
+        
+        # Appending rows is O(1) per row; the delegate paints them when they scroll into view
+        conversation.append_messages(messages)
+        
+        # Following new messages brings a conversation paged back through its history to the latest rows
+        if follow:
+            conversation.show_latest()
+            self.chat_display.itemDelegate().forget(conversation.take_evicted())
+        
+        # Keep the conversation to its window unless the user is reading older messages
+        if follow or not is_shown:
+            self.chat_display.itemDelegate().forget(conversation.trim())
         
         # Scroll to bottom
-        cursor = self.chat_display.textCursor()
-        cursor.movePosition(QTextCursor.MoveOperation.End)
-        
-        self.chat_display.setTextCursor(cursor)
-        self.chat_display.ensureCursorVisible()
-        
-        # Clean up old bubbles
-        self.cleanup_old_bubbles()
+        if follow:
+            self.chat_display.scrollToBottom()
     
-    def cleanup_old_bubbles(self):
-        # Keep only the last 100 bubbles
-        if len(self.message_bubbles) > 100:
-            # Remove oldest bubbles
-            for bubble_id in list(self.message_bubbles.keys())[:-100]:
-                del self.message_bubbles[bubble_id]
+    def show_search_dialog(self):
+        # One search window, kept open while results are browsed
+        if self.search_dialog is None:
+            self.search_dialog = SearchDialog(self.store, self.current_peer, self)
+            self.search_dialog.result_selected.connect(self.show_search_result)
+        elif self.search_dialog.current_peer != self.current_peer:
+            self.search_dialog.set_current_peer(self.current_peer)
+        self.search_dialog.show()
+        self.search_dialog.raise_()
+        self.search_dialog.query_input.setFocus()
+    
+    def show_search_result(self, peer, store_id):
+        self.add_peer_to_list(peer)
+        self.select_peer_by_name(peer)
+        
+        # Page the conversation back to the message and centre it
+        conversation = self.conversation_for(peer)
+        row = conversation.reveal(store_id)
+        self.chat_display.itemDelegate().forget(conversation.take_evicted())
+        if row < 0:
+            self.statusBar().showMessage("That message is too far back to show", 5000)
+            return
+        index = conversation.index(row, 0)
+        self.chat_display.scrollTo(index, QAbstractItemView.ScrollHint.PositionAtCenter)
+        self.chat_display.setCurrentIndex(index)
+    
+    def load_stored_peers(self):
+        # Peers from earlier sessions are listed by their last stored message
+        for peer, last_activity in self.store.peers():
+            self.peer_model.add_peer(peer)
+            self.peer_model.record_activity(peer, 0, last_activity)
     
     def add_peer_to_list(self, username):
-        # Check if peer is already in list
-        for i in range(self.peer_list.count()):
-            if self.peer_list.item(i).text() == username:
-                return
-        
-        # Add peer to list
-        item = QListWidgetItem(username)
-        self.peer_list.addItem(item)
+        # Dict lookup, so this is cheap to call on every event
+        self.peer_model.add_peer(username)
     
-    def select_peer(self, item):
-        username = item.text()
+    def select_peer(self, index):
+        username = index.data()
         self.select_peer_by_name(username)
     
     def select_peer_by_name(self, username):
@@ -808,14 +1201,18 @@ class ChatApp(QMainWindow):
         
         # Update UI
         self.peer_name_label.setText(username)
-        self.send_button.setEnabled(True)
+        # Nothing can be sent until the network has started; handle_network_ready enables it then
+        self.send_button.setEnabled(self.network.wait_ready(0))
         self.message_input.setEnabled(True)
         
-        # Clear chat display
-        self.chat_display.clear()
+        # Switch to the peer's conversation without re-rendering its history
+        self.chat_display.show_conversation(self.conversation_for(username))
         
-        # Add system message
-        self.add_message("System", f"Connected to {username}")
+        # Highlight the peer and clear its unread count
+        self.peer_model.mark_read(username)
+        row = self.peer_model.row_of(username)
+        if row >= 0:
+            self.peer_list.setCurrentIndex(self.peer_proxy.mapFromSource(self.peer_model.index(row, 0)))
     
     def show_settings(self):
         # Show settings dialog
@@ -837,6 +1234,9 @@ class ChatApp(QMainWindow):
         # Clean up network resources
         if self.network:
             self.network.cleanup()
+        
+        # Write out any messages still queued
+        self.store.close()
         event.accept()
 
 if __name__ == "__main__":